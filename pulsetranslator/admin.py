@@ -0,0 +1,201 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Live introspection of a running translator.
+
+A small HTTP server on a local port or a Unix socket answers with JSON:
+
+    GET  /status                consumer, publish backlog, probes, caches
+    GET  /pending?limit=N       messages waiting for their log, due first
+    GET  /probing               logs being probed right now
+    POST /reprobe?key=PATTERN   probe the matching messages now
+    POST /drop?key=PATTERN      give up on the matching messages
+    POST /retry-publish         cut the publish backoff short
+    POST /flush-caches          clear the parser and lookup caches
+
+Patterns are shell style and match pulse or normalized routing keys.
+On a port, requests must name a loopback host, and POSTs must carry an
+``X-Admin-Request`` header, which pages in a browser cannot send to another
+origin without its consent, so neither DNS rebinding nor cross-site forms
+reach the translator. Requests are served on threads of their own, which
+only hold the locks of the translator for as long as it takes to copy or
+change its state.
+"""
+
+import BaseHTTPServer
+import json
+import os
+import SocketServer
+import threading
+import urlparse
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn,
+                              SocketServer.UnixStreamServer):
+
+    daemon_threads = True
+
+    def server_bind(self):
+        # Create the socket accessible to its owner only, rather than
+        # restricting it once it exists.
+        umask = os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+class AdminRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def refusal(self, method):
+        """Return why a request over TCP is refused, or None."""
+        host = self.headers.get('Host', '')
+        if host.startswith('['):
+            host = host[1:].partition(']')[0]
+        else:
+            host = host.partition(':')[0]
+        if not (is_loopback(host) or host == '::1'):
+            return 'the Host header must name localhost'
+        if method == 'POST' and not self.headers.get('X-Admin-Request'):
+            return 'POST requests need an X-Admin-Request header'
+        return None
+
+    def respond(self, method):
+        url = urlparse.urlparse(self.path)
+        query = dict((name, values[-1]) for name, values
+                     in urlparse.parse_qs(url.query).iteritems())
+        refusal = None
+        if self.server.admin.family == 'tcp':
+            refusal = self.refusal(method)
+        try:
+            if refusal:
+                code, body = 403, {'error': refusal}
+            else:
+                code, body = self.server.admin.handle(method, url.path,
+                                                      query)
+        except Exception as e:
+            self.server.admin.logger.exception('Failure in admin request %s',
+                                               self.path)
+            code, body = 500, {'error': '%s: %s' % (e.__class__.__name__, e)}
+        payload = json.dumps(body, sort_keys=True, indent=2)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+
+def is_loopback(host):
+    return host == 'localhost' or host.startswith('127.')
+
+
+def parse_address(address):
+    """Return the (family, address) of ``host:port``, a bare port, which
+    is bound to localhost, or the path of a Unix socket.
+
+    Anyone who can connect may drop messages, so only loopback hosts are
+    accepted; a Unix socket limits access to its owner.
+    """
+    if '/' in address:
+        return 'unix', address
+    host, sep, port = address.rpartition(':')
+    try:
+        port = int(port)
+    except ValueError:
+        raise ValueError('admin address %r is not [host:]port or a path' %
+                         address)
+    if host and not is_loopback(host):
+        raise ValueError('admin address %r is not on localhost; use a Unix '
+                         'socket path to restrict access instead' % address)
+    return 'tcp', (host or '127.0.0.1', port)
+
+
+class AdminServer(object):
+    """Serve introspection of ``translator`` at ``address``."""
+
+    def __init__(self, translator, address, logger):
+        self.translator = translator
+        self.logger = logger
+        self.family, self.address = parse_address(address)
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        if self.family == 'unix':
+            if os.path.exists(self.address):
+                # left behind by an instance which did not shut down
+                os.remove(self.address)
+            self.server = ThreadingUnixHTTPServer(self.address,
+                                                  AdminRequestHandler)
+        else:
+            self.server = ThreadingHTTPServer(self.address,
+                                              AdminRequestHandler)
+        self.server.admin = self
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.5},
+                                       name='AdminServer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        if self.family == 'unix' and os.path.exists(self.address):
+            os.remove(self.address)
+        self.server = None
+
+    def handle(self, method, path, query):
+        """Return the status code and JSON body answering a request."""
+        translator = self.translator
+        loghandler = translator.loghandler
+        if method == 'GET':
+            if path == '/status':
+                return 200, translator.status()
+            if path == '/pending':
+                limit = int(query.get('limit', 100))
+                return 200, {'waiting': loghandler.waiting,
+                             'messages': loghandler.pending_snapshot(limit)}
+            if path == '/probing':
+                return 200, {'messages': loghandler.probes_in_flight()}
+        elif method == 'POST':
+            if path in ('/reprobe', '/drop'):
+                if not query.get('key'):
+                    return 400, {'error': 'a key pattern is required'}
+                if path == '/reprobe':
+                    result = {'messages': loghandler.reprobe(query['key'])}
+                else:
+                    # Messages being probed are dropped unless the probe
+                    # publishes them.
+                    dropped, probing = loghandler.drop(query['key'])
+                    result = {'messages': dropped, 'probing': probing}
+                self.logger.info({'admin': dict(result, action=path[1:],
+                                                key=query['key'])})
+                return 200, result
+            if path == '/retry-publish':
+                loghandler.outbox.retry_now()
+                return 200, loghandler.outbox.stats()
+            if path == '/flush-caches':
+                translator.flush_caches()
+                self.logger.info({'admin': {'action': 'flush-caches'}})
+                return 200, translator.cache_stats()
+        return 404, {'error': 'no such resource: %s %s' % (method, path)}
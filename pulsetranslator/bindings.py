@@ -0,0 +1,175 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Topic bindings of the consumer queue and the prefilter behind them.
+
+Only 'log_uploaded' messages are translated, so by default the queue is
+bound to ``#.log_uploaded`` alone and the broker never sends the
+'finished' message of a job. Trees and platforms cannot be selected by
+topic: buildbot routing keys have the form ``build.<builder>.<number>.
+<event>``, and the tree and platform are only part of the builder word.
+They are selected by the ``Prefilter`` instead, which looks at the routing
+key before the message body is decoded.
+"""
+
+import fnmatch
+import re
+
+from memo import BoundedMemo
+
+DEFAULT_TOPICS = ['#.log_uploaded']
+
+# Topics bound by earlier versions, which are unbound from durable queues
+# once they are no longer configured.
+LEGACY_TOPICS = ['#.finished', '#.log_uploaded']
+
+
+def topic_regex(topic):
+    """Return a compiled regex for an AMQP topic binding."""
+    pattern = re.escape(topic).replace(r'\#', '.*').replace(r'\*', '[^.]+')
+    return re.compile('^%s$' % pattern)
+
+
+def parse_list(spec):
+    """Return the items of a comma separated configuration string."""
+    return [item.strip() for item in (spec or '').split(',') if item.strip()]
+
+
+class Prefilter(object):
+    """Drop unwanted messages by routing key.
+
+    ``wanted`` is a list of shell style tree patterns, each optionally
+    followed by ``/`` and a platform pattern; if given, only messages for
+    matching trees and platforms are translated. ``excluded`` is a list of
+    shell style builder name patterns whose messages are never translated.
+    Trees and platforms are taken from the routing key with ``trees``, a
+    ``TreeIndex``; keys it cannot split are let through, and the
+    translations of messages let through are checked again by ``wants()``.
+    """
+
+    def __init__(self, trees, wanted=None, excluded=None):
+        self.trees = trees
+        self.wanted = []
+        for pattern in wanted or []:
+            tree, sep, platform = pattern.partition('/')
+            self.wanted.append((tree, platform or '*'))
+        self.excluded = excluded or []
+        self.reasons = BoundedMemo(4096)
+
+    def check(self, key):
+        """Return why a message with routing key ``key`` is dropped, or
+        None if it is to be translated.
+        """
+        if not self.wanted and not self.excluded:
+            return None
+        # The build number varies for every message of a builder.
+        parts = key.split('.')
+        return self.reasons.get('.'.join(parts[:-2] + parts[-1:]),
+                                lambda: self.reason(key))
+
+    def reason(self, key):
+        parts = key.split('.')
+        builder = '.'.join(parts[1:-2])
+        for pattern in self.excluded:
+            if fnmatch.fnmatchcase(builder, pattern):
+                return 'excluded %s' % pattern
+        if not self.wanted:
+            return None
+
+        parsed = self.trees.split(key)
+        if parsed is None:
+            return None
+        for tree, platform in self.wanted:
+            if fnmatch.fnmatchcase(parsed.tree, tree) and (
+                    parsed.platform is None or
+                    fnmatch.fnmatchcase(parsed.platform, platform)):
+                return None
+        return 'unwanted tree or platform'
+
+    def wants(self, data):
+        """Return whether a normalized message is for a wanted tree and
+        platform.
+        """
+        if not self.wanted:
+            return True
+        tree = data.get('tree') or ''
+        platform = data.get('platform') or ''
+        return any(fnmatch.fnmatchcase(tree, tree_pattern) and
+                   fnmatch.fnmatchcase(platform, platform_pattern)
+                   for tree_pattern, platform_pattern in self.wanted)
+
+
+class TrafficReport(object):
+    """Count what became of the messages each topic binding carried.
+
+    Every message is counted for each binding matching its routing key as
+    'translated', or as useless: 'prefiltered', 'ignored' when translation
+    produced no message to publish, or 'failed'.
+    """
+
+    OUTCOMES = ('translated', 'prefiltered', 'ignored', 'failed')
+
+    def __init__(self, topics):
+        self.bindings = [(topic, topic_regex(topic)) for topic in topics]
+        self.counts = dict((topic, dict.fromkeys(self.OUTCOMES, 0))
+                           for topic in topics)
+        self.reasons = dict((topic, {}) for topic in topics)
+        self.topics = BoundedMemo(4096)
+
+    def matching(self, key):
+        return [topic for topic, regex in self.bindings if regex.match(key)]
+
+    def record(self, key, outcome, reason=None):
+        parts = key.split('.')
+        topics = self.topics.get('.'.join(parts[:-2] + parts[-1:]),
+                                 lambda: self.matching(key))
+        for topic in topics:
+            self.counts[topic][outcome] += 1
+            if reason:
+                reasons = self.reasons[topic]
+                reasons[reason] = reasons.get(reason, 0) + 1
+
+    def stats(self):
+        stats = {}
+        for topic, counts in self.counts.iteritems():
+            received = sum(counts.values())
+            stats[topic] = dict(counts, received=received,
+                                reasons=dict(self.reasons[topic]))
+            if received:
+                stats[topic]['useless'] = round(
+                    1 - counts['translated'] / float(received), 3)
+        return stats
+
+
+def prefiltering(consumer_class, skip):
+    """Return a subclass of a mozillapulse consumer class which passes the
+    routing key of each message to ``skip`` before decoding it, and acks
+    the messages it returns true for without decoding them. Legacy topics
+    which are not configured are unbound from the queue.
+    """
+
+    class PrefilteringConsumer(consumer_class):
+
+        unbound = False
+
+        def _build_consumer(self, *args, **kwargs):
+            from kombu import Exchange
+
+            consumer = consumer_class._build_consumer(self, *args, **kwargs)
+            if not self.unbound:
+                exchange = Exchange(self.exchange[0], type='topic')
+                for topic in LEGACY_TOPICS:
+                    if topic not in self.topic:
+                        consumer.queues[0].unbind_from(exchange, topic)
+                self.unbound = True
+            consumer.on_message = self.on_raw_message
+            return consumer
+
+        def on_raw_message(self, message):
+            if skip(message.delivery_info.get('routing_key', '')):
+                message.ack()
+                return
+            self.callback(message.decode(), message)
+
+    return PrefilteringConsumer
@@ -0,0 +1,307 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Publishing each normalized message once across translator instances.
+
+Translators run side by side for availability each consume every pulse
+message, from queues of their own. Before publishing a normalized message,
+an instance claims it in a store shared by all of them, keyed by its
+routing key, buildid, locale and the pulse routing key of its job. The
+instance whose claim succeeds publishes the message and marks it published
+once the exchange accepted it; the others drop their copies. The claiming
+instance renews its claim while the message waits to be published, as in
+the outbox during a broker outage. A claim which is not renewed lapses after
+a lease, so when the claiming instance died, another one takes the message
+over the next time it probes its log.
+Every other message of a dead instance is published by the others anyway,
+as they have copies of their own.
+
+Stores implement ``claim(key, owner, lease, now)``, returning one of
+``CLAIMED``, ``TAKEN_OVER``, ``PUBLISHED`` or ``BUSY``, and
+``published(key, owner, retention, now)``.
+"""
+
+import os
+import threading
+import time
+import urlparse
+
+# The claim succeeded; TAKEN_OVER if it replaced a lapsed claim of another
+# owner.
+CLAIMED = 'claimed'
+TAKEN_OVER = 'taken_over'
+# The message was published by some instance.
+PUBLISHED = 'published'
+# Another owner holds a claim on the message.
+BUSY = 'busy'
+
+
+def message_key(message):
+    """Return the dedup key of an ``EncodedMessage``."""
+    # Routing keys only name the builder; retriggers of a job share its
+    # buildid but not its pulse routing key, which has the build number.
+    # The locales of a release repack share both.
+    data = message.data
+    return '%s %s %s %s' % (message.routing_key, data.get('buildid'),
+                            data.get('key'), data.get('locale'))
+
+
+def open_store(url):
+    """Return the store for ``sqlite:///path``, a plain path, or
+    ``redis://host:port/db``; nothing is connected until first used.
+    """
+    scheme = urlparse.urlsplit(url).scheme
+    if scheme in ('redis', 'rediss'):
+        return RedisStore(url)
+    if scheme == 'sqlite':
+        return SQLiteStore(url[len('sqlite://'):])
+    if '://' not in url:
+        return SQLiteStore(url)
+    raise ValueError('unsupported dedup store %r' % url)
+
+
+class SQLiteStore(object):
+    """Claims in a SQLite database, for instances on one host."""
+
+    def __init__(self, path, timeout=30, purge_every=1000):
+        self.path = path
+        self.timeout = timeout
+        self.purge_every = purge_every
+        self.lock = threading.Lock()
+        self.db = None
+        self.writes = 0
+
+    def open(self):
+        import sqlite3
+
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.access(dirname, os.F_OK):
+            os.makedirs(dirname)
+        self.db = sqlite3.connect(self.path, timeout=self.timeout,
+                                  isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS claims '
+                        '(key TEXT PRIMARY KEY, owner TEXT, state TEXT, '
+                        'expires REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS claims_expires '
+                        'ON claims (expires)')
+
+    def write(self, key, owner, state, expires, now):
+        self.db.execute('INSERT OR REPLACE INTO claims VALUES (?, ?, ?, ?)',
+                        (key, owner, state, expires))
+        self.writes += 1
+        if self.writes % self.purge_every == 0:
+            self.db.execute('DELETE FROM claims WHERE expires < ?', (now,))
+
+    def claim(self, key, owner, lease, now):
+        with self.lock:
+            if self.db is None:
+                self.open()
+            # Other instances wait for the write lock until COMMIT.
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute(
+                    'SELECT owner, state, expires FROM claims WHERE key = ?',
+                    (key,)).fetchone()
+                if row is None or row[2] < now:
+                    result = (TAKEN_OVER if row and row[1] == CLAIMED and
+                              row[0] != owner else CLAIMED)
+                elif row[1] == PUBLISHED:
+                    result = PUBLISHED
+                elif row[0] == owner:
+                    result = CLAIMED
+                else:
+                    result = BUSY
+                if result in (CLAIMED, TAKEN_OVER):
+                    self.write(key, owner, CLAIMED, now + lease, now)
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+            return result
+
+    def published(self, key, owner, retention, now):
+        with self.lock:
+            if self.db is None:
+                self.open()
+            self.write(key, owner, PUBLISHED, now + retention, now)
+
+
+class RedisStore(object):
+    """Claims in Redis or a store speaking its protocol, for instances on
+    several hosts. Lapsed claims expire in the store, so takeovers are
+    counted as plain claims.
+    """
+
+    prefix = 'pulsetranslator:'
+
+    def __init__(self, url):
+        self.url = url
+        self.client = None
+
+    def open(self):
+        import redis
+
+        self.client = redis.StrictRedis.from_url(self.url)
+
+    def claim(self, key, owner, lease, now):
+        if self.client is None:
+            self.open()
+        key = self.prefix + key
+        value = '%s %s' % (CLAIMED, owner)
+        lease = max(1, int(lease * 1000))
+        if self.client.set(key, value, nx=True, px=lease):
+            return CLAIMED
+        current = self.client.get(key)
+        if current is None:
+            # The claim lapsed in between.
+            return (CLAIMED if self.client.set(key, value, nx=True, px=lease)
+                    else BUSY)
+        state, _, current_owner = current.decode('utf-8').partition(' ')
+        if state == PUBLISHED:
+            return PUBLISHED
+        if current_owner == owner:
+            self.client.set(key, value, px=lease)
+            return CLAIMED
+        return BUSY
+
+    def published(self, key, owner, retention, now):
+        if self.client is None:
+            self.open()
+        self.client.set(self.prefix + key, '%s %s' % (PUBLISHED, owner),
+                        px=max(1, int(retention * 1000)))
+
+
+class PublishDedup(object):
+    """Claim messages for ``owner`` in ``store`` and count the outcomes.
+
+    Claims last ``lease`` seconds and published marks ``retention``
+    seconds, which must exceed the time a copy of a message may take to
+    reach another instance, including its wait for the log. Claims are
+    renewed every third of a lease until the message is marked published,
+    for up to ``retention`` seconds. If the store fails, messages are
+    published anyway: a duplicate is better than a lost message.
+    """
+
+    def __init__(self, store, owner, logger, lease=60, retention=86400):
+        self.store = store
+        self.owner = owner
+        self.logger = logger
+        self.lease = lease
+        self.retention = retention
+        self.condition = threading.Condition()
+        # key -> when it was claimed, for the claims not marked published
+        self.held = {}
+        self.renewer = None
+        self.stopped = False
+        self.counts = dict.fromkeys([CLAIMED, TAKEN_OVER, PUBLISHED, BUSY,
+                                     'marked', 'renewed', 'lost',
+                                     'store_errors'], 0)
+
+    def count(self, name):
+        with self.condition:
+            self.counts[name] += 1
+
+    def claim(self, message):
+        """Return whether to publish a message now: True, or False if it
+        was published already, or None if another instance holds it.
+        """
+        key = message_key(message)
+        try:
+            result = self.store.claim(key, self.owner, self.lease,
+                                      time.time())
+        except Exception:
+            self.logger.exception('Failure when claiming %s' %
+                                  message.routing_key)
+            self.count('store_errors')
+            return True
+        self.count(result)
+        if result == BUSY:
+            return None
+        if result == PUBLISHED:
+            return False
+        self.hold(key)
+        return True
+
+    def hold(self, key):
+        with self.condition:
+            self.held[key] = time.time()
+            if self.renewer is None:
+                self.renewer = threading.Thread(target=self.renew_held,
+                                                name='DedupRenewer')
+                self.renewer.daemon = True
+                self.renewer.start()
+            self.condition.notify()
+
+    def renew_held(self):
+        """Renew the claims held for longer than a third of a lease."""
+        interval = self.lease / 3.0
+        while True:
+            with self.condition:
+                while not self.held and not self.stopped:
+                    # hold() and close() notify.
+                    self.condition.wait()
+                if not self.stopped:
+                    self.condition.wait(interval)
+                if self.stopped:
+                    return
+                now = time.time()
+                for key, since in self.held.items():
+                    if since < now - self.retention:
+                        del self.held[key]
+                keys = [key for key, since in self.held.iteritems()
+                        if since <= now - interval]
+            for key in keys:
+                try:
+                    result = self.store.claim(key, self.owner, self.lease,
+                                              time.time())
+                except Exception:
+                    self.logger.exception('Failure when renewing %s' % key)
+                    self.count('store_errors')
+                    continue
+                with self.condition:
+                    if key not in self.held:
+                        # Marked published meanwhile.
+                        continue
+                    if result in (CLAIMED, TAKEN_OVER):
+                        self.counts['renewed'] += 1
+                        continue
+                    del self.held[key]
+                    self.counts['lost'] += 1
+                self.logger.warning('Claim on %s lapsed before it was '
+                                    'published; it may be published twice.'
+                                    % key)
+
+    def close(self, timeout):
+        """Stop renewing claims; those not marked published lapse."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+            renewer = self.renewer
+        if renewer:
+            renewer.join(timeout)
+
+    def published(self, message):
+        key = message_key(message)
+        with self.condition:
+            self.held.pop(key, None)
+        try:
+            self.store.published(key, self.owner, self.retention,
+                                 time.time())
+        except Exception:
+            self.logger.exception('Failure when marking %s published' %
+                                  message.routing_key)
+            self.count('store_errors')
+            return
+        self.count('marked')
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counts)
+            stats['held'] = len(self.held)
+        stats['duplicates'] = stats.pop(PUBLISHED)
+        stats['deferred'] = stats.pop(BUSY)
+        return stats
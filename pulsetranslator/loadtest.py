@@ -0,0 +1,552 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Offline end-to-end load test for the translator.
+
+Replays the stored pulse messages under test/pulse_messages through a
+complete translator at a configurable rate. Pulse is replaced by an
+in-process broker with mozillapulse compatible consumer and publisher
+shims, and every log url is rewritten to point at a local HTTP server
+which simulates upload delays, missing logs (404) and redirects. When
+done, throughput and latency from replay to normalized publish are
+reported.
+
+    python pulsetranslator/loadtest.py --rate 50 --count 1000 \\
+        --max-delay 5 --missing-rate 0.05 --log-timeout 10
+"""
+
+import BaseHTTPServer
+import copy
+import email.utils
+import glob
+import json
+import optparse
+import os
+import Queue
+import random
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
+import urlparse
+
+from bindings import parse_list, topic_regex
+from dedup import SQLiteStore
+from priorities import parse_priorities
+from pulsetranslator import PulseBuildbotTranslator
+from shadow import load_engine
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_MESSAGES = os.path.join(HERE, os.pardir, 'test', 'pulse_messages')
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(pct / 100.0 * (len(values) - 1)))]
+
+
+class FakeMessage(object):
+
+    def ack(self):
+        pass
+
+
+class FakeBroker(object):
+    """In-process stand-in for the pulse broker.
+
+    ``consumer_class`` and ``publisher_class`` return classes which can be
+    handed to the translator in place of ``BuildConsumer`` and
+    ``NormalizedBuildPublisher``. Every message sent goes to each of
+    ``queues`` queues, one per translator instance.
+    """
+
+    def __init__(self, publish_failure_rate=0, queues=1):
+        self.publish_failure_rate = publish_failure_rate
+        self.queues = [Queue.Queue() for i in range(queues)]
+        self.lock = threading.Lock()
+        self.published = []
+        self.in_callback = 0
+        # consumers cannot connect until then
+        self.down_until = 0
+        self.closed = False
+
+    def send(self, data):
+        for queue in self.queues:
+            queue.put(data)
+
+    def outage(self, seconds):
+        self.down_until = time.time() + seconds
+
+    def close(self):
+        """Make the consumers return from listen()."""
+        self.closed = True
+
+    def available(self):
+        return time.time() >= self.down_until
+
+    def idle(self):
+        return (all(queue.empty() for queue in self.queues) and
+                not self.in_callback)
+
+    def record(self, routing_key, data):
+        with self.lock:
+            self.published.append((time.time(), routing_key, data))
+
+    def consumer_class(self, index=0):
+        return type('FakeConsumer', (FakeConsumer,),
+                    {'broker': self, 'queue': self.queues[index]})
+
+    def publisher_class(self):
+        return type('FakePublisher', (FakePublisher,), {'broker': self})
+
+
+class FakeConsumer(object):
+
+    broker = None
+    queue = None
+
+    def __init__(self, applabel=None, connect=True, **kwargs):
+        self.applabel = applabel
+        self.config = None
+        self.topic = []
+        self.callback = None
+        self.durable = False
+
+    def configure(self, **kwargs):
+        for key, value in kwargs.iteritems():
+            setattr(self, key, value)
+
+    def disconnect(self):
+        pass
+
+    def listen(self, on_connect_callback=None):
+        bindings = [topic_regex(topic) for topic in self.topic]
+        if not self.broker.available():
+            raise IOError('broker unavailable')
+        if on_connect_callback:
+            on_connect_callback()
+        while not self.broker.closed:
+            if not self.broker.available():
+                raise IOError('connection lost')
+            # Poll, as a blocking get() would keep signal handlers such as
+            # the translator's SIGTERM handler from running.
+            try:
+                data = self.queue.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+            key = data['_meta']['routing_key']
+            if [regex for regex in bindings if regex.match(key)]:
+                self.broker.in_callback += 1
+                try:
+                    self.callback(data, FakeMessage())
+                finally:
+                    self.broker.in_callback -= 1
+
+
+class FakePublisher(object):
+
+    broker = None
+
+    def __init__(self, connect=True, **kwargs):
+        self.config = None
+
+    def publish(self, message):
+        message._prepare()
+        if random.random() < self.broker.publish_failure_rate:
+            raise IOError('simulated publish failure')
+        self.broker.record(message.routing_key, message.data)
+
+
+class LogRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve simulated logs.
+
+    /log/<id>?ready=<epoch> returns 404 before ``ready`` and a log after,
+    /redirect/<id>?ready=<epoch> redirects to the matching /log/ url, and
+    /missing/<id> always returns 404.
+    """
+
+    body = 'simulated log line\n' * 100
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, send_body):
+        url = urlparse.urlparse(self.path)
+        kind = url.path.split('/')[1]
+        ready = float(urlparse.parse_qs(url.query).get('ready', ['0'])[0])
+
+        if kind == 'redirect':
+            self.send_response(302)
+            self.send_header('Location', self.path.replace('/redirect/',
+                                                           '/log/', 1))
+            self.end_headers()
+        elif kind == 'log' and time.time() >= ready:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(self.body)))
+            self.send_header('Last-Modified', email.utils.formatdate(
+                ready, usegmt=True))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(self.body)
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def do_GET(self):
+        self.respond(True)
+
+
+class LogServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           LogRequestHandler)
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       name='LogServer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def base_url(self):
+        return 'http://%s:%d' % self.server_address
+
+
+class LoadGenerator(object):
+    """Replay stored messages into a broker at a fixed rate.
+
+    Each replayed message gets a unique log url on the ``LogServer``. The
+    scenario of every message ('delayed', 'redirect' or 'missing') and the
+    time its log becomes available are remembered for the report.
+    """
+
+    def __init__(self, broker, log_server, messages, rate, max_delay=0,
+                 missing_rate=0, redirect_rate=0, builder_delays=False):
+        self.broker = broker
+        self.log_server = log_server
+        self.messages = messages
+        self.rate = rate
+        self.max_delay = max_delay
+        self.missing_rate = missing_rate
+        self.redirect_rate = redirect_rate
+        # stored message index -> typical upload delay of its logs
+        self.typical_delays = None
+        if builder_delays:
+            self.typical_delays = [random.uniform(0, max_delay)
+                                   for message in messages]
+        # message id -> (scenario, sent at, log ready at)
+        self.sent = {}
+
+    def make_message(self, msgid, template):
+        data = copy.deepcopy(template)
+        now = time.time()
+        if self.typical_delays:
+            ready = now + self.typical_delays[msgid % len(self.messages)] * (
+                random.uniform(0.8, 1.2))
+        else:
+            ready = now + random.uniform(0, self.max_delay)
+
+        draw = random.random()
+        if draw < self.missing_rate:
+            scenario = 'missing'
+            url = '%s/missing/%d' % (self.log_server.base_url, msgid)
+            ready = None
+        elif draw < self.missing_rate + self.redirect_rate:
+            scenario = 'redirect'
+            url = '%s/redirect/%d?ready=%f' % (self.log_server.base_url,
+                                               msgid, ready)
+        else:
+            scenario = 'delayed'
+            url = '%s/log/%d?ready=%f' % (self.log_server.base_url, msgid,
+                                          ready)
+
+        for prop in data['payload']['build']['properties']:
+            if prop[0] == 'log_url':
+                prop[1] = url
+        # The job ends, and its message is sent, now.
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%S+0000', time.gmtime(now))
+        data['payload']['build']['times'][1] = stamp
+        data['_meta']['sent'] = stamp
+        # Every replay is a job of its own, with a build number of its own.
+        key = data['_meta']['routing_key'].split('.')
+        key[-2] = str(msgid)
+        data['_meta']['routing_key'] = '.'.join(key)
+
+        self.sent[msgid] = (scenario, now, ready)
+        return data
+
+    def run(self, count):
+        start = time.time()
+        for msgid in range(count):
+            template = self.messages[msgid % len(self.messages)]
+            self.broker.send(self.make_message(msgid, template))
+            delay = start + (msgid + 1) / float(self.rate) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def message_id(logurl):
+    return int(urlparse.urlparse(logurl).path.split('/')[2])
+
+
+def report(generator, broker, translators, duration):
+    first_publish = {}
+    distinct = set()
+    for published_at, routing_key, data in broker.published:
+        msgid = message_id(data['logurl'])
+        first_publish.setdefault(msgid, published_at)
+        distinct.add((routing_key, msgid, data.get('locale')))
+
+    print 'messages replayed: %d' % len(generator.sent)
+    print 'normalized messages published: %d in %.1f s (%.1f/s)' % (
+        len(broker.published), duration, len(broker.published) / duration)
+    if len(translators) > 1:
+        print 'duplicates published: %d' % (len(broker.published) -
+                                            len(distinct))
+        for index, translator in enumerate(translators):
+            print 'instance %d dedup: %s' % (index, json.dumps(
+                translator.dedup.stats(), sort_keys=True))
+
+    # The remaining figures are those of the first instance.
+    translator = translators[0]
+
+    print 'publish outbox: %s' % json.dumps(
+        translator.loghandler.outbox.stats(), sort_keys=True)
+    print 'messages waiting for logs: %s' % json.dumps(
+        translator.loghandler.pending_stats(), sort_keys=True)
+    for name, stats in sorted(translator.loghandler.latency_stats().items()):
+        print 'publish latency of class %s: %s' % (
+            name, json.dumps(stats, sort_keys=True))
+
+    for topic, stats in sorted(translator.traffic.stats().items()):
+        print 'binding %s: %s' % (topic, json.dumps(stats, sort_keys=True))
+    print 'interned fields: %s' % json.dumps(
+        translator.parser.strings.stats(), sort_keys=True)
+    print 'log probes: %s' % json.dumps(
+        translator.probe_schedule.stats(), sort_keys=True)
+    print 'consumer reconnects: %s' % json.dumps(
+        translator.reconnects.stats(), sort_keys=True)
+    print 'traces: %d completed, %d deduplicated, %d failed' % (
+        translator.tracer.completed, translator.tracer.deduplicated,
+        translator.tracer.failed)
+    for name, stages in sorted(translator.tracer.stats()['latency'].items()):
+        print '    %s: %s' % (name, ' '.join(
+            '%s p50 %.2fs p99 %.2fs' % (stage, stats['p50'], stats['p99'])
+            for stage, stats in sorted(stages.items())))
+
+    if translator.shadow:
+        translator.shadow.flush(10)
+        print 'shadow comparison: %s' % json.dumps(
+            translator.shadow.stats(), sort_keys=True)
+
+    for scenario in ['delayed', 'redirect', 'missing']:
+        ids = [msgid for msgid, sent in generator.sent.items()
+               if sent[0] == scenario]
+        if not ids:
+            continue
+        done = [msgid for msgid in ids if msgid in first_publish]
+        latency = [first_publish[msgid] - generator.sent[msgid][1]
+                   for msgid in done]
+        overhead = [first_publish[msgid] - generator.sent[msgid][2]
+                    for msgid in done if generator.sent[msgid][2]]
+
+        print '%s: %d replayed, %d published' % (scenario, len(ids),
+                                                  len(done))
+        for name, values in [('latency', latency),
+                             ('latency after log ready', overhead)]:
+            if values:
+                print '    %s p50 %.2fs p90 %.2fs p99 %.2fs max %.2fs' % (
+                    name, percentile(values, 50), percentile(values, 90),
+                    percentile(values, 99), max(values))
+
+
+def make_translator(options, broker, index, logdir, dedup_store=None):
+    return PulseBuildbotTranslator(
+        logdir=logdir,
+        label='loadtest-%d' % index,
+        admin_address=options.admin_address if index == 0 else None,
+        log_stable_interval=options.log_stable_interval,
+        log_timeout=options.log_timeout,
+        log_retry_interval=options.log_retry_interval,
+        pending_memory=options.pending_memory,
+        priorities=parse_priorities(options.priorities),
+        topics=parse_list(options.bindings),
+        wanted=parse_list(options.wanted),
+        excluded=parse_list(options.excluded),
+        report_bindings=3600,
+        first_probe_quantile=options.first_probe_quantile,
+        shadow_engine=(load_engine(options.shadow_engine)
+                       if options.shadow_engine else None),
+        dedup_store=dedup_store, dedup_lease=options.dedup_lease,
+        consumer_class=broker.consumer_class(index),
+        publisher_class=broker.publisher_class())
+
+
+def stop_instance(translator):
+    """Stop a translator probing for logs, leaving its claims behind."""
+    translator.stopping.set()
+    with translator.loghandler.condition:
+        translator.loghandler.condition.notify_all()
+
+
+def stop_translators(broker, translators, threads, timeout):
+    """Shut the translators down and wait for their threads, so that none
+    of them still writes to the log directory.
+    """
+    for translator in translators:
+        translator.stopping.set()
+    broker.close()
+    for translator, thread in zip(translators, threads):
+        # The listener returns, the translator parks what is left and
+        # stops its log writer; then the probers and outbox are joined.
+        thread.join(timeout)
+        translator.loghandler.close(timeout)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--messages', dest='messages',
+                      default=DEFAULT_MESSAGES,
+                      help='directory of stored pulse messages to replay')
+    parser.add_option('--rate', dest='rate', type='float', default=10,
+                      help='messages replayed per second')
+    parser.add_option('--count', dest='count', type='int', default=200,
+                      help='number of messages to replay')
+    parser.add_option('--max-delay', dest='max_delay', type='float',
+                      default=0,
+                      help='maximum simulated upload delay of logs, seconds')
+    parser.add_option('--missing-rate', dest='missing_rate', type='float',
+                      default=0, help='fraction of logs which never appear')
+    parser.add_option('--redirect-rate', dest='redirect_rate', type='float',
+                      default=0, help='fraction of log urls which redirect')
+    parser.add_option('--publish-failure-rate', dest='publish_failure_rate',
+                      type='float', default=0,
+                      help='fraction of publish attempts which fail')
+    parser.add_option('--log-timeout', dest='log_timeout', type='int',
+                      default=600,
+                      help='seconds before the translator gives up on a log')
+    parser.add_option('--log-retry-interval', dest='log_retry_interval',
+                      type='float', default=1,
+                      help='seconds between probes of a log url')
+    parser.add_option('--log-stable-interval', dest='log_stable_interval',
+                      type='int', default=0,
+                      help='seconds a log must be unchanged to be complete')
+    parser.add_option('--pending-memory', dest='pending_memory', type='int',
+                      default=1000,
+                      help='messages waiting for their log to keep in memory')
+    parser.add_option('--priorities', dest='priorities', default='',
+                      help='priority classes as "pattern: weight, ..."')
+    parser.add_option('--bindings', dest='bindings', default='',
+                      help='comma separated topics to bind')
+    parser.add_option('--wanted', dest='wanted', default='',
+                      help='comma separated "tree[/platform]" patterns')
+    parser.add_option('--excluded', dest='excluded', default='',
+                      help='comma separated builder name patterns')
+    parser.add_option('--shadow-engine', dest='shadow_engine',
+                      help='candidate engine to compare, as module:attribute')
+    parser.add_option('--first-probe-quantile',
+                      dest='first_probe_quantile', type='float', default=0.25,
+                      help='quantile of learned log delays to probe first at')
+    parser.add_option('--no-probe-prediction', dest='first_probe_quantile',
+                      action='store_const', const=None,
+                      help='probe for logs right away')
+    parser.add_option('--builder-delays', dest='builder_delays',
+                      action='store_true', default=False,
+                      help='give the logs of each stored message a typical '
+                      'upload delay, varied by up to 20%')
+    parser.add_option('--broker-outage', dest='broker_outage', type='float',
+                      help='seconds the broker is unavailable to the '
+                      'consumer, starting halfway through the replay')
+    parser.add_option('--instances', dest='instances', type='int',
+                      default=1,
+                      help='translators consuming every message, each from '
+                      'a queue of its own, and publishing each once through '
+                      'a shared dedup store')
+    parser.add_option('--kill-instance-after', dest='kill_instance_after',
+                      type='float',
+                      help='seconds into the replay after which the last '
+                      'instance stops probing and publishing, as if it died')
+    parser.add_option('--dedup-lease', dest='dedup_lease', type='float',
+                      default=5,
+                      help='seconds before an instance takes over a message '
+                      'claimed by another')
+    parser.add_option('--admin-address', dest='admin_address',
+                      help='serve introspection of the first instance at '
+                      'a port on localhost or a Unix socket path')
+    parser.add_option('--drain', dest='drain', type='float',
+                      help='seconds to wait for outstanding messages after '
+                      'the replay; defaults to the log timeout plus a margin')
+    options, args = parser.parse_args()
+
+    messages = [json.load(open(path)) for path in
+                sorted(glob.glob(os.path.join(options.messages, '*', '*')))]
+
+    broker = FakeBroker(options.publish_failure_rate,
+                        queues=options.instances)
+    log_server = LogServer()
+    logdir = tempfile.mkdtemp()
+
+    translators = []
+    threads = []
+    try:
+        for index in range(options.instances):
+            translators.append(make_translator(
+                options, broker, index,
+                os.path.join(logdir, 'instance-%d' % index),
+                dedup_store=(SQLiteStore(os.path.join(logdir, 'dedup.sqlite'))
+                             if options.instances > 1 else None)))
+            thread = threading.Thread(target=translators[-1].start,
+                                      name='Translator-%d' % index)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        live = list(translators)
+
+        generator = LoadGenerator(broker, log_server, messages, options.rate,
+                                  max_delay=options.max_delay,
+                                  missing_rate=options.missing_rate,
+                                  redirect_rate=options.redirect_rate,
+                                  builder_delays=options.builder_delays)
+        if options.broker_outage:
+            outage = threading.Timer(options.count / options.rate / 2,
+                                     broker.outage, [options.broker_outage])
+            outage.daemon = True
+            outage.start()
+        if options.kill_instance_after is not None:
+            kill = threading.Timer(options.kill_instance_after,
+                                   stop_instance, [live.pop()])
+            kill.daemon = True
+            kill.start()
+        start = time.time()
+        generator.run(options.count)
+
+        drain = options.drain
+        if drain is None:
+            drain = options.log_timeout + 3 * options.log_retry_interval
+        deadline = time.time() + drain
+        while time.time() < deadline and (
+                not broker.idle() or
+                any(translator.loghandler.waiting or
+                    translator.loghandler.outbox.backlog
+                    for translator in live)):
+            time.sleep(0.1)
+
+        report(generator, broker, translators, time.time() - start)
+    finally:
+        stop_translators(broker, translators, threads, 15)
+        log_server.shutdown()
+        shutil.rmtree(logdir)
+
+
+if __name__ == '__main__':
+    main()
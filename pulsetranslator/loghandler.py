@@ -3,141 +3,475 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import calendar
+import collections
+import fnmatch
 import json
+import os
+import threading
 import time
 
-import requests
-
-from mozillapulse.publishers import NormalizedBuildPublisher
-
+from messageencoder import EncodedMessage, encode, routing_key
+from pendingstore import PendingStore
+from priorities import LatencyStats, PriorityClasses
+from probeschedule import ProbeSchedule
+from readiness import StableSizeReadiness, UrlInfo
+from sinks import AMQPSink, BackgroundSink
+from tracing import Tracer
 from translatorexceptions import LogTimeoutError
-from translatorqueues import publish_message
 
 DEBUG = False
 
 
 class LogHandler(object):
 
-    def __init__(self, error_logger, publisher_cfg):
+    def __init__(self, error_logger, publisher_cfg, readiness=None,
+                 sinks=None, publisher_class=None, timeout=600,
+                 retry_interval=15, stopping=None, overflow_path=None,
+                 pending_memory=1000, spill_path=None, probe_threads=4,
+                 priorities=None, tracer=None, probe_schedule=None,
+                 dedup=None, probe_timeout=(5, 15)):
         self.error_logger = error_logger
         self.publisher_cfg = publisher_cfg
+        self.readiness = readiness or StableSizeReadiness()
+        # seconds after insertion_time to give up on a log, and between
+        # probes of its url
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        # seconds to connect for, and to wait for the response of, a probe
+        self.probe_timeout = probe_timeout
+
+        # Once set, messages still waiting for their log are parked
+        # instead, to be saved by save_pending().
+        self.stopping = stopping or threading.Event()
+        self.parked = []
+        self.tracer = tracer or Tracer()
+        # when to first probe for the log of a message
+        self.probe_schedule = probe_schedule or ProbeSchedule(
+            quantile=None, retry_interval=retry_interval)
+        # A PublishDedup if other instances publish the same messages.
+        self.dedup = dedup
+
+        # Messages waiting for their log are probed by a pool of threads,
+        # so the consumer never waits for log uploads. Probes, and so
+        # publishing, are shared out between priority classes by weight.
+        self.priorities = priorities or PriorityClasses()
+        self.latencies = collections.defaultdict(LatencyStats)
+        self.condition = threading.Condition()
+        self.pending = PendingStore(pending_memory, spill_path,
+                                    weight=self.priorities.weight,
+                                    keys=self.record_keys)
+        self.probing = 0
+        # prober thread name -> (the record it is probing, since when)
+        self.in_flight = {}
+        # names of the prober threads whose message was dropped meanwhile
+        self.dropping = set()
+        # Started with the first message, so that one-shot runs which only
+        # display translations do without them.
+        self.probe_threads = probe_threads
+        self.probers = []
+        if len(self.pending):
+            self.start_probers()
+
+        # The normalized exchange is published to inline; additional sinks
+        # each get their own buffer and thread.
+        self.sinks = [AMQPSink(self.error_logger, self.publisher_cfg,
+                               publisher_class=publisher_class,
+                               overflow_path=overflow_path,
+                               confirm=self.confirmed,
+                               priorities=self.priorities)]
+        for sink in sinks or []:
+            background = BackgroundSink(sink, self.error_logger)
+            background.start()
+            self.sinks.append(background)
+
+    def start_probers(self):
+        with self.condition:
+            if self.probers:
+                return
+            for i in range(self.probe_threads):
+                prober = threading.Thread(target=self.probe_pending,
+                                          name='LogProber-%d' % i)
+                prober.daemon = True
+                prober.start()
+                self.probers.append(prober)
+
+    def publish(self, message):
+        for sink in self.sinks:
+            sink.publish(message)
+
+    def confirmed(self, message):
+        """Called once the exchange accepted a message."""
+        self.tracer.finish(message.trace)
+        if self.dedup:
+            self.dedup.published(message)
+
+    @property
+    def outbox(self):
+        return self.sinks[0].outbox
+
+    def flush_sinks(self, timeout):
+        """Give secondary sinks up to ``timeout`` seconds to write what
+        they buffered and return the number of messages left unwritten.
+        """
+        deadline = time.time() + timeout
+        return sum(sink.flush(max(0, deadline - time.time()))
+                   for sink in self.sinks[1:])
+
+    @property
+    def waiting(self):
+        """Number of messages waiting for or being probed for their log."""
+        with self.condition:
+            return len(self.pending) + self.probing
+
+    def wait_pending(self, timeout=None):
+        """Wait until no message is waiting for its log, for up to
+        ``timeout`` seconds, and return the number still waiting.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while len(self.pending) + self.probing:
+                if deadline is not None and time.time() >= deadline:
+                    break
+                self.condition.wait(1)
+            return len(self.pending) + self.probing
+
+    def close(self, timeout):
+        """Stop the prober threads, which requires ``stopping`` to be set,
+        and give the publish outbox and secondary sinks up to ``timeout``
+        seconds; return the number of messages left unpublished.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            self.condition.notify_all()
+        for prober in self.probers:
+            prober.join(max(0, deadline - time.time()))
+        unpublished = len(self.outbox.drain(max(0, deadline - time.time())))
+        if self.outbox.is_alive():
+            self.outbox.join(max(0, deadline - time.time()))
+        if self.dedup:
+            self.dedup.close(max(0, deadline - time.time()))
+        return unpublished + self.flush_sinks(max(0, deadline - time.time()))
+
+    def save_pending(self, path, timeout=0):
+        """Write parked messages, and those the publish outbox could not
+        deliver within ``timeout`` seconds, to ``path`` and return their
+        number.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            # Let probes in progress finish, so that their messages are
+            # either published or back in the pending store.
+            while self.probing and time.time() < deadline:
+                self.condition.wait(0.05)
+            self.parked.extend({'data': record['data'],
+                                'trace': record.get('trace')}
+                               for record in self.pending.drain())
+            # Idle probers wait without a timeout; let them see stopping.
+            self.condition.notify_all()
+        for prober in self.probers:
+            prober.join(max(0, deadline - time.time()))
+        self.parked.extend(self.outbox.drain(max(0, deadline - time.time())))
+        if self.dedup:
+            # The claims on parked messages lapse, so other instances
+            # publish them meanwhile.
+            self.dedup.close(max(0, deadline - time.time()))
+        if not self.parked:
+            return 0
+        dirname = os.path.dirname(path)
+        if dirname and not os.access(dirname, os.F_OK):
+            os.makedirs(dirname)
+        with open(path, 'w') as f:
+            json.dump(self.parked, f)
+        return len(self.parked)
+
+    def load_pending(self, path):
+        """Resume the messages saved by ``save_pending``."""
+        if not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            pending = json.load(f)
+        os.remove(path)
+
+        for record in pending:
+            if 'routing_key' in record:
+                self.publish(EncodedMessage(record['routing_key'],
+                                            record['data'],
+                                            json.dumps(record['data']),
+                                            record.get('trace')))
+            else:
+                self.handle_message(record['data'],
+                                    trace=record.get('trace'))
+        return len(pending)
 
     def get_url_info(self, url):
-        """Return a (code, content_length) tuple from making an
-           HTTP HEAD request for the given url.
+        """Return a ``UrlInfo`` from making an HTTP HEAD request for the
+           given url, following redirects. A log host which does not
+           answer in time is treated like a log which is not there yet.
 
         """
+        import requests
+
         try:
-            resp = requests.get(url)
+            resp = requests.head(url, allow_redirects=True,
+                                 timeout=self.probe_timeout)
             resp.raise_for_status()
 
-            # In case of a redirect make another head request for the new location.
-            if resp.status_code == 301:
-                resp = requests.head(resp.headers['location'])
-                resp.raise_for_status()
+            return UrlInfo(resp.status_code,
+                           resp.headers.get('Content-length'),
+                           resp.headers.get('ETag'),
+                           resp.headers.get('Last-Modified'),
+                           resp.headers.get('Date'))
 
-            return (resp.status_code, resp.headers.get('Content-length'))
+        except requests.exceptions.Timeout as e:
+            self.error_logger.warning('HEAD request for %s timed out: %s',
+                                      url, e)
+            return UrlInfo(-1, None, None, None, None)
 
         except (requests.exceptions.RequestException, IOError) as e:
-            self.error_logger.error('HEAD request for {} failed with "{}".'.format(url, e))
-            return (-1, -1)
+            self.error_logger.error('HEAD request for %s failed with "%s".',
+                                    url, e)
+            return UrlInfo(-1, None, None, None, None)
 
         except Exception:
             self.error_logger.exception('Unknown failure.')
-            return (-1, -1)
+            return UrlInfo(-1, None, None, None, None)
+
+    def probe_pending(self):
+        """Prober thread: probe the logs of messages as they fall due."""
+        while True:
+            with self.condition:
+                while True:
+                    if self.stopping.is_set():
+                        return
+                    now = time.time()
+                    record = self.pending.pop(now)
+                    if record is not None:
+                        self.in_flight[threading.current_thread().name] = (
+                            record, now)
+                        break
+                    # Wake up at least every second to notice stopping
+                    # while messages wait; when idle, new messages and
+                    # close() notify.
+                    due = self.pending.next_due()
+                    if due is None:
+                        self.condition.wait()
+                    else:
+                        self.condition.wait(max(0.01, min(due - now, 1)))
+                self.probing += 1
+
+            done = True
+            dropped = False
+            try:
+                record['probes'] = record.get('probes', 0) + 1
+                done = self.process_message(record['data'],
+                                            record['payload'],
+                                            record['since'], record['class'],
+                                            record.get('trace'),
+                                            record['probes'])
+            finally:
+                name = threading.current_thread().name
+                with self.condition:
+                    self.probing -= 1
+                    del self.in_flight[name]
+                    if name in self.dropping:
+                        self.dropping.remove(name)
+                        dropped = not done
+                    if not done and not dropped:
+                        self.pending.add(record, time.time() +
+                                         self.retry_interval,
+                                         record['class'])
+                    self.condition.notify_all()
+            if dropped:
+                self.forget(record)
 
-    def process_data(self, data, publish_method):
+    def describe(self, record, due=None, now=None):
+        """Return a JSON serializable summary of a pending record."""
+        now = now or time.time()
+        data = record['data']
+        pulse_key, key = self.record_keys(record)
+        since = record.get('since', now)
+        summary = {'key': pulse_key,
+                   'routing_key': key,
+                   'logurl': data.get('logurl'),
+                   'class': record.get('class'),
+                   'probes': record.get('probes', 0),
+                   'age': round(now - since, 3),
+                   'deadline_in': round(data.get('insertion_time', since) +
+                                        self.timeout - now, 3)}
+        if due is not None:
+            summary['due_in'] = round(due - now, 3)
+        return summary
+
+    def pending_snapshot(self, limit=100):
+        """Return summaries of up to ``limit`` messages waiting for their
+        log, earliest due first.
+        """
+        with self.condition:
+            entries = self.pending.snapshot(limit)
+        now = time.time()
+        return [self.describe(record, due, now)
+                for due, lane, record in entries]
+
+    def probes_in_flight(self):
+        """Return summaries of the messages being probed."""
+        with self.condition:
+            records = self.in_flight.items()
+        now = time.time()
+        return [dict(self.describe(record, now=now), thread=name,
+                     probing_for=round(now - started, 3))
+                for name, (record, started) in sorted(records)]
+
+    def record_keys(self, record):
+        """Return the pulse and normalized routing keys of a pending
+        record, or None for either which it has not.
+        """
+        data = record['data']
+        try:
+            key = routing_key(data)
+        except Exception:
+            key = None
+        return data.get('key'), key
+
+    def pending_stats(self):
+        with self.condition:
+            return self.pending.stats()
+
+    def reprobe(self, pattern):
+        """Make the messages whose pulse or normalized routing key matches
+        the shell style ``pattern`` due now and return their number.
+        """
+        with self.condition:
+            removed = self.pending.remove(pattern)
+            now = time.time()
+            for lane, record in removed:
+                self.pending.add(record, now, lane)
+            self.condition.notify_all()
+        return len(removed)
+
+    def drop(self, pattern):
+        """Give up on the messages whose pulse or normalized routing key
+        matches the shell style ``pattern``. Return the number of waiting
+        messages dropped, and that of messages being probed, which are
+        dropped unless the probe publishes them.
+        """
+        with self.condition:
+            removed = self.pending.remove(pattern)
+            probing = 0
+            for name, (record, started) in self.in_flight.iteritems():
+                if any(fnmatch.fnmatchcase(key, pattern) for key
+                       in self.record_keys(record) if key is not None):
+                    self.dropping.add(name)
+                    probing += 1
+            self.condition.notify_all()
+        for lane, record in removed:
+            self.forget(record)
+        return len(removed), probing
+
+    def forget(self, record):
+        """Finish with a message dropped on request."""
+        self.tracer.finish(record.get('trace'), error='Dropped')
+        if record['data'].get('logurl'):
+            self.readiness.forget(str(record['data']['logurl']))
+        self.error_logger.warning('Dropped %s on request.',
+                                  record['data'].get('key'))
+
+    def process_data(self, data, publish_method, since=0):
         """
-        Publish the message when the data is ready.
+        Probe the log of a message once, and publish the message when the
+        log is ready. Return False if the log should be probed again.
 
-        ``publish_method`` The method to publish the type of message that
-            this data is for.  Usually ``publish_unittest_message`` or
-            ``publish_build_message``.
+        ``publish_method`` The method to publish the message with; it
+            returns False if it is to be called again later.
+        ``since`` When the message was queued; the timeout counts from
+            there for messages without an insertion_time.
         """
 
         if not data.get('logurl'):
             # should log this
-            return
+            return True
 
-        retrying = False
+        url = str(data['logurl'])
+        done = True
 
-        while True:
+        try:
             now = calendar.timegm(time.gmtime())
 
-            (code, content_length) = self.get_url_info(str(data['logurl']))
+            info = self.get_url_info(url)
 
             if DEBUG:
-                if retrying:
-                    print '...reprocessing logfile', code, data.get('logurl')
-                    print '...', data.get('key')
-                    print '...', now - data.get('insertion_time', 0), 'seconds since insertion_time'
-                else:
-                    print 'processing logfile', code, data.get('logurl')
-            if code == 200:
-                publish_method(data)
-                break
+                print 'processing logfile', info.code, url
+                print '...', data.get('key')
+                print '...', now - data.get('insertion_time', since), 'seconds since insertion_time'
+            if self.readiness.is_ready(url, info):
+                done = publish_method(data) is not False
+            elif now - data.get('insertion_time', since) > self.timeout:
+                raise LogTimeoutError(data.get('key', 'unknown'),
+                                      data.get('logurl'))
             else:
-                if now - data.get('insertion_time', 0) > 600:
-                    raise LogTimeoutError(data.get('key', 'unknown'),
-                                          data.get('logurl'))
-                else:
-                    retrying = True
-                    if DEBUG:
-                        print 'sleeping 15 seconds before retrying'
-                    time.sleep(15)
-
-    def publish_unittest_message(self, data):
-        # The original routing key has the format build.foo.bar.finished;
-        # we only use 'foo' in the new routing key.
-        original_key = data['key'].split('.')[1]
-        tree = data['tree']
-        pltfrm = data['platform']
-        buildtype = data['buildtype']
-        os = data['os']
-        test = data['test']
-        product = data['product'] if data['product'] else 'unknown'
-        key_parts = ['talos' if data['talos'] else 'unittest',
-                     tree,
-                     pltfrm,
-                     os,
-                     buildtype,
-                     test,
-                     product,
-                     original_key]
-
-        publish_message(NormalizedBuildPublisher, self.error_logger, data,
-                        '.'.join(key_parts), self.publisher_cfg)
-
-    def publish_build_message(self, data):
-        # The original routing key has the format build.foo.bar.finished;
-        # we only use 'foo' in the new routing key.
-        original_key = data['key'].split('.')[1]
-        tree = data['tree']
-        pltfrm = data['platform']
-        buildtype = data['buildtype']
-        key_parts = ['build', tree, pltfrm, buildtype]
-        for tag in data['tags']:
-            if tag:
-                key_parts.append(tag)
-            if tag == 'l10n':
-                key_parts.append(data['locale'])
-        key_parts.append(original_key)
-
-        publish_message(NormalizedBuildPublisher, self.error_logger, data,
-                        '.'.join(key_parts), self.publisher_cfg)
-
-    def handle_message(self, data):
+                done = False
+                if DEBUG:
+                    print 'retrying in %s seconds' % self.retry_interval
+        finally:
+            if done:
+                self.readiness.forget(url)
+        return done
+
+    def handle_message(self, data, payload=None, trace=None):
+        """Queue a message to be published once its log is ready, along
+        with its JSON payload if already encoded and its trace.
+        """
+        if not self.probers:
+            self.start_probers()
+        with self.condition:
+            if self.stopping.is_set():
+                self.parked.append({'data': data, 'trace': trace})
+                return
+            now = time.time()
+            name = self.priorities.classify(data)
+            self.pending.add({'data': data, 'payload': payload,
+                              'since': now, 'class': name, 'trace': trace},
+                             now + self.probe_schedule.first_probe(data),
+                             name)
+            self.condition.notify()
+
+    def latency_stats(self):
+        """Return publish latency statistics by priority class."""
+        with self.condition:
+            return dict((name, stats.stats())
+                        for name, stats in self.latencies.iteritems())
+
+    def process_message(self, data, payload, since, name, trace=None,
+                        probes=1):
+        """Probe for the log of a pending message and publish it if ready;
+        return False if the log should be probed again.
+        """
+        self.tracer.mark(trace, 'first_probe')
         try:
-            # publish the right kind of message based on the data.
-            # if it's not a unittest, presume it's a build.
-            if data.get("test"):
-                publish_method = self.publish_unittest_message
-            else:
-                publish_method = self.publish_build_message
-            self.process_data(data, publish_method=publish_method)
-        except Exception:
+            def publish_method(data):
+                self.tracer.mark(trace, 'log_ready')
+                message = encode(data, payload, trace)
+                if self.dedup:
+                    claimed = self.dedup.claim(message)
+                    if claimed is None:
+                        # Another instance is publishing it; take over if
+                        # its claim lapses.
+                        return False
+                    if not claimed:
+                        self.tracer.finish(trace, deduplicated=True)
+                        return
+                self.probe_schedule.observe(data, time.time() - since,
+                                            probes)
+                self.publish(message)
+                with self.condition:
+                    self.latencies[name].add(time.time() - since)
+
+            return self.process_data(data, publish_method=publish_method,
+                                     since=since)
+        except Exception as e:
+            self.tracer.finish(trace, error=e.__class__.__name__)
             obj_to_log = data
             if (data.get('payload') and data['payload'].get('build') and
                 data['payload']['build'].get('properties')):
                 obj_to_log = data['payload']['build']['properties']
-            self.error_logger.exception(json.dumps(obj_to_log, indent=2))
+            self.error_logger.exception(obj_to_log)
+            return True
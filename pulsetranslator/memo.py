@@ -0,0 +1,110 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import collections
+import sys
+import threading
+
+
+class BoundedMemo(object):
+    """Least recently used cache of at most ``maxsize`` results, which
+    counts its hits and misses.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        """Return the cached result for ``key``, calling ``compute()`` to
+        produce it on a miss.
+        """
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries[key] = value
+                return value
+
+        value = compute()
+
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries),
+                    'maxsize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': (round(float(self.hits) / lookups, 4)
+                                 if lookups else None)}
+
+
+class InternTable(object):
+    """Canonical instances of repeated values, so that equal values held
+    by many messages share one object.
+
+    At most ``maxsize`` values are kept; once full, values not seen before
+    are returned as they are. The bytes of the duplicates which were
+    replaced by a canonical instance are counted; they are freed unless
+    held elsewhere.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+        self.saved_bytes = 0
+
+    def intern(self, value):
+        """Return the canonical instance of a hashable value."""
+        if value is None:
+            return value
+        with self.lock:
+            canonical = self.values.get(value)
+            if canonical is None:
+                self.misses += 1
+                if len(self.values) < self.maxsize:
+                    self.values[value] = value
+                return value
+            self.hits += 1
+            if canonical is not value:
+                self.saved_bytes += sys.getsizeof(value)
+            return canonical
+
+    def intern_tuple(self, values):
+        """Return the canonical tuple of a sequence of values."""
+        return self.intern(tuple(self.intern(value) for value in values))
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.values),
+                    'maxsize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'saved_bytes': self.saved_bytes,
+                    'hit_rate': (round(float(self.hits) / lookups, 4)
+                                 if lookups else None)}
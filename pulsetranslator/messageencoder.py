@@ -0,0 +1,90 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Routing keys and JSON payloads of normalized messages.
+
+A normalized message is encoded once, into an ``EncodedMessage`` holding
+its routing key and JSON payload, and that encoding is reused by every
+sink and every publish retry. The translations of one pulse message, such
+as the locales of a repack, share most of their fields; those are encoded
+once for all of them.
+"""
+
+import collections
+import json
+
+EncodedMessage = collections.namedtuple(
+    'EncodedMessage', ['routing_key', 'data', 'payload', 'trace'])
+# The trace of a message, see tracing.py, is optional.
+EncodedMessage.__new__.__defaults__ = (None,)
+
+# Fields making up the routing keys of unittest messages, between the
+# 'unittest' or 'talos' prefix and the product.
+UNITTEST_KEY_FIELDS = ('tree', 'platform', 'os', 'buildtype', 'test')
+
+
+def unittest_routing_key(data):
+    # The original routing key has the format build.foo.bar.finished;
+    # we only use 'foo' in the new routing key.
+    key_parts = ['talos' if data['talos'] else 'unittest']
+    key_parts.extend(data[field] for field in UNITTEST_KEY_FIELDS)
+    key_parts.append(data['product'] if data['product'] else 'unknown')
+    key_parts.append(data['key'].split('.')[1])
+    return '.'.join(key_parts)
+
+
+def build_routing_key(data):
+    # The original routing key has the format build.foo.bar.finished;
+    # we only use 'foo' in the new routing key.
+    key_parts = ['build', data['tree'], data['platform'], data['buildtype']]
+    for tag in data['tags']:
+        if tag:
+            key_parts.append(tag)
+        if tag == 'l10n':
+            key_parts.append(data['locale'])
+    key_parts.append(data['key'].split('.')[1])
+    return '.'.join(key_parts)
+
+
+def routing_key(data):
+    # if it's not a unittest, presume it's a build.
+    if data.get('test'):
+        return unittest_routing_key(data)
+    return build_routing_key(data)
+
+
+def encode_payloads(datas):
+    """Return the JSON payloads of a list of messages.
+
+    Fields holding the same object in every message, as the shallow copies
+    made for each locale of a repack do, are encoded only once.
+    """
+    if len(datas) < 2:
+        return [json.dumps(data) for data in datas]
+
+    first, others = datas[0], datas[1:]
+    shared = dict((key, value) for key, value in first.iteritems()
+                  if all(key in data and data[key] is value
+                         for data in others))
+    if not shared:
+        return [json.dumps(data) for data in datas]
+
+    # '{"a": 1, "b": 2}' and '{"c": 3}' make '{"a": 1, "b": 2, "c": 3}'.
+    prefix = json.dumps(shared)[:-1]
+    payloads = []
+    for data in datas:
+        rest = dict((key, value) for key, value in data.iteritems()
+                    if key not in shared)
+        payloads.append(prefix + (', ' + json.dumps(rest)[1:] if rest
+                                  else '}'))
+    return payloads
+
+
+def encode(data, payload=None, trace=None):
+    """Return the ``EncodedMessage`` of a message, given its payload if
+    already encoded.
+    """
+    if payload is None:
+        payload = json.dumps(data)
+    return EncodedMessage(routing_key(data), data, payload, trace)
@@ -4,6 +4,7 @@
 
 import re
 
+from memo import BoundedMemo
 
 buildtypes = [ 'opt', 'debug', 'pgo' ]
 
@@ -17,17 +18,18 @@ def guess_platform(builder):
             if os in builder:
                 return os
 
+os_patterns = [
+    (re.compile(r'OS\s*X\s*10.5', re.I), 'leopard'),
+    (re.compile(r'OS\s*X\s*10.6', re.I), 'snowleopard'),
+    (re.compile(r'OS\s*X\s*10.7', re.I), 'lion'),
+    (re.compile(r'OS\s*X\s*10.8', re.I), 'mountainlion'),
+    (re.compile(r'WINNT\s*5.2', re.I), 'xp'),
+]
+
 def convert_os(data):
-    if re.search(r'OS\s*X\s*10.5', data['buildername'], re.I):
-        return 'leopard'
-    if re.search(r'OS\s*X\s*10.6', data['buildername'], re.I):
-        return 'snowleopard'
-    if re.search(r'OS\s*X\s*10.7', data['buildername'], re.I):
-        return 'lion'
-    if re.search(r'OS\s*X\s*10.8', data['buildername'], re.I):
-        return 'mountainlion'
-    if re.search(r'WINNT\s*5.2', data['buildername'], re.I):
-        return 'xp'
+    for pattern, os in os_patterns:
+        if pattern.search(data['buildername']):
+            return os
     return 'unknown'
 
 os_conversions = {
@@ -39,6 +41,16 @@ os_conversions = {
     'win32': convert_os,
 }
 
+# Buildernames come from a small set, so conversions are memoized on
+# (os token, buildername).
+os_memo = BoundedMemo(4096)
+
+def normalize_os(os, data):
+    if os not in os_conversions:
+        return os
+    return os_memo.get((os, data['buildername']),
+                       lambda: os_conversions[os](data))
+
 platforms = {
     'emulator': ['emulator', 'ubuntu64_vm-b2g-emulator'],
     'emulator-kk': ['emulator-kk'],
@@ -69,6 +81,40 @@ platforms = {
     'ics_armv7a_gecko': ['ubuntu64-b2g'],
 }
 
+def os_platform(os):
+    """Return the platform of an OS named in a builder, or None if it is
+    unknown or runs more than one platform.
+    """
+    if os in platforms:
+        return os
+    candidates = [platform for platform, names in platforms.iteritems()
+                  if os in names]
+    if len(candidates) == 1:
+        return candidates[0]
+
+# Trees known up front; more are learned from the 'branch' property of
+# incoming messages.
+trees = [
+    'b2g-inbound',
+    'comm-aurora',
+    'comm-beta',
+    'comm-central',
+    'fx-team',
+    'mozilla-aurora',
+    'mozilla-b2g44_v2_5',
+    'mozilla-beta',
+    'mozilla-central',
+    'mozilla-esr38',
+    'mozilla-inbound',
+    'mozilla-release',
+    'release-comm-beta',
+    'release-mozilla-beta',
+    'release-mozilla-esr38',
+    'release-mozilla-release',
+    'try',
+    'try-comm-central',
+]
+
 ignored_platforms = [
     'dolphin',
     'dolphin_eng',
@@ -103,6 +149,7 @@ tags = [
         'xulrunner',
         'arm',
         'compacting',
+        'jetpack',
         'plain',
         'plaindebug',
         'rootanalysis',
@@ -0,0 +1,565 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Translation of buildbot pulse messages into normalized messages.
+
+``MessageParser`` does no I/O: it neither acknowledges, publishes nor logs,
+so the live consumer and offline backfills share it. Tree and platform
+indexes, buildid dates and compiled classification regexes are kept
+between messages, and ``parse_batch`` translates a list of messages in one
+call, returning normalized messages and classified errors. The
+module-level ``parse_batch`` keeps one parser per process and can be handed
+to ``multiprocessing.Pool.map`` over chunks of messages.
+"""
+
+import collections
+import json
+import os
+import re
+import time
+import urllib
+
+import messageparams
+
+from memo import BoundedMemo, InternTable
+from profiler import Profiler
+from translatorexceptions import (BadLocalesError, BadOSError,
+                                  BadPlatformError, BadPulseMessageError,
+                                  BadTagError, NoBuildUrlError, NoLogUrlError)
+from treeindex import TreeIndex
+
+# kind is 'unittest' or 'build'.
+Translation = collections.namedtuple('Translation', ['kind', 'data'])
+
+# category is None, 'bad_message' for messages which cannot be translated,
+# or 'failure' for unexpected errors; error and detail are the class name
+# and text of the exception.
+ParseResult = collections.namedtuple('ParseResult', ['key', 'translations',
+                                                     'category', 'error',
+                                                     'detail', 'warnings'])
+
+# Fields whose values repeat across messages, and are shared between them
+# by interning; 'tags' become shared tuples. Revisions, new with every
+# push, and test names, new with every suite and chunk, are left out: the
+# intern table never evicts, so they would fill it for good.
+INTERNED_FIELDS = ('tree', 'platform', 'os', 'buildername', 'slave',
+                   'product', 'buildtype', 'locale')
+
+
+def quote_url(url):
+    # Bug 1229761: URLs in build messages are not quoted and will cause bustage in mozharness
+    return urllib.quote(url, safe='%/:=&?~#+!$,;\'@()*[]|') if url is not None else url
+
+
+def buildid2date(string):
+    """Takes a buildid string and returns seconds since epoch.
+    """
+
+    from dateutil.parser import parse
+
+    try:
+        date = parse(string)
+        return int(time.mktime(date.timetuple()))
+    except ValueError:
+        return int(string)
+
+
+def routing_key(data):
+    try:
+        return data['_meta']['routing_key']
+    except (KeyError, TypeError):
+        return 'unknown'
+
+
+class MessageParser(object):
+
+    def __init__(self, known_trees=None, profiler=None):
+        self.trees = TreeIndex(
+            messageparams.trees + list(known_trees or []),
+            platforms=list(messageparams.platforms) +
+            [name for names in messageparams.platforms.values()
+             for name in names])
+        self.profiler = profiler or Profiler(None, None)
+        self.builddates = BoundedMemo(4096)
+        self.regexes = BoundedMemo(1024)
+        self.strings = InternTable()
+
+    def buildid2date(self, string):
+        return self.builddates.get(string, lambda: buildid2date(string))
+
+    def unittest_regex(self, tree):
+        return self.regexes.get(('unittest', tree), lambda: re.compile(
+            r'build\.((%s)[-|_](.*?)(-debug|-o-debug|-pgo|_pgo|_test)?[-|_](test|unittest|pgo)-(.*?))\.(\d+)\.(log_uploaded|finished)' %
+            tree))
+
+    def build_regex(self, tree, platform):
+        return self.regexes.get(('build', tree, platform), lambda: re.compile(
+            r'build\.((release-|jetpack-|b2g_)?(%s)[-|_](xulrunner[-|_])?(%s)([-|_]?)(.*?))\.(\d+)\.(log_uploaded|finished)' %
+            (tree, platform)))
+
+    def stats(self):
+        return {'builddates': self.builddates.stats(),
+                'regexes': self.regexes.stats(),
+                'strings': self.strings.stats()}
+
+    def intern_fields(self, data):
+        """Replace the repetitive fields of a translation by their
+        canonical instances, and return it.
+        """
+        with self.profiler.stage('intern'):
+            for field in INTERNED_FIELDS:
+                value = data.get(field)
+                if isinstance(value, basestring):
+                    data[field] = self.strings.intern(value)
+            if data.get('tags') is not None:
+                data['tags'] = self.strings.intern_tuple(data['tags'])
+        return data
+
+    def parse_batch(self, messages):
+        """Translate a list of raw pulse messages into a list of
+        ``ParseResult``, one per message and in the same order.
+        """
+        now = time.time()
+        results = []
+        for data in messages:
+            warnings = []
+            try:
+                translations = self.parse(data, now=now, warnings=warnings)
+            except BadPulseMessageError as inst:
+                results.append(ParseResult(routing_key(data), [],
+                                           'bad_message',
+                                           inst.__class__.__name__,
+                                           str(inst), warnings))
+            except Exception as inst:
+                results.append(ParseResult(routing_key(data), [], 'failure',
+                                           inst.__class__.__name__,
+                                           str(inst), warnings))
+            else:
+                results.append(ParseResult(routing_key(data), translations,
+                                           None, None, None, warnings))
+        return results
+
+    def check_unittest(self, data):
+        """Validate a unittest translation; return False if it is for an
+        ignored platform.
+        """
+        if data['platform'] in messageparams.ignored_platforms:
+            return False
+        if not data.get('logurl'):
+            raise NoLogUrlError(data['key'])
+        if data['platform'] not in messageparams.platforms:
+            raise BadPlatformError(data['key'], data['platform'])
+        elif data['os'] not in messageparams.platforms[data['platform']]:
+            raise BadOSError(data['key'], data['platform'], data['os'],
+                             data['buildername'])
+        return True
+
+    def check_build(self, data):
+        """Validate a build translation; return False if it is for an
+        ignored platform.
+        """
+        if data['platform'] in messageparams.ignored_platforms:
+            return False
+        if data['platform'] not in messageparams.platforms:
+            raise BadPlatformError(data['key'], data['platform'])
+        for tag in data['tags']:
+            if tag not in messageparams.tags:
+                raise BadTagError(data['key'], tag, data['platform'],
+                                  data['product'])
+        # Repacks do not have a buildurl included. We can remove this
+        # workaround once bug 857971 has been fixed
+        if not data['buildurl'] and not data['repack']:
+            raise NoBuildUrlError(data['key'])
+        return True
+
+    def scan_properties(self, properties, builddata, warnings):
+        """Fill ``builddata`` from the buildbot properties of a message
+        and return the stage_platform, if any.
+        """
+        stage_platform = None
+
+        # scan the payload for properties applicable to both tests and
+        # builds
+        for prop in properties:
+
+            # look for the job number
+            if prop[0] == 'buildnumber':
+                builddata['job_number'] = prop[1]
+
+            # look for revision
+            if prop[0] == 'revision':
+                builddata['revision'] = prop[1]
+
+            # look for product
+            elif prop[0] == 'product':
+                # Bug 1010120:
+                # Ensure to lowercase to prevent issues with capitalization
+                builddata['product'] = prop[1].lower()
+
+            # look for version
+            elif prop[0] == 'version':
+                builddata['version'] = prop[1]
+
+            # look for tree
+            elif prop[0] == 'branch':
+                builddata['tree'] = prop[1]
+                # For builds, this property is sometimes a relative path,
+                # ('releases/mozilla-beta') and not just a name.  For
+                # consistency, we'll strip the path components.
+                if isinstance(builddata['tree'], basestring):
+                    builddata['tree'] = os.path.basename(builddata['tree'])
+
+            # look for buildid
+            elif prop[0] == 'buildid':
+                builddata['buildid'] = prop[1]
+                with self.profiler.stage('buildid2date'):
+                    builddata['builddate'] = self.buildid2date(prop[1])
+
+            # look for the build number which comes with candidate builds
+            elif prop[0] == 'build_number':
+                builddata['build_number'] = prop[1]
+
+            # look for the previous buildid
+            elif prop[0] == 'previous_buildid':
+                builddata['previous_buildid'] = prop[1]
+
+            # look for platform
+            elif prop[0] == 'platform':
+                builddata['platform'] = prop[1]
+                if (builddata['platform'] and
+                    '-debug' in builddata['platform']):
+                    # strip '-debug' from the platform string if it's
+                    # present
+                    builddata['platform'] = builddata['platform'][
+                        0:builddata['platform'].find('-debug')]
+
+            # look for the locale
+            elif prop[0] == 'locale':
+                builddata['locale'] = prop[1]
+
+            # look for the locale
+            elif prop[0] == 'locales':
+                builddata['locales'] = prop[1]
+
+            # look for build url
+            elif prop[0] in ['packageUrl', 'build_url', 'fileURL']:
+                builddata['buildurl'] = quote_url(prop[1])
+
+            # look for log url
+            elif prop[0] == 'log_url':
+                builddata['logurl'] = quote_url(prop[1])
+
+            # look for release name
+            elif prop[0] in ['en_revision', 'script_repo_revision']:
+                builddata['release'] = prop[1]
+
+            # look for tests url
+            elif prop[0] == 'symbolsUrl':
+                builddata['symbols_url'] = quote_url(prop[1])
+
+            # look for tests url
+            elif prop[0] == 'testsUrl':
+                builddata['testsurl'] = quote_url(prop[1])
+
+            # look for url to json manifest of test packages
+            elif prop[0] == 'testPackagesUrl':
+                builddata['test_packages_url'] = quote_url(prop[1])
+
+            # look for buildername
+            elif prop[0] == 'buildername':
+                builddata['buildername'] = prop[1]
+
+            # look for slave builder
+            elif prop[0] == 'slavename':
+                builddata['slave'] = prop[1]
+
+            # look for blobber files
+            elif prop[0] == 'blobber_files':
+                try:
+                    builddata['blobber_files'] = json.loads(prop[1])
+                except ValueError:
+                    warnings.append(
+                        "Malformed `blobber_files` buildbot property: %s" %
+                        prop[1])
+
+            # look for stage_platform
+            elif prop[0] == 'stage_platform':
+                # For some messages, the platform we really care about
+                # is in the 'stage_platform' property, not the 'platform'
+                # property.
+                stage_platform = prop[1]
+                for buildtype in messageparams.buildtypes:
+                    if buildtype in stage_platform:
+                        stage_platform = stage_platform[0:stage_platform.find(buildtype) - 1]
+
+            elif prop[0] == 'completeMarUrl':
+                builddata['completemarurl'] = prop[1]
+
+            elif prop[0] == 'completeMarHash':
+                builddata['completemarhash'] = prop[1]
+
+        return stage_platform
+
+    def parse(self, data, now=None, warnings=None):
+        """Translate a raw pulse message into a list of ``Translation``.
+
+        Messages which are not published translate into an empty list;
+        messages which cannot be translated raise a BadPulseMessageError.
+        Non-fatal problems are appended to ``warnings``.
+        """
+        if now is None:
+            now = time.time()
+        if warnings is None:
+            warnings = []
+
+        key = data['_meta']['routing_key']
+
+        if key.endswith('.finished'):
+            # We only care about 'log_uploaded' messages, for both builds
+            # and unittests; the 'finished' message of a job carries
+            # nothing they lack, so drop it without scanning properties.
+            return []
+
+        parsed = self.trees.split(key)
+
+        # Create a dict that holds build properties that apply to both
+        # unittests and builds.
+        builddata = { 'key': key,
+                      'job_number': None,
+                      'buildid': None,
+                      'build_number': None,
+                      'previous_buildid': None,
+                      'status': None,
+                      'platform': None,
+                      'builddate': None,
+                      'buildurl': None,
+                      'locale': None,
+                      'locales': None,
+                      'logurl': None,
+                      'testsurl': None,
+                      'test_packages_url': None,
+                      'release': None,
+                      'buildername': None,
+                      'slave': None,
+                      'repack': None,
+                      'revision': None,
+                      'symbols_url': None,
+                      'product': None,
+                      'version': None,
+                      'tree': None,
+                      'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                 time.gmtime(now)),
+                    }
+
+        with self.profiler.stage('scan_properties'):
+            stage_platform = self.scan_properties(
+                data['payload']['build']['properties'], builddata, warnings)
+
+        if parsed and parsed.prefix == 'jetpack-':
+            # For jetpack messages the tree appears nowhere except in
+            # the routing key.
+            builddata['tree'] = parsed.tree
+        elif builddata['tree']:
+            self.trees.learn(builddata['tree'])
+        elif parsed:
+            builddata['tree'] = parsed.tree
+
+        if not builddata['tree']:
+            raise BadPulseMessageError(key, "no 'branch' property")
+
+        # If no locale is given fallback to en-US
+        if not builddata['locale']:
+            builddata['locale'] = 'en-US'
+
+        # status of the build or test notification
+        # see http://hg.mozilla.org/build/buildbot/file/08b7c51d2962/master/buildbot/status/builder.py#l25
+        builddata['status'] = data['payload']['build']['results']
+
+        if 'debug' in key:
+            builddata['buildtype'] = 'debug'
+        elif 'pgo' in key:
+            builddata['buildtype'] = 'pgo'
+        else:
+            builddata['buildtype'] = 'opt'
+
+        # see if this message is for a unittest
+        with self.profiler.stage('classify'):
+            match = self.unittest_regex(builddata['tree']).match(key)
+        if match:
+            # for unittests, generate some metadata by parsing the key
+
+            # The 'short_builder' string is quite arbitrary, and so this
+            # code is expected to be fragile, and will likely need
+            # frequent maintenance to deal with future changes to this
+            # string.  Unfortunately, these items are not available
+            # in a more straightforward fashion at present.
+            short_builder = match.groups()[0]
+
+            builddata['os'] = messageparams.normalize_os(
+                match.groups()[2], builddata)
+
+            builddata['test'] = match.groups()[5]
+
+            # yuck!!
+            if builddata['test'].endswith('_2'):
+                short_builder = "%s.2" % short_builder[0:-2]
+            elif builddata['test'].endswith('_2-pgo'):
+                short_builder = "%s.2-pgo" % short_builder[0:-6]
+
+            builddata['talos'] = 'talos' in builddata['buildername']
+
+            if stage_platform:
+                builddata['platform'] = stage_platform
+
+            builddata['insertion_time'] = int(now)
+            if not self.check_unittest(builddata):
+                return []
+            return [Translation('unittest', self.intern_fields(builddata))]
+
+        elif 'source' in key:
+            # what is this?
+            # ex: build.release-mozilla-esr10-firefox_source.0.finished
+            return []
+
+        elif [x for x in ['schedulers', 'tag', 'submitter',
+                          'final_verification', 'fuzzer'] if x in key]:
+            # internal buildbot stuff we don't care about
+            # ex: build.release-mozilla-beta-firefox_reset_schedulers.12.finished
+            # ex: build.release-mozilla-beta-fennec_tag.40.finished
+            # ex: build.release-mozilla-beta-bouncer_submitter.46.finished
+            return []
+
+        elif 'jetpack' in key and not (parsed and
+                                       parsed.prefix == 'jetpack-'):
+            # These are very awkwardly formed; i.e.
+            # build.jetpack-mozilla-central-win7-debug.18.finished,
+            # and the tree appears nowhere except this string.  Only
+            # those whose tree is in the tree index can be supported.
+            return []
+
+        # Jetpack builders are named after the OS they run on, like win7,
+        # which their platform property does not match.
+        key_platform = None
+        if parsed and parsed.prefix == 'jetpack-':
+            platform = messageparams.os_platform(parsed.platform)
+            if platform:
+                key_platform = parsed.platform
+                builddata['platform'] = platform
+
+        if not builddata['platform']:
+            if stage_platform:
+                builddata['platform'] = stage_platform
+            else:
+                # Some messages don't contain the platform
+                # in any place other than the routing key, so we'll
+                # have to take it from there, or guess it.
+                if parsed and parsed.platform in messageparams.platforms:
+                    builddata['platform'] = parsed.platform
+                else:
+                    builddata['platform'] = messageparams.guess_platform(key)
+                if not builddata['platform']:
+                    raise BadPulseMessageError(key, 'no "platform" property')
+
+        with self.profiler.stage('classify'):
+            match = self.build_regex(
+                builddata['tree'],
+                key_platform or builddata['platform']).match(key)
+        if not match:
+            raise BadPulseMessageError(key, "unknown message type, platform: %s" % builddata.get('platform', 'unknown'))
+
+        builddata['tags'] = match.group(7).replace('_', '-').split('-')
+
+        # There are some tags we don't care about as tags,
+        # usually because they are redundant with other properties,
+        # so remove them.
+        notags = ['debug', 'pgo', 'opt', 'repack']
+        builddata['tags'] = [x for x in builddata['tags'] if x not in notags]
+
+        # Sometimes a tag will just be a digit, i.e.,
+        # build.mozilla-central-android-l10n_5.12.finished;
+        # strip these.
+        builddata['tags'] = [x for x in builddata['tags'] if not x.isdigit()]
+
+        if isinstance(match.group(2), basestring):
+            if 'release' in match.group(2):
+                builddata['tags'].append('release')
+            if 'jetpack' in match.group(2):
+                builddata['tags'].append('jetpack')
+
+        if match.group(4) or 'xulrunner' in builddata['tags']:
+            builddata['product'] = 'xulrunner'
+
+        # Sadly, the build url for emulator builds isn't published
+        # to the pulse stream, so we have to guess it.  See bug
+        # 1071642.
+        if ('emulator' in builddata.get('platform', '') and
+                'try' not in key and builddata.get('buildid')):
+            builddata['buildurl'] = (
+                'https://pvtbuilds.mozilla.org/pub/mozilla.org/b2g/tinderbox-builds' +
+                '/%s-%s/%s/emulator.tar.gz' %
+                (builddata['tree'], builddata['platform'],
+                 builddata['buildid']))
+
+        # In case of repack messages we have to send multiple
+        # notifications, each for every locale included.
+
+        # Current release-builds have a different data structure
+        # than nightly builds which are generated via mozharness.
+        # This will change once bug 1142872 is fixed and active.
+        builds = []
+        if 'repack' in key:  # release build
+            builddata['repack'] = True
+
+            if not builddata["locales"]:
+                raise BadPulseMessageError(key, 'no "locales" property')
+
+            for locale in builddata["locales"].split(','):
+                if not locale:
+                    raise BadLocalesError(key, builddata["locales"])
+
+                # Translations only differ in top level fields, so they
+                # share everything else.
+                with self.profiler.stage('copy'):
+                    data = dict(builddata)
+                data['locale'] = locale
+                builds.append(data)
+
+        elif builddata['locales']:  # nightly repack build
+            builddata['repack'] = True
+
+            locales = json.loads(builddata['locales'])
+            for locale, result in locales.iteritems():
+                # Use all properties except the locales array
+                with self.profiler.stage('copy'):
+                    data = dict(builddata)
+                del data['locales']
+
+                # Update overall status of the new message based on the locale status.
+                # Given that there are no clear result values, lets take the values
+                # from buildbot status: 0 = Success, 2 = Failed
+                status = str(result).lower() == "success" or str(result) == '0'
+                data['status'] = 0 if status else 2
+
+                # Process locale
+                data['locale'] = locale
+                builds.append(data)
+
+        else:  # single locale build
+            builds.append(builddata)
+
+        return [Translation('build', self.intern_fields(build))
+                for build in builds if self.check_build(build)]
+
+
+# Parsers of this process, by known trees; see parse_batch().
+process_parsers = {}
+
+
+def parse_batch(messages, known_trees=None):
+    """Translate ``messages`` with a parser kept for this process."""
+    known_trees = tuple(known_trees or ())
+    parser = process_parsers.get(known_trees)
+    if parser is None:
+        parser = process_parsers[known_trees] = MessageParser(known_trees)
+    return parser.parse_batch(messages)
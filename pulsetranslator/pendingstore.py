@@ -0,0 +1,266 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import fnmatch
+import heapq
+import itertools
+import json
+import os
+
+
+class Lane(object):
+    """The messages of one priority class."""
+
+    def __init__(self, weight):
+        self.weight = weight
+        # (due, sequence, data)
+        self.heap = []
+        self.on_disk = 0
+        # (id, due, data) of the earliest spilled message, once queried
+        self.disk_head = None
+        # virtual time of the next message served, see PendingStore.pop()
+        self.finish = 0.0
+
+
+class PendingStore(object):
+    """Messages waiting for the next probe of their log, by due time.
+
+    Messages are kept in lanes, one per priority class. When messages of
+    several lanes are due, lanes are served by weighted fair queuing: each
+    gets a share of pops in proportion to its weight, and a lane which was
+    idle gets no credit for the time it was.
+
+    Up to ``maxsize`` messages are kept in memory. Beyond that they are
+    written to an SQLite database at ``spill_path`` and only read back
+    once they are the next due of their lane, so memory use stays bounded
+    however long logs take to appear. A database left behind by a previous
+    run is resumed. Callers serialize access.
+
+    ``keys`` returns the pulse and normalized routing keys of a message,
+    either of which may be None; they are kept in indexed columns of the
+    database for remove().
+    """
+
+    def __init__(self, maxsize=1000, spill_path=None, weight=None,
+                 keys=None):
+        self.maxsize = maxsize
+        self.spill_path = spill_path
+        self.weight = weight or (lambda name: 1.0)
+        self.keys = keys or (lambda data: (None, None))
+        self.lanes = {}
+        self.sequence = itertools.count()
+        self.in_memory = 0
+        self.on_disk = 0
+        self.db = None
+        # virtual time of the last message served
+        self.clock = 0.0
+
+        self.spilled = 0
+        self.loaded = 0
+
+        if spill_path and os.path.exists(spill_path):
+            self.open()
+            for name, count in self.db.execute(
+                    'SELECT lane, COUNT(*) FROM pending GROUP BY lane'):
+                self.lane(name).on_disk = count
+                self.on_disk += count
+
+    def __len__(self):
+        return self.in_memory + self.on_disk
+
+    def lane(self, name):
+        lane = self.lanes.get(name)
+        if lane is None:
+            lane = self.lanes[name] = Lane(self.weight(name))
+        return lane
+
+    def open(self):
+        import sqlite3
+
+        dirname = os.path.dirname(self.spill_path)
+        if dirname and not os.access(dirname, os.F_OK):
+            os.makedirs(dirname)
+        self.db = sqlite3.connect(self.spill_path, isolation_level=None,
+                                  check_same_thread=False)
+        # The database only relieves memory; a crash of the machine may
+        # lose it, like the messages held in memory.
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('CREATE TABLE IF NOT EXISTS pending '
+                        '(id INTEGER PRIMARY KEY, lane TEXT, due REAL, '
+                        'data TEXT, key TEXT, routing_key TEXT)')
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(pending)')]
+        if 'key' not in columns:
+            # Left behind by a version without the key columns.
+            self.db.execute('ALTER TABLE pending ADD COLUMN key TEXT')
+            self.db.execute('ALTER TABLE pending ADD COLUMN routing_key TEXT')
+            rows = self.db.execute('SELECT id, data FROM pending').fetchall()
+            for id, data in rows:
+                self.db.execute('UPDATE pending SET key = ?, routing_key = ? '
+                                'WHERE id = ?',
+                                self.keys(json.loads(data)) + (id,))
+        self.db.execute('CREATE INDEX IF NOT EXISTS pending_due '
+                        'ON pending (lane, due, id)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS pending_key '
+                        'ON pending (key)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS pending_routing_key '
+                        'ON pending (routing_key)')
+
+    def stats(self):
+        return {'in_memory': self.in_memory,
+                'on_disk': self.on_disk,
+                'spilled': self.spilled,
+                'loaded': self.loaded,
+                'lanes': dict((name, len(lane.heap) + lane.on_disk)
+                              for name, lane in self.lanes.iteritems())}
+
+    def add(self, data, due, lane='default'):
+        name, lane = lane, self.lane(lane)
+        if not self.spill_path or self.in_memory < self.maxsize:
+            heapq.heappush(lane.heap, (due, next(self.sequence), data))
+            self.in_memory += 1
+            return
+
+        if self.db is None:
+            self.open()
+        key, routing_key = self.keys(data)
+        self.db.execute('INSERT INTO pending '
+                        '(lane, due, data, key, routing_key) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (name, due, json.dumps(data), key, routing_key))
+        lane.on_disk += 1
+        self.on_disk += 1
+        self.spilled += 1
+        if lane.disk_head and due < lane.disk_head[1]:
+            lane.disk_head = None
+
+    def spilled_head(self, name, lane):
+        if not lane.on_disk:
+            return None
+        if lane.disk_head is None:
+            lane.disk_head = self.db.execute(
+                'SELECT id, due, data FROM pending WHERE lane = ? '
+                'ORDER BY due, id LIMIT 1', (name,)).fetchone()
+        return lane.disk_head
+
+    def head_due(self, name, lane):
+        dues = []
+        row = self.spilled_head(name, lane)
+        if row:
+            dues.append(row[1])
+        if lane.heap:
+            dues.append(lane.heap[0][0])
+        return min(dues) if dues else None
+
+    def next_due(self):
+        """Return the due time of the earliest message, or None."""
+        dues = [due for due in [self.head_due(name, lane) for name, lane
+                                in self.lanes.iteritems()]
+                if due is not None]
+        return min(dues) if dues else None
+
+    def pop(self, now):
+        """Remove and return the next message due by ``now``, or None."""
+        chosen = None
+        for name, lane in self.lanes.iteritems():
+            due = self.head_due(name, lane)
+            if due is None or due > now:
+                continue
+            start = max(lane.finish, self.clock)
+            if chosen is None or (start, due) < chosen[0]:
+                chosen = ((start, due), name, lane)
+        if chosen is None:
+            return None
+
+        (start, due), name, lane = chosen
+        self.clock = start
+        lane.finish = start + 1.0 / lane.weight
+
+        row = self.spilled_head(name, lane)
+        if row and (not lane.heap or row[1] < lane.heap[0][0]):
+            self.db.execute('DELETE FROM pending WHERE id = ?', (row[0],))
+            lane.on_disk -= 1
+            lane.disk_head = None
+            self.on_disk -= 1
+            self.loaded += 1
+            return json.loads(row[2])
+
+        self.in_memory -= 1
+        return heapq.heappop(lane.heap)[2]
+
+    def snapshot(self, limit=None):
+        """Return up to ``limit`` (due, lane, data) of the messages,
+        earliest due first, without removing them.
+        """
+        entries = []
+        for name, lane in self.lanes.iteritems():
+            heap = (heapq.nsmallest(limit, lane.heap) if limit
+                    else lane.heap)
+            entries.extend((due, name, data) for due, sequence, data in heap)
+        if self.db is not None and self.on_disk:
+            query = 'SELECT due, lane, data FROM pending ORDER BY due, id'
+            if limit:
+                query += ' LIMIT %d' % limit
+            entries.extend((due, name, json.loads(data)) for due, name, data
+                           in self.db.execute(query))
+        entries.sort(key=lambda entry: entry[0])
+        return entries[:limit] if limit else entries
+
+    def remove(self, pattern):
+        """Remove the messages either of whose keys matches the shell style
+        ``pattern``, and return their (lane, data).
+        """
+        def match(data):
+            return any(fnmatch.fnmatchcase(key, pattern)
+                       for key in self.keys(data) if key is not None)
+
+        removed = []
+        for name, lane in self.lanes.iteritems():
+            kept = []
+            for entry in lane.heap:
+                if match(entry[2]):
+                    removed.append((name, entry[2]))
+                else:
+                    kept.append(entry)
+            if len(kept) < len(lane.heap):
+                self.in_memory -= len(lane.heap) - len(kept)
+                heapq.heapify(kept)
+                lane.heap = kept
+        if self.db is not None and self.on_disk:
+            # Spilled messages are found by their key columns, without
+            # reading every message back; GLOB negates sets with ^.
+            glob = pattern.replace('[!', '[^')
+            rows = self.db.execute(
+                'SELECT id, lane, data FROM pending '
+                'WHERE key GLOB ? OR routing_key GLOB ?',
+                (glob, glob)).fetchall()
+            for id, name, data in rows:
+                self.db.execute('DELETE FROM pending WHERE id = ?', (id,))
+                data = json.loads(data)
+                lane = self.lane(name)
+                lane.on_disk -= 1
+                lane.disk_head = None
+                self.on_disk -= 1
+                removed.append((name, data))
+        return removed
+
+    def drain(self):
+        """Remove and return all messages, earliest due first."""
+        entries = []
+        for lane in self.lanes.itervalues():
+            entries.extend((due, data) for due, sequence, data in lane.heap)
+            lane.heap = []
+            lane.on_disk = 0
+            lane.disk_head = None
+        if self.db is not None:
+            entries.extend(
+                (due, json.loads(data)) for due, data in self.db.execute(
+                    'SELECT due, data FROM pending ORDER BY due, id'))
+            self.db.close()
+            self.db = None
+            os.remove(self.spill_path)
+        self.in_memory = 0
+        self.on_disk = 0
+        entries.sort(key=lambda entry: entry[0])
+        return [data for due, data in entries]
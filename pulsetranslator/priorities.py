@@ -0,0 +1,99 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Priority classes of messages by tree and platform.
+
+Classes are configured as a comma separated list of ``pattern: weight``
+rules, where a pattern is a shell style tree pattern optionally followed by
+``/`` and a platform pattern, e.g.
+
+    release-*: 8, mozilla-central: 4, */android*: 2, try: 1
+
+A message belongs to the class of the first matching rule, named by its
+pattern, or to the 'default' class of weight 1. Waiting messages of each
+class get a share of the log probes in proportion to its weight.
+"""
+
+import collections
+import fnmatch
+
+from memo import BoundedMemo
+
+DEFAULT_CLASS = 'default'
+
+
+def parse_priorities(spec):
+    """Return a list of (pattern, weight) rules from a configuration
+    string.
+    """
+    rules = []
+    for rule in spec.split(','):
+        if not rule.strip():
+            continue
+        pattern, sep, weight = rule.rpartition(':')
+        if not sep or not pattern.strip():
+            raise ValueError('priority rule %r is not "pattern: weight"' %
+                             rule.strip())
+        weight = float(weight)
+        if weight <= 0:
+            raise ValueError('priority weight of %r must be positive' %
+                             pattern.strip())
+        rules.append((pattern.strip(), weight))
+    return rules
+
+
+class PriorityClasses(object):
+
+    def __init__(self, rules=None):
+        self.rules = []
+        for pattern, weight in rules or []:
+            tree, sep, platform = pattern.partition('/')
+            self.rules.append((pattern, tree, platform or '*', weight))
+        self.weights = dict((rule[0], rule[3]) for rule in self.rules)
+        self.weights.setdefault(DEFAULT_CLASS, 1.0)
+        self.classes = BoundedMemo(4096)
+
+    def weight(self, name):
+        return self.weights.get(name, 1.0)
+
+    def classify(self, data):
+        """Return the class name of a normalized message."""
+        tree = data.get('tree') or ''
+        platform = data.get('platform') or ''
+        return self.classes.get((tree, platform),
+                                lambda: self.match(tree, platform))
+
+    def match(self, tree, platform):
+        for pattern, tree_pattern, platform_pattern, weight in self.rules:
+            if (fnmatch.fnmatchcase(tree, tree_pattern) and
+                    fnmatch.fnmatchcase(platform, platform_pattern)):
+                return pattern
+        return DEFAULT_CLASS
+
+
+class LatencyStats(object):
+    """Count and percentiles of the most recent ``window`` latencies."""
+
+    def __init__(self, window=1000):
+        self.count = 0
+        self.recent = collections.deque(maxlen=window)
+
+    def add(self, seconds):
+        self.count += 1
+        self.recent.append(seconds)
+
+    def stats(self):
+        values = sorted(self.recent)
+        if not values:
+            return {'count': self.count}
+
+        def percentile(pct):
+            return round(values[int(round(pct / 100.0 *
+                                          (len(values) - 1)))], 3)
+
+        return {'count': self.count,
+                'p50': percentile(50),
+                'p90': percentile(90),
+                'p99': percentile(99),
+                'max': round(values[-1], 3)}
@@ -0,0 +1,126 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""When to first probe for the log of a message.
+
+Logs of one builder take a fairly consistent time to be uploaded, so the
+time from queueing a message to its log being ready is remembered for the
+most recent messages of every builder, and of every tree and platform for
+builders seen too rarely. The first probe of a message is scheduled at a
+quantile of those times instead of right away; later probes follow every
+retry interval as before. The times are kept in a JSON file across
+restarts.
+
+A log found by the first probe may have been ready for up to a retry
+interval already, so such times are remembered that much shorter; without
+that, the schedule could only ever drift later.
+"""
+
+import collections
+import json
+import os
+import threading
+
+
+class ProbeSchedule(object):
+
+    def __init__(self, path=None, quantile=0.25, window=50, min_samples=5,
+                 maxsize=10000, retry_interval=15, max_delay=None):
+        self.path = path
+        self.quantile = quantile
+        self.window = window
+        self.min_samples = min_samples
+        self.maxsize = maxsize
+        self.retry_interval = retry_interval
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        # key -> deque of seconds to ready, least recently updated first
+        self.delays = collections.OrderedDict()
+        self.counts = dict.fromkeys(['scheduled', 'predicted', 'published',
+                                     'probes', 'wasted_probes',
+                                     'first_probe_hits', 'baseline_probes'],
+                                    0)
+        if path and os.path.exists(path):
+            self.load()
+
+    def keys(self, data):
+        keys = ['%s/%s' % (data.get('tree'), data.get('platform'))]
+        if data.get('buildername'):
+            keys.insert(0, data['buildername'])
+        return keys
+
+    def first_probe(self, data):
+        """Return the seconds to wait before the first probe of the log of
+        a message.
+        """
+        if self.quantile is None:
+            return 0
+        with self.lock:
+            self.counts['scheduled'] += 1
+            for key in self.keys(data):
+                delays = self.delays.get(key)
+                if delays is not None and len(delays) >= self.min_samples:
+                    break
+            else:
+                return 0
+            self.counts['predicted'] += 1
+            values = sorted(delays)
+        delay = values[int(self.quantile * (len(values) - 1))]
+        if self.max_delay is not None:
+            delay = min(delay, self.max_delay)
+        return delay
+
+    def observe(self, data, seconds, probes):
+        """Remember that the log of a message was ready ``seconds`` after
+        it was queued, found by the ``probes``-th probe.
+        """
+        # The log became ready since the previous probe, a retry interval
+        # earlier, or at any time before the first.
+        ready = max(0, seconds - (self.retry_interval if probes == 1
+                                  else self.retry_interval / 2.0))
+        with self.lock:
+            for key in self.keys(data):
+                delays = self.delays.pop(key, None)
+                if delays is None:
+                    delays = collections.deque(maxlen=self.window)
+                delays.append(round(ready, 3))
+                self.delays[key] = delays
+            while len(self.delays) > self.maxsize:
+                self.delays.popitem(last=False)
+
+            self.counts['published'] += 1
+            self.counts['probes'] += probes
+            self.counts['wasted_probes'] += probes - 1
+            if probes == 1:
+                self.counts['first_probe_hits'] += 1
+            # Probing right away and then every retry interval would have
+            # taken about this many probes.
+            self.counts['baseline_probes'] += (
+                int(seconds // self.retry_interval) + 1)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts, keys=len(self.delays))
+        stats['saved_probes'] = stats['baseline_probes'] - stats['probes']
+        return stats
+
+    def load(self):
+        with open(self.path) as f:
+            saved = json.load(f)
+        with self.lock:
+            for key, delays in saved:
+                self.delays[key] = collections.deque(delays,
+                                                     maxlen=self.window)
+
+    def save(self):
+        if not self.path:
+            return
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.access(dirname, os.F_OK):
+            os.makedirs(dirname)
+        with self.lock:
+            saved = [(key, list(delays))
+                     for key, delays in self.delays.iteritems()]
+        with open(self.path, 'w') as f:
+            json.dump(saved, f)
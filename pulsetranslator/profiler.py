@@ -0,0 +1,196 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Low overhead profiling of the translator.
+
+Named stages are timed deterministically, and an optional sampler thread
+periodically records the stacks of all other threads. Both are dumped as
+collapsed stacks ("a;b;c <weight>" per line) that flamegraph.pl and
+compatible tools read directly. Stage weights are self time in
+microseconds, sample weights are sample counts.
+"""
+
+import collections
+import datetime
+import os
+import sys
+import threading
+import time
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        stack = self.profiler._stack()
+        path = stack[-1][0] + ';' + self.name if stack else self.name
+        # [path, start, time spent in nested stages]
+        stack.append([path, time.time(), 0.0])
+        return self
+
+    def __exit__(self, *exc):
+        stack = self.profiler._stack()
+        path, start, children = stack.pop()
+        elapsed = time.time() - start
+        if stack:
+            stack[-1][2] += elapsed
+        self.profiler._record(self.name, path, elapsed, elapsed - children)
+        return False
+
+
+class Profiler(object):
+
+    def __init__(self, logdir, logger, sample_interval=None):
+        self.logdir = logdir
+        self.logger = logger
+        self.sample_interval = sample_interval
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.sampler = None
+        self.stop_sampling = threading.Event()
+        self.toggle_requested = threading.Event()
+        self.controller = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # name -> [calls, total seconds]
+            self.stats = collections.defaultdict(lambda: [0, 0.0])
+            self.stage_stacks = collections.defaultdict(float)
+            self.sample_stacks = collections.defaultdict(int)
+
+    def stage(self, name):
+        """Return a context manager timing the named stage."""
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def _stack(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def _record(self, name, path, elapsed, self_time):
+        with self.lock:
+            stat = self.stats[name]
+            stat[0] += 1
+            stat[1] += elapsed
+            self.stage_stacks[path] += self_time
+
+    def _sample(self):
+        own = threading.current_thread().ident
+        while not self.stop_sampling.wait(self.sample_interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append('%s:%s' % (
+                        os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                with self.lock:
+                    self.sample_stacks[';'.join(reversed(names))] += 1
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.reset()
+        self.enabled = True
+        if self.sample_interval:
+            self.stop_sampling.clear()
+            self.sampler = threading.Thread(target=self._sample,
+                                            name='ProfileSampler')
+            self.sampler.daemon = True
+            self.sampler.start()
+        self.logger.info('Profiling enabled.')
+
+    def disable(self):
+        """Stop profiling and dump what was collected."""
+        if not self.enabled:
+            return
+        self.enabled = False
+        if self.sampler:
+            self.stop_sampling.set()
+            self.sampler.join()
+            self.sampler = None
+        self.dump()
+
+    def toggle(self):
+        """Switch profiling on and off."""
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def request_toggle(self, signum=None, frame=None):
+        """Signal handler asking the control thread to toggle profiling.
+
+        The interrupted thread may hold the profiler's lock, or a logging
+        lock, so the handler itself does nothing else.
+        """
+        self.toggle_requested.set()
+
+    def _control(self):
+        while True:
+            self.toggle_requested.wait()
+            self.toggle_requested.clear()
+            try:
+                self.toggle()
+            except Exception:
+                self.logger.exception('Failure when toggling profiling')
+
+    def start_control(self):
+        """Start the thread serving ``request_toggle``."""
+        if self.controller is None:
+            self.controller = threading.Thread(target=self._control,
+                                               name='ProfileControl')
+            self.controller.daemon = True
+            self.controller.start()
+
+    def write_folded(self, filename, stacks, scale=1):
+        if not os.access(self.logdir, os.F_OK):
+            os.makedirs(self.logdir)
+        path = os.path.join(self.logdir, filename)
+        with open(path, 'w') as f:
+            for stack, weight in sorted(stacks.items()):
+                f.write('%s %d\n' % (stack, int(round(weight * scale))))
+        return path
+
+    def dump(self):
+        prefix = 'profile-%s' % datetime.datetime.utcnow().strftime(
+            '%Y%m%d-%H%M%S')
+        with self.lock:
+            stats = dict(self.stats)
+            stage_stacks = dict(self.stage_stacks)
+            sample_stacks = dict(self.sample_stacks)
+
+        files = [self.write_folded(prefix + '-stages.folded', stage_stacks,
+                                   scale=1000000)]
+        if sample_stacks:
+            files.append(self.write_folded(prefix + '-samples.folded',
+                                           sample_stacks))
+
+        summary = dict((name, {'calls': calls,
+                               'total_ms': round(total * 1000, 3),
+                               'mean_ms': round(total * 1000 / calls, 3)})
+                       for name, (calls, total) in stats.items())
+        self.logger.info({'profile': summary, 'files': files})
@@ -2,35 +2,51 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import calendar
-import copy
-import datetime
+import atexit
 import json
 import logging
-import logging.handlers
 import os
-import re
+import signal
 import socket
+import threading
 import time
-import urllib2
-
-from dateutil.parser import parse
-from mozillapulse import consumers
-import requests
 
 import messageparams
 
+from bindings import DEFAULT_TOPICS, Prefilter, TrafficReport, prefiltering
+from dedup import PublishDedup
 from loghandler import LogHandler
-from translatorexceptions import (BadLocalesError, BadOSError,
-                                  BadPlatformError, BadPulseMessageError,
-                                  BadTagError, NoBuildUrlError, NoLogUrlError)
+from memo import BoundedMemo
+from messageencoder import encode_payloads
+from messageparser import MessageParser
+from priorities import PriorityClasses
+from probeschedule import ProbeSchedule
+from profiler import Profiler
+from readiness import StableSizeReadiness
+from reconnect import Backoff, ReconnectManager, resilient
+from shadow import ShadowParser
+from sinks import FileSink, HTTPSink
+from tracing import OTLPSink, SpanFileSink, Tracer
+from translatorexceptions import BadPulseMessageError, ShutdownRequested
+from translatorlogging import (DeferredRotatingFileHandler, JSONFormatter,
+                               LogWriter, QueueHandler, RateLimitFilter)
 
 
 class PulseBuildbotTranslator(object):
 
     def __init__(self, durable=False, logdir='logs', message=None,
                  display_only=False, consumer_cfg=None, publisher_cfg=None,
-                 label=None):
+                 label=None, log_stable_interval=15, profile=False,
+                 profile_sample_interval=None, sink_files=None,
+                 sink_urls=None, log_timeout=600, log_retry_interval=15,
+                 consumer_class=None, publisher_class=None,
+                 shutdown_timeout=10, pending_file=None, known_trees=None,
+                 pending_memory=1000, log_probe_threads=4, priorities=None,
+                 shadow_engine=None, trace_files=None, trace_urls=None,
+                 topics=None, wanted=None, excluded=None,
+                 report_bindings=None, heartbeat=30, max_reconnect_delay=30,
+                 first_probe_quantile=0.25, dedup_store=None,
+                 dedup_lease=60, admin_address=None):
         self.durable = durable
         self.label = 'pulse-build-translator-%s' % (label or
                                                     socket.gethostname())
@@ -39,9 +55,22 @@ class PulseBuildbotTranslator(object):
         self.display_only = display_only
         self.consumer_cfg = consumer_cfg
         self.publisher_cfg = publisher_cfg
-
-        if not os.access(self.logdir, os.F_OK):
-            os.mkdir(self.logdir)
+        self.consumer_class = consumer_class
+        self.heartbeat = heartbeat
+        self.admin_address = admin_address
+        self.admin = None
+        self.shutdown_timeout = shutdown_timeout
+        self.pending_file = pending_file or os.path.join(self.logdir,
+                                                         'pending.json')
+
+        # Shutdown state, see request_shutdown().
+        self.stopping = threading.Event()
+        self.listener = None
+        self.in_callback = False
+
+        self.log_writer = LogWriter()
+        self.log_writer.start()
+        atexit.register(self.log_writer.stop)
 
         self.bad_pulse_msg_logger = self.get_logger('BadPulseMessage',
                                                     'bad_pulse_message.log')
@@ -53,27 +82,77 @@ class PulseBuildbotTranslator(object):
         loghandler_error_logger = self.get_logger('LogHandlerErrorLog',
                                                   'log_handler_error.log',
                                                   stderr=True)
-        self.loghandler = LogHandler(loghandler_error_logger,
-                                     self.publisher_cfg)
-
-    def _quote_url(self, url):
-        # Bug 1229761: URLs in build messages are not quoted and will cause bustage in mozharness
-        return urllib2.quote(url, safe='%/:=&?~#+!$,;\'@()*[]|') if url is not None else url
+        self.reconnects = ReconnectManager(
+            self.error_logger, Backoff(maximum=max_reconnect_delay))
+        self.profiler = Profiler(self.logdir, self.error_logger,
+                                 sample_interval=profile_sample_interval)
+        if profile:
+            self.profiler.enable()
+        self.parser = MessageParser(known_trees, profiler=self.profiler)
+        self.engine = self.parser
+        self.shadow = None
+        if shadow_engine:
+            # Only the translations of the current parser are published.
+            self.shadow = self.engine = ShadowParser(
+                self.parser, shadow_engine(known_trees=known_trees),
+                self.get_logger('ShadowDiff', 'shadow_diff.log'))
+        self.release_revisions = BoundedMemo(256)
+        self.topics = topics or DEFAULT_TOPICS
+        self.prefilter = Prefilter(self.parser.trees, wanted, excluded)
+        # Traffic by binding is counted if reported every report_bindings
+        # seconds.
+        self.traffic = None
+        if report_bindings:
+            self.traffic = TrafficReport(self.topics)
+            self.report_bindings = report_bindings
+            self.next_traffic_report = time.time() + report_bindings
+
+        sinks = ([FileSink(path) for path in sink_files or []] +
+                 [HTTPSink(url) for url in sink_urls or []])
+        self.tracer = Tracer(
+            loghandler_error_logger, service=self.label,
+            sinks=([SpanFileSink(path) for path in trace_files or []] +
+                   [OTLPSink(url, self.label) for url in trace_urls or []]))
+        self.probe_schedule = ProbeSchedule(
+            os.path.join(self.logdir, 'probe-delays.json'),
+            quantile=first_probe_quantile, retry_interval=log_retry_interval,
+            max_delay=log_timeout / 2.0)
+        # Instances sharing a dedup store publish each message once.
+        self.dedup = None
+        if dedup_store:
+            self.dedup = PublishDedup(
+                dedup_store,
+                '%s@%s:%d' % (self.label, socket.gethostname(), os.getpid()),
+                loghandler_error_logger, lease=dedup_lease)
+        self.loghandler = LogHandler(
+            loghandler_error_logger, self.publisher_cfg,
+            readiness=StableSizeReadiness(log_stable_interval),
+            sinks=sinks, publisher_class=publisher_class,
+            timeout=log_timeout, retry_interval=log_retry_interval,
+            stopping=self.stopping,
+            overflow_path=os.path.join(self.logdir, 'outbox-overflow.json'),
+            pending_memory=pending_memory,
+            spill_path=os.path.join(self.logdir, 'pending-spill.sqlite'),
+            probe_threads=log_probe_threads,
+            priorities=PriorityClasses(priorities), tracer=self.tracer,
+            probe_schedule=self.probe_schedule, dedup=self.dedup)
 
     def get_logger(self, name, filename, stderr=False):
         filepath = os.path.join(self.logdir, filename)
         logger = logging.getLogger(name)
         logger.setLevel(logging.DEBUG)
-        handler = logging.handlers.RotatingFileHandler(
-            filepath, mode='a+', maxBytes=300000, backupCount=2)
-        formatter = logging.Formatter(
-            "%(asctime)s - %(levelname)s: %(message)s", "%Y-%m-%d %H:%M:%S")
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
+        logger.addFilter(RateLimitFilter())
 
+        # File writes and rotation happen on the log writer thread, and
+        # the log directory and file are only created once needed.
+        handlers = [DeferredRotatingFileHandler(
+            filepath, mode='a+', maxBytes=300000, backupCount=2)]
         if stderr:
-            handler = logging.StreamHandler()
-            logger.addHandler(handler)
+            handlers.append(logging.StreamHandler())
+
+        for handler in handlers:
+            handler.setFormatter(JSONFormatter())
+            logger.addHandler(QueueHandler(self.log_writer, handler))
 
         return logger
 
@@ -83,447 +162,307 @@ class PulseBuildbotTranslator(object):
             json_data = open(self.message)
             data = json.load(json_data)
             self.on_pulse_message(data)
+            self.loghandler.wait_pending()
+            if self.shadow:
+                self.shadow.flush(self.shutdown_timeout)
+            self.stopping.set()
+            unpublished = self.loghandler.close(self.shutdown_timeout)
+            self.tracer.flush(1)
+            if unpublished:
+                self.error_logger.error('%d messages could not be published.',
+                                        unpublished)
+            self.profiler.disable()
+            self.log_writer.stop()
             return
 
-        # Start listening for pulse messages. If 5 failures in a
-        # minute, wait 5 minutes before retrying.
-        failures = []
-        while True:
-            pulse = consumers.BuildConsumer(applabel=self.label, connect=False)
-            pulse.configure(topic=['#.finished', '#.log_uploaded'],
-                            callback=self.on_pulse_message,
-                            durable=self.durable)
-            if self.consumer_cfg:
-                pulse.config = self.consumer_cfg
-
-            try:
-                pulse.listen()
-            except Exception:
-                self.error_logger.exception(
-                    "Error occurred during pulse.listen()")
-
-            now = datetime.datetime.now()
-            failures = [x for x in failures
-                        if now - x < datetime.timedelta(seconds=60)]
-            failures.append(now)
-            if len(failures) >= 5:
-                failures = []
-                time.sleep(5 * 60)
-
-    def buildid2date(self, string):
-        """Takes a buildid string and returns seconds since epoch.
-        """
-
+        consumer_class = self.consumer_class
+        if consumer_class is None:
+            # Network stacks are only needed when listening, and importing
+            # them dominates the runtime of one-shot --push-message runs.
+            from mozillapulse.consumers import BuildConsumer
+            consumer_class = prefiltering(
+                resilient(BuildConsumer, heartbeat=self.heartbeat),
+                self.skip_message)
+
+        # Resume messages which were still waiting when the previous
+        # instance shut down.
+        self.loghandler.load_pending(self.pending_file)
+
+        if self.admin_address:
+            from admin import AdminServer
+
+            self.admin = AdminServer(self, self.admin_address,
+                                     self.error_logger)
+            self.admin.start()
+
+        # Start listening for pulse messages, and reconnect the same
+        # consumer after failures.
+        pulse = consumer_class(applabel=self.label, connect=False)
+        pulse.configure(topic=list(self.topics),
+                        callback=self.on_pulse_message,
+                        durable=self.durable)
+        if self.consumer_cfg:
+            pulse.config = self.consumer_cfg
+        self.profiler.start_control()
         try:
-            date = parse(string)
-            return int(time.mktime(date.timetuple()))
+            signal.signal(signal.SIGUSR1, self.profiler.request_toggle)
+            signal.signal(signal.SIGTERM, self.request_shutdown)
         except ValueError:
-            return int(string)
-
-    def process_unittest(self, data):
-        data['insertion_time'] = calendar.timegm(time.gmtime())
-        if data['platform'] in messageparams.ignored_platforms:
-            return
-        if not data.get('logurl'):
-            raise NoLogUrlError(data['key'])
-        if data['platform'] not in messageparams.platforms:
-            raise BadPlatformError(data['key'], data['platform'])
-        elif data['os'] not in messageparams.platforms[data['platform']]:
-            raise BadOSError(data['key'], data['platform'], data['os'],
-                             data['buildername'])
-
-        if self.display_only:
-            print "Test properties:\n%s\n" % json.dumps(data)
-            return
-
-        self.loghandler.handle_message(data)
-
-    def process_build(self, data):
-        if data['platform'] in messageparams.ignored_platforms:
-            return
-        if data['platform'] not in messageparams.platforms:
-            raise BadPlatformError(data['key'], data['platform'])
-        for tag in data['tags']:
-            if tag not in messageparams.tags:
-                raise BadTagError(data['key'], tag, data['platform'],
-                                  data['product'])
-        # Repacks do not have a buildurl included. We can remove this
-        # workaround once bug 857971 has been fixed
-        if not data['buildurl'] and not data['repack']:
-            raise NoBuildUrlError(data['key'])
-
-        if self.display_only:
-            print "Build properties:\n%s\n" % json.dumps(data)
+            # Signals are only handled on the main thread; translators run
+            # on others in the load test.
+            pass
+        try:
+            while not self.stopping.is_set():
+                delay = 0
+                try:
+                    self.listener = threading.current_thread()
+                    pulse.listen(
+                        on_connect_callback=self.reconnects.connected)
+                except ShutdownRequested:
+                    break
+                except Exception as e:
+                    self.error_logger.exception(
+                        "Error occurred during pulse.listen()")
+                    delay = self.reconnects.failed(e)
+                finally:
+                    self.listener = None
+                pulse.disconnect()
+                self.stopping.wait(delay)
+        except ShutdownRequested:
+            # Raised while handling a failure of listen().
+            pass
+        finally:
+            pulse.disconnect()
+            self.shutdown()
+
+    def request_shutdown(self, signum=None, frame=None):
+        """SIGTERM handler: stop consuming and drain within the deadline.
+
+        A message being translated is allowed to finish; waits for logs and
+        publish retries are cut short and the affected messages parked.
+        If the listener is idle it is interrupted right away.
+        """
+        if self.stopping.is_set():
             return
-
-        self.loghandler.handle_message(data)
+        self.stopping.set()
+        self.shutdown_started = time.time()
+
+        # Hard stop in case draining does not finish in time.
+        signal.signal(signal.SIGALRM, lambda signum, frame: os._exit(1))
+        signal.alarm(int(self.shutdown_timeout) + 1)
+
+        if (self.listener is threading.current_thread() and
+                not self.in_callback):
+            raise ShutdownRequested()
+
+    def shutdown(self):
+        """Persist parked messages, flush sinks and logs, and report."""
+        started = getattr(self, 'shutdown_started', time.time())
+        if self.admin:
+            self.admin.stop()
+        if self.shadow:
+            # Comparisons are only worth a short share of the deadline.
+            self.shadow.flush(min(self.shutdown_timeout / 10.0, 1))
+        remaining = max(0, started + self.shutdown_timeout - time.time())
+
+        publish_backlog = self.loghandler.outbox.backlog
+        sink_backlog = self.loghandler.flush_sinks(remaining)
+        self.tracer.flush(max(0, started + self.shutdown_timeout -
+                              time.time()))
+        parked = self.loghandler.save_pending(
+            self.pending_file,
+            timeout=max(0, started + self.shutdown_timeout - time.time()))
+        self.probe_schedule.save()
+        self.profiler.disable()
+
+        self.error_logger.info({'shutdown': {
+            'parked': parked,
+            'pending_file': self.pending_file if parked else None,
+            'publish_backlog': publish_backlog,
+            'publish_latency': self.loghandler.latency_stats(),
+            'probes': self.probe_schedule.stats(),
+            'trace': self.tracer.stats(),
+            'unwritten_sink_messages': sink_backlog,
+            'os_memo': messageparams.os_memo.stats(),
+            'parser': self.parser.stats(),
+            'release_revisions': self.release_revisions.stats(),
+            'bindings': self.traffic.stats() if self.traffic else None,
+            'consumer': self.reconnects.stats(),
+            'dedup': self.dedup.stats() if self.dedup else None,
+            'log_writer': self.log_writer.stats(),
+            'shadow': self.shadow.stats() if self.shadow else None,
+            'seconds': round(time.time() - started, 3)}})
+        self.log_writer.stop()
+        signal.alarm(0)
+
+    def status(self):
+        """Return a snapshot of the state of the translator."""
+        return {
+            'consumer': dict(self.reconnects.stats(),
+                             listening=self.listener is not None,
+                             in_callback=self.in_callback,
+                             stopping=self.stopping.is_set()),
+            'waiting': self.loghandler.waiting,
+            'pending': self.loghandler.pending_stats(),
+            'probing': len(self.loghandler.probes_in_flight()),
+            'publish_backlog': self.loghandler.outbox.stats(),
+            'publish_latency': self.loghandler.latency_stats(),
+            'probes': self.probe_schedule.stats(),
+            'trace': self.tracer.stats(),
+            'bindings': self.traffic.stats() if self.traffic else None,
+            'dedup': self.dedup.stats() if self.dedup else None,
+            'shadow': self.shadow.stats() if self.shadow else None,
+            'log_writer': self.log_writer.stats(),
+            'caches': self.cache_stats()}
+
+    def cache_stats(self):
+        return dict(self.parser.stats(),
+                    os_memo=messageparams.os_memo.stats(),
+                    release_revisions=self.release_revisions.stats(),
+                    prefilter=self.prefilter.reasons.stats())
+
+    def flush_caches(self):
+        """Clear the parser and lookup caches; they refill as messages
+        arrive.
+        """
+        for cache in [self.parser.builddates, self.parser.regexes,
+                      self.parser.strings, messageparams.os_memo,
+                      self.release_revisions, self.prefilter.reasons]:
+            cache.clear()
 
     def on_pulse_message(self, data, message=None):
-        key = 'unknown'
-        stage_platform = None
-
+        self.in_callback = True
+        try:
+            with self.profiler.stage('on_pulse_message'):
+                self.translate_message(data, message)
+        finally:
+            self.in_callback = False
+
+        if (self.stopping.is_set() and
+                self.listener is threading.current_thread()):
+            # Leave pulse.listen() once the message has been handled.
+            raise ShutdownRequested()
+
+    def skip_message(self, key):
+        """Return whether the message with routing key ``key`` is
+        dropped by the prefilter, and count it as such.
+        """
+        reason = self.prefilter.check(key)
+        if reason is None:
+            return False
+        if self.traffic:
+            self.traffic.record(key, 'prefiltered', reason)
+        return True
+
+    def translate_message(self, data, message=None):
+        key = (data.get('_meta') or {}).get('routing_key') or ''
+        outcome = 'failed'
         try:
-            key = data['_meta']['routing_key']
-
             # Acknowledge the message so it doesn't hang around on the
             # pulse server.
             if message:
                 message.ack()
-
-            # Create a dict that holds build properties that apply to both
-            # unittests and builds.
-            builddata = { 'key': key,
-                          'job_number': None,
-                          'buildid': None,
-                          'build_number': None,
-                          'previous_buildid': None,
-                          'status': None,
-                          'platform': None,
-                          'builddate': None,
-                          'buildurl': None,
-                          'locale': None,
-                          'locales': None,
-                          'logurl': None,
-                          'testsurl': None,
-                          'test_packages_url': None,
-                          'release': None,
-                          'buildername': None,
-                          'slave': None,
-                          'repack': None,
-                          'revision': None,
-                          'symbols_url': None,
-                          'product': None,
-                          'version': None,
-                          'tree': None,
-                          'timestamp': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
-                        }
-
-            # scan the payload for properties applicable to both tests and
-            # builds
-            for prop in data['payload']['build']['properties']:
-
-                # look for the job number
-                if prop[0] == 'buildnumber':
-                    builddata['job_number'] = prop[1]
-
-                # look for revision
-                if prop[0] == 'revision':
-                    builddata['revision'] = prop[1]
-
-                # look for product
-                elif prop[0] == 'product':
-                    # Bug 1010120:
-                    # Ensure to lowercase to prevent issues with capitalization
-                    builddata['product'] = prop[1].lower()
-
-                # look for version
-                elif prop[0] == 'version':
-                    builddata['version'] = prop[1]
-
-                # look for tree
-                elif prop[0] == 'branch':
-                    builddata['tree'] = prop[1]
-                    # For builds, this property is sometimes a relative path,
-                    # ('releases/mozilla-beta') and not just a name.  For
-                    # consistency, we'll strip the path components.
-                    if isinstance(builddata['tree'], basestring):
-                        builddata['tree'] = os.path.basename(builddata['tree'])
-
-                # look for buildid
-                elif prop[0] == 'buildid':
-                    builddata['buildid'] = prop[1]
-                    builddata['builddate'] = self.buildid2date(prop[1])
-
-                # look for the build number which comes with candidate builds
-                elif prop[0] == 'build_number':
-                    builddata['build_number'] = prop[1]
-
-                # look for the previous buildid
-                elif prop[0] == 'previous_buildid':
-                    builddata['previous_buildid'] = prop[1]
-
-                # look for platform
-                elif prop[0] == 'platform':
-                    builddata['platform'] = prop[1]
-                    if (builddata['platform'] and
-                        '-debug' in builddata['platform']):
-                        # strip '-debug' from the platform string if it's
-                        # present
-                        builddata['platform'] = builddata['platform'][
-                            0:builddata['platform'].find('-debug')]
-
-                # look for the locale
-                elif prop[0] == 'locale':
-                    builddata['locale'] = prop[1]
-
-                # look for the locale
-                elif prop[0] == 'locales':
-                    builddata['locales'] = prop[1]
-
-                # look for build url
-                elif prop[0] in ['packageUrl', 'build_url', 'fileURL']:
-                    builddata['buildurl'] = self._quote_url(prop[1])
-
-                # look for log url
-                elif prop[0] == 'log_url':
-                    builddata['logurl'] = self._quote_url(prop[1])
-
-                # look for release name
-                elif prop[0] in ['en_revision', 'script_repo_revision']:
-                    builddata['release'] = prop[1]
-
-                # look for tests url
-                elif prop[0] == 'symbolsUrl':
-                    builddata['symbols_url'] = self._quote_url(prop[1])
-
-                # look for tests url
-                elif prop[0] == 'testsUrl':
-                    builddata['testsurl'] = self._quote_url(prop[1])
-
-                # look for url to json manifest of test packages
-                elif prop[0] == 'testPackagesUrl':
-                    builddata['test_packages_url'] = self._quote_url(prop[1])
-
-                # look for buildername
-                elif prop[0] == 'buildername':
-                    builddata['buildername'] = prop[1]
-
-                # look for slave builder
-                elif prop[0] == 'slavename':
-                    builddata['slave'] = prop[1]
-
-                # look for blobber files
-                elif prop[0] == 'blobber_files':
-                    try:
-                        builddata['blobber_files'] = json.loads(prop[1])
-                    except ValueError:
-                        self.error_logger.exception(
-                            "Malformed `blobber_files` buildbot property: {}".format(prop[1]))
-
-                # look for stage_platform
-                elif prop[0] == 'stage_platform':
-                    # For some messages, the platform we really care about
-                    # is in the 'stage_platform' property, not the 'platform'
-                    # property.
-                    stage_platform = prop[1]
-                    for buildtype in messageparams.buildtypes:
-                        if buildtype in stage_platform:
-                            stage_platform = stage_platform[0:stage_platform.find(buildtype) - 1]
-
-                elif prop[0] == 'completeMarUrl':
-                    builddata['completemarurl'] = prop[1]
-
-                elif prop[0] == 'completeMarHash':
-                    builddata['completemarhash'] = prop[1]
-
-            if not builddata['tree']:
-                raise BadPulseMessageError(key, "no 'branch' property")
-
-            # If no locale is given fallback to en-US
-            if not builddata['locale']:
-                builddata['locale'] = 'en-US'
-
-            # Release build notifications do not contain a revision.
-            # Lets fetch it via the release tag and the hg.m.o REST API
-            if builddata['tree'].startswith('release-') and builddata['revision'] in [None, 'None']:
-                try:
-                    # Map for platforms which change their id
-                    platform_map = {
-                        'linux': 'linux-i686',
-                        'linux64': 'linux-x86_64',
-                        'macosx64': 'mac',
-                        'win32': 'win32',
-                        'win64': 'win64',
-                    }
-
-                    url = 'http://archive.mozilla.org/pub/{product}/candidates/{version}-' \
-                          'candidates/build{build_number}/{platform}/en-US/firefox-' \
-                          '{version}.json'.format(
-                              product=builddata['product'],
-                              version=builddata['version'],
-                              build_number=builddata['build_number'],
-                              platform=platform_map.get(builddata['platform'],
-                                                        builddata['platform']),
-                          )
-                    response = requests.get(url)
-                    builddata['revision'] = response.json()['moz_source_stamp']
-                except Exception:
-                    # We cannot raise an exception due to a broken release rev for repacks
-                    # https://bugzilla.mozilla.org/show_bug.cgi?id=1219432#c1
-                    pass
-
-            # status of the build or test notification
-            # see http://hg.mozilla.org/build/buildbot/file/08b7c51d2962/master/buildbot/status/builder.py#l25
-            builddata['status'] = data['payload']['build']['results']
-
-            if 'debug' in key:
-                builddata['buildtype'] = 'debug'
-            elif 'pgo' in key:
-                builddata['buildtype'] = 'pgo'
-            else:
-                builddata['buildtype'] = 'opt'
-
-            # see if this message is for a unittest
-            unittestRe = re.compile(r'build\.((%s)[-|_](.*?)(-debug|-o-debug|-pgo|_pgo|_test)?[-|_](test|unittest|pgo)-(.*?))\.(\d+)\.(log_uploaded|finished)' %
-                                    builddata['tree'])
-            match = unittestRe.match(key)
-            if match:
-                # for unittests, generate some metadata by parsing the key
-
-                if match.groups()[7] == 'finished':
-                    # Ignore this message, we only care about 'log_uploaded'
-                    # messages for unittests.
-                    return
-
-                # The 'short_builder' string is quite arbitrary, and so this
-                # code is expected to be fragile, and will likely need
-                # frequent maintenance to deal with future changes to this
-                # string.  Unfortunately, these items are not available
-                # in a more straightforward fashion at present.
-                short_builder = match.groups()[0]
-
-                builddata['os'] = match.groups()[2]
-                if builddata['os'] in messageparams.os_conversions:
-                    builddata['os'] = messageparams.os_conversions[
-                        builddata['os']](builddata)
-
-                builddata['test'] = match.groups()[5]
-
-                # yuck!!
-                if builddata['test'].endswith('_2'):
-                    short_builder = "%s.2" % short_builder[0:-2]
-                elif builddata['test'].endswith('_2-pgo'):
-                    short_builder = "%s.2-pgo" % short_builder[0:-6]
-
-                builddata['talos'] = 'talos' in builddata['buildername']
-
-                if stage_platform:
-                    builddata['platform'] = stage_platform
-
-                self.process_unittest(builddata)
-
-            elif 'source' in key:
-                # what is this?
-                # ex: build.release-mozilla-esr10-firefox_source.0.finished
-                pass
-
-            elif [x for x in ['schedulers', 'tag', 'submitter',
-                              'final_verification', 'fuzzer'] if x in key]:
-                # internal buildbot stuff we don't care about
-                # ex: build.release-mozilla-beta-firefox_reset_schedulers.12.finished
-                # ex: build.release-mozilla-beta-fennec_tag.40.finished
-                # ex: build.release-mozilla-beta-bouncer_submitter.46.finished
-                pass
-
-            elif 'jetpack' in key:
-                # These are very awkwardly formed; i.e.
-                # build.jetpack-mozilla-central-win7-debug.18.finished,
-                # and the tree appears nowhere except this string.  In order
-                # to support these we'd have to keep a tree map of all
-                # possible trees.
-                pass
-
-            else:
-                if not builddata['platform']:
-                    if stage_platform:
-                        builddata['platform'] = stage_platform
-                    else:
-                        # Some messages don't contain the platform
-                        # in any place other than the routing key, so we'll
-                        # have to guess it based on that.
-                        builddata['platform'] = messageparams.guess_platform(key)
-                        if not builddata['platform']:
-                            raise BadPulseMessageError(key, 'no "platform" property')
-
-                otherRe = re.compile(r'build\.((release-|jetpack-|b2g_)?(%s)[-|_](xulrunner[-|_])?(%s)([-|_]?)(.*?))\.(\d+)\.(log_uploaded|finished)' %
-                                     (builddata['tree'], builddata['platform']))
-                match = otherRe.match(key)
-                if match:
-                    if 'finished' in match.group(9):
-                        # Ignore this message, we only care about 'log_uploaded'
-                        # messages for builds
-                        return
-
-                    builddata['tags'] = match.group(7).replace('_', '-').split('-')
-
-                    # There are some tags we don't care about as tags,
-                    # usually because they are redundant with other properties,
-                    # so remove them.
-                    notags = ['debug', 'pgo', 'opt', 'repack']
-                    builddata['tags'] = [x for x in builddata['tags'] if x not in notags]
-
-                    # Sometimes a tag will just be a digit, i.e.,
-                    # build.mozilla-central-android-l10n_5.12.finished;
-                    # strip these.
-                    builddata['tags'] = [x for x in builddata['tags'] if not x.isdigit()]
-
-                    if isinstance(match.group(2), basestring):
-                        if 'release' in match.group(2):
-                            builddata['tags'].append('release')
-                        if 'jetpack' in match.group(2):
-                            builddata['tags'].append('jetpack')
-
-                    if match.group(4) or 'xulrunner' in builddata['tags']:
-                        builddata['product'] = 'xulrunner'
-
-                    # Sadly, the build url for emulator builds isn't published
-                    # to the pulse stream, so we have to guess it.  See bug
-                    # 1071642.
-                    if ('emulator' in builddata.get('platform', '') and
-                            'try' not in key and builddata.get('buildid')):
-                        builddata['buildurl'] = (
-                            'https://pvtbuilds.mozilla.org/pub/mozilla.org/b2g/tinderbox-builds' +
-                            '/%s-%s/%s/emulator.tar.gz' %
-                            (builddata['tree'], builddata['platform'],
-                             builddata['buildid']))
-
-                    # In case of repack messages we have to send multiple
-                    # notifications, each for every locale included.
-
-                    # Current release-builds have a different data structure
-                    # than nightly builds which are generated via mozharness.
-                    # This will change once bug 1142872 is fixed and active.
-                    if 'repack' in key:  # release build
-                        builddata['repack'] = True
-
-                        if not builddata["locales"]:
-                            raise BadPulseMessageError(key, 'no "locales" property')
-
-                        for locale in builddata["locales"].split(','):
-                            if not locale:
-                                raise BadLocalesError(key, builddata["locales"])
-
-                            data = copy.deepcopy(builddata)
-                            data['locale'] = locale
-                            self.process_build(data)
-
-                    elif builddata['locales']:  # nightly repack build
-                        builddata['repack'] = True
-
-                        locales = json.loads(builddata['locales'])
-                        for locale, result in locales.iteritems():
-                            # Use all properties except the locales array
-                            data = copy.deepcopy(builddata)
-                            del data['locales']
-
-                            # Update overall status of the new message based on the locale status.
-                            # Given that there are no clear result values, lets take the values
-                            # from buildbot status: 0 = Success, 2 = Failed
-                            status = str(result).lower() == "success" or str(result) == '0'
-                            data['status'] = 0 if status else 2
-
-                            # Process locale
-                            data['locale'] = locale
-                            self.process_build(data)
-
-                    else:  # single locale build
-                        self.process_build(builddata)
-                else:
-                    raise BadPulseMessageError(key, "unknown message type, platform: %s" % builddata.get('platform', 'unknown'))
+            # Consumers other than the prefiltering one deliver every
+            # message.
+            if self.skip_message(key):
+                outcome = None
+                return
+            trace = self.tracer.start(data)
+
+            warnings = []
+            translations = self.engine.parse(data, warnings=warnings)
+            for warning in warnings:
+                self.error_logger.error(warning)
+            translations = [translation for translation in translations
+                            if self.prefilter.wants(translation.data)]
+            outcome = 'translated' if translations else 'ignored'
+            now = time.time()
+            traces = [self.tracer.child(trace, translation.kind,
+                                        translation.data)
+                      for translation in translations]
+            for child in traces:
+                self.tracer.mark(child, 'parsed', now)
+
+            revisions = {}
+            for translation in translations:
+                self.release_revision(translation.data, revisions)
+
+            payloads = [None] * len(translations)
+            if not self.display_only:
+                with self.profiler.stage('encode'):
+                    payloads = encode_payloads([translation.data for
+                                                translation in translations])
+            for translation, payload, child in zip(translations, payloads,
+                                                   traces):
+                self.process_translation(translation, payload, child)
 
         except BadPulseMessageError as inst:
-            self.bad_pulse_msg_logger.exception(json.dumps(data.get('payload'),
-                                                           indent=2))
+            self.bad_pulse_msg_logger.exception(data.get('payload'))
             print(inst.__class__, str(inst))
         except Exception:
-            self.error_logger.exception(json.dumps(data, indent=2))
+            self.error_logger.exception(data)
+        finally:
+            if self.traffic and outcome:
+                self.traffic.record(key, outcome)
+            if self.traffic and time.time() >= self.next_traffic_report:
+                self.next_traffic_report = time.time() + self.report_bindings
+                self.error_logger.info({'bindings': self.traffic.stats()})
+
+    def release_revision(self, builddata, revisions):
+        """Release build notifications do not contain a revision. Lets
+        fetch it via the release tag and the hg.m.o REST API; ``revisions``
+        caches lookups between the translations of one message.
+        """
+        if not (builddata['tree'].startswith('release-') and
+                builddata['revision'] in [None, 'None']):
+            return
+
+        # Map for platforms which change their id
+        platform_map = {
+            'linux': 'linux-i686',
+            'linux64': 'linux-x86_64',
+            'macosx64': 'mac',
+            'win32': 'win32',
+            'win64': 'win64',
+        }
+
+        url = 'http://archive.mozilla.org/pub/{product}/candidates/{version}-' \
+              'candidates/build{build_number}/{platform}/en-US/firefox-' \
+              '{version}.json'.format(
+                  product=builddata['product'],
+                  version=builddata['version'],
+                  build_number=builddata['build_number'],
+                  platform=platform_map.get(builddata['platform'],
+                                            builddata['platform']),
+              )
+        if url not in revisions:
+            try:
+                # All repacks of a candidate build share the revision, so
+                # successful lookups are kept between messages.
+                revisions[url] = self.release_revisions.get(
+                    url, lambda: self.fetch_release_revision(url))
+            except Exception:
+                # We cannot raise an exception due to a broken release rev for repacks
+                # https://bugzilla.mozilla.org/show_bug.cgi?id=1219432#c1
+                revisions[url] = builddata['revision']
+        builddata['revision'] = revisions[url]
+
+    def fetch_release_revision(self, url):
+        with self.profiler.stage('release_revision'):
+            import requests
+            response = requests.get(url)
+            return response.json()['moz_source_stamp']
+
+    def process_translation(self, translation, payload=None, trace=None):
+        if self.display_only:
+            with self.profiler.stage('display'):
+                if translation.kind == 'unittest':
+                    print "Test properties:\n%s\n" % json.dumps(
+                        translation.data)
+                else:
+                    print "Build properties:\n%s\n" % json.dumps(
+                        translation.data)
+            return
+
+        with self.profiler.stage('handle_message'):
+            self.loghandler.handle_message(translation.data, payload, trace)
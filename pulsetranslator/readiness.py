@@ -0,0 +1,89 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Policies deciding when an uploaded log is complete enough to publish.
+
+A policy is consulted by ``LogHandler`` with the ``UrlInfo`` of every HEAD
+probe for a log url, and answers whether the log can be considered ready.
+"""
+
+import collections
+import time
+
+UrlInfo = collections.namedtuple('UrlInfo', ['code', 'content_length', 'etag',
+                                             'last_modified', 'date'])
+
+
+def http_date(value):
+    """Return seconds since epoch for an HTTP date header, or None."""
+    import email.utils
+
+    if not value:
+        return None
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return email.utils.mktime_tz(parsed)
+
+
+class StatusReadiness(object):
+    """Consider a log ready as soon as it can be fetched."""
+
+    def is_ready(self, url, info):
+        return info.code == 200
+
+    def forget(self, url):
+        pass
+
+
+class StableSizeReadiness(object):
+    """Consider a log ready once its size has stopped changing.
+
+    The Content-Length, ETag and Last-Modified headers of successive probes
+    are compared, and the log is ready when none of them changed for
+    ``stable_interval`` seconds. A Last-Modified date at least that old
+    according to the server's Date header makes a log ready on the first
+    probe. Empty logs, and logs whose Content-Length is not a number, are
+    not ready, and logs whose server reports none of the headers fall back
+    to the plain status check.
+    """
+
+    def __init__(self, stable_interval=15):
+        self.stable_interval = stable_interval
+        # url -> (fingerprint, time the fingerprint was first seen)
+        self.seen = {}
+
+    def is_ready(self, url, info):
+        if info.code != 200:
+            return False
+
+        if info.content_length is not None:
+            try:
+                if int(info.content_length) == 0:
+                    return False
+            except ValueError:
+                # A garbled header, e.g. from a proxy mid-upload; probe
+                # again rather than fail the message.
+                return False
+
+        fingerprint = (info.content_length, info.etag, info.last_modified)
+        if fingerprint == (None, None, None):
+            return True
+
+        last_modified = http_date(info.last_modified)
+        server_now = http_date(info.date)
+        if (last_modified is not None and server_now is not None and
+                server_now - last_modified >= self.stable_interval):
+            return True
+
+        now = time.time()
+        previous, since = self.seen.get(url, (None, now))
+        if previous != fingerprint:
+            since = now
+        self.seen[url] = (fingerprint, since)
+
+        return now - since >= self.stable_interval
+
+    def forget(self, url):
+        self.seen.pop(url, None)
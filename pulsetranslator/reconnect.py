@@ -0,0 +1,170 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Reconnecting the pulse consumer after broker failures.
+
+The consumer is kept across reconnects, so a durable queue declared and
+bound on the first connection is consumed from directly afterwards.
+Connections send AMQP heartbeats, so a broker which went away unnoticed is
+detected within two heartbeat intervals. Reconnect attempts are spaced by
+exponential backoff with jitter, and each outage is logged once the
+consumer is connected again.
+"""
+
+import random
+import socket
+import sys
+import time
+
+
+class Backoff(object):
+    """Delays doubling from ``initial`` up to ``maximum`` seconds, each
+    shortened by a random fraction of up to ``jitter`` so that
+    translators restarted by the same outage do not reconnect in step.
+    """
+
+    def __init__(self, initial=0.5, maximum=30, jitter=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next(self):
+        delay = min(self.maximum, self.initial * 2 ** self.attempts)
+        self.attempts += 1
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        self.attempts = 0
+
+
+class ReconnectManager(object):
+    """Keep track of the consumer's connection and its outages.
+
+    An outage starts with the first failure of a connection and ends once
+    the consumer is connected again. The backoff is only reset once a
+    connection stayed up for ``stable`` seconds, so a broker which accepts
+    connections but drops them right away is not retried in a tight loop.
+    """
+
+    def __init__(self, logger, backoff=None, stable=10):
+        self.logger = logger
+        self.backoff = backoff or Backoff()
+        self.stable = stable
+        self.connected_at = None
+        self.outage = None
+        self.outages = 0
+        self.downtime = 0.0
+        self.longest = 0.0
+
+    def connected(self):
+        now = time.time()
+        self.connected_at = now
+        if self.outage is None:
+            return
+        seconds = now - self.outage['started']
+        self.outages += 1
+        self.downtime += seconds
+        self.longest = max(self.longest, seconds)
+        self.logger.info({'outage': dict(
+            self.outage, ended=now, seconds=round(seconds, 3))})
+        self.outage = None
+
+    def failed(self, error):
+        """Record a failure of the connection and return the seconds to
+        wait before the next attempt.
+        """
+        now = time.time()
+        if (self.connected_at is not None and
+                now - self.connected_at >= self.stable):
+            self.backoff.reset()
+        self.connected_at = None
+        if self.outage is None:
+            self.outage = {'started': now, 'attempts': 0}
+        self.outage['attempts'] += 1
+        self.outage['error'] = '%s: %s' % (error.__class__.__name__, error)
+        return self.backoff.next()
+
+    def stats(self):
+        stats = {'outages': self.outages,
+                 'downtime': round(self.downtime, 3),
+                 'longest': round(self.longest, 3),
+                 'connected': self.connected_at is not None}
+        if self.outage is not None:
+            stats['current'] = dict(
+                self.outage, seconds=round(time.time() -
+                                           self.outage['started'], 3))
+        return stats
+
+
+def resilient(consumer_class, heartbeat=30):
+    """Return a subclass of a mozillapulse consumer class whose ``listen``
+    consumes from a heartbeat-checked connection until it fails, and then
+    raises instead of reconnecting on its own. Once a durable queue was
+    declared and bound, later connections consume from it without
+    declaring it again.
+    """
+
+    class ResilientConsumer(consumer_class):
+
+        declared = False
+
+        def connect(self):
+            from kombu import Connection
+
+            if not self.connection:
+                self.connection = Connection(
+                    hostname=self.config.host, port=self.config.port,
+                    userid=self.config.user, password=self.config.password,
+                    virtual_host=self.config.vhost, ssl=self.config.ssl,
+                    heartbeat=heartbeat)
+
+        def disconnect(self):
+            try:
+                consumer_class.disconnect(self)
+            except Exception:
+                # The connection is gone already.
+                self.connection = None
+
+        def _build_consumer(self, callback=None, on_connect_callback=None):
+            from kombu import Exchange
+
+            if not (self.durable and self.declared):
+                consumer = consumer_class._build_consumer(self, callback)
+                self.declared = True
+                return consumer
+
+            # The queue and its bindings outlive the connection.
+            self.connect()
+            queue = self._create_queue(Exchange(self.exchange[0],
+                                                type='topic'),
+                                       self.topic[0])
+            return self.connection.Consumer(queue, auto_declare=False,
+                                            callbacks=[self.callback])
+
+        def listen(self, callback=None, on_connect_callback=None):
+            try:
+                consumer = self._build_consumer(callback)
+                consumer.__enter__()
+            except Exception:
+                # The broker may have lost the queue, e.g. in a failover.
+                self.declared = False
+                raise
+            try:
+                if on_connect_callback:
+                    on_connect_callback()
+                while True:
+                    # Wake up every second to send and check heartbeats;
+                    # that also lets signal handlers run.
+                    try:
+                        self.connection.drain_events(timeout=1)
+                    except socket.timeout:
+                        pass
+                    if heartbeat:
+                        self.connection.heartbeat_check()
+            except BaseException:
+                consumer.__exit__(*sys.exc_info())
+                raise
+
+    return ResilientConsumer
@@ -6,10 +6,12 @@ import ConfigParser
 import optparse
 import os
 
-from mozillapulse.config import PulseConfiguration
-
+from bindings import parse_list
 from daemon import createDaemon
+from dedup import open_store
+from priorities import parse_priorities
 from pulsetranslator import PulseBuildbotTranslator
+from shadow import load_engine
 
 
 def main():
@@ -48,11 +50,156 @@ def main():
     parser.add_option('--label',
                       dest='label',
                       help='label to use for pulse queue')
+    parser.add_option('--log-stable-interval',
+                      dest='log_stable_interval',
+                      type='int',
+                      default=15,
+                      help='seconds the size of an uploaded log must stay '
+                      'unchanged before it is considered complete')
+
+    parser.add_option('--profile',
+                      dest='profile',
+                      action='store_true',
+                      default=False,
+                      help='start with profiling enabled; SIGUSR1 toggles '
+                      'profiling and dumps collapsed stacks to the log dir')
+    parser.add_option('--profile-sample-interval',
+                      dest='profile_sample_interval',
+                      type='float',
+                      help='seconds between stack samples while profiling; '
+                      'sampling is off unless given')
+
+    parser.add_option('--sink-file',
+                      dest='sink_files',
+                      action='append',
+                      help='also append normalized messages as JSON lines '
+                      'to this file; may be given multiple times')
+    parser.add_option('--sink-url',
+                      dest='sink_urls',
+                      action='append',
+                      help='also POST batches of normalized messages as JSON '
+                      'lines to this url; may be given multiple times')
+    parser.add_option('--trace-file',
+                      dest='trace_files',
+                      action='append',
+                      help='append a latency trace span of every published '
+                      'message as a JSON line to this file; may be given '
+                      'multiple times')
+    parser.add_option('--trace-url',
+                      dest='trace_urls',
+                      action='append',
+                      help='POST batches of latency trace spans to this OTLP '
+                      'JSON endpoint, e.g. http://localhost:4318/v1/traces; '
+                      'may be given multiple times')
+
+    parser.add_option('--shutdown-timeout',
+                      dest='shutdown_timeout',
+                      type='int',
+                      default=10,
+                      help='seconds to drain pending messages on SIGTERM')
+    parser.add_option('--pending-file',
+                      dest='pending_file',
+                      help='file to save messages still waiting for their '
+                      'log on shutdown, and to resume them from on start; '
+                      'defaults to pending.json in the log dir')
+    parser.add_option('--pending-memory',
+                      dest='pending_memory',
+                      type='int',
+                      default=1000,
+                      help='messages waiting for their log to keep in '
+                      'memory; more are spilled to pending-spill.sqlite in '
+                      'the log dir')
+    parser.add_option('--log-probe-threads',
+                      dest='log_probe_threads',
+                      type='int',
+                      default=4,
+                      help='threads probing for the logs of waiting messages')
+    parser.add_option('--first-probe-quantile',
+                      dest='first_probe_quantile',
+                      type='float',
+                      default=0.25,
+                      help='quantile of the recent log upload delays of a '
+                      'builder at which to first probe for a log')
+    parser.add_option('--no-probe-prediction',
+                      dest='first_probe_quantile',
+                      action='store_const',
+                      const=None,
+                      help='probe for logs right away')
+    parser.add_option('--heartbeat',
+                      dest='heartbeat',
+                      type='int',
+                      default=30,
+                      help='seconds between AMQP heartbeats of the consumer '
+                      'connection; 0 disables them')
+    parser.add_option('--max-reconnect-delay',
+                      dest='max_reconnect_delay',
+                      type='float',
+                      default=30,
+                      help='maximum seconds between attempts to reconnect '
+                      'the consumer')
+    parser.add_option('--report-bindings',
+                      dest='report_bindings',
+                      type='float',
+                      help='count what became of the messages each topic '
+                      'binding carried, and log it every this many seconds '
+                      'and on shutdown')
+    parser.add_option('--shadow-engine',
+                      dest='shadow_engine',
+                      help='also translate every message with this candidate '
+                      'engine, given as module:attribute, and log where its '
+                      'output differs to shadow_diff.log in the log dir; '
+                      'only the current engine\'s output is published')
+    parser.add_option('--admin-address',
+                      dest='admin_address',
+                      help='serve live introspection and operator actions '
+                      'as JSON over HTTP at a port on localhost, or at the '
+                      'path of a Unix socket')
+    parser.add_option('--dedup-store',
+                      dest='dedup_store',
+                      help='publish each normalized message only once across '
+                      'the translators sharing this store, given as '
+                      'sqlite:///path or redis://host:port/db')
+    parser.add_option('--dedup-lease',
+                      dest='dedup_lease',
+                      type='float',
+                      default=60,
+                      help='seconds after which another translator takes '
+                      'over a message claimed but not published')
 
     options, args = parser.parse_args()
 
+    shadow_engine = None
+    if options.shadow_engine:
+        try:
+            shadow_engine = load_engine(options.shadow_engine)
+        except ValueError as e:
+            print 'Invalid shadow engine: %s' % e
+            return
+
+    if options.admin_address:
+        from admin import parse_address
+
+        try:
+            parse_address(options.admin_address)
+        except ValueError as e:
+            print 'Invalid admin address: %s' % e
+            return
+
+    dedup_store = None
+    if options.dedup_store:
+        try:
+            dedup_store = open_store(options.dedup_store)
+        except ValueError as e:
+            print 'Invalid dedup store: %s' % e
+            return
+
     pulse_cfgs = {'consumer': None, 'publisher': None}
+    known_trees = []
+    priorities = []
+    translator_cfg = {}
     if options.pulse_cfg:
+        from mozillapulse.config import PulseConfiguration
+
         if not os.path.exists(options.pulse_cfg):
             print 'Config file does not exist!'
             return
@@ -61,6 +208,21 @@ def main():
         for section in pulse_cfgs.keys():
             pulse_cfgs[section] = PulseConfiguration.read_from_config(
                 pulse_cfgfile, section)
+        if pulse_cfgfile.has_option('translator', 'priorities'):
+            try:
+                priorities = parse_priorities(
+                    pulse_cfgfile.get('translator', 'priorities'))
+            except ValueError as e:
+                print 'Invalid priorities: %s' % e
+                return
+        for option in ['bindings', 'wanted', 'excluded']:
+            if pulse_cfgfile.has_option('translator', option):
+                translator_cfg[option] = parse_list(
+                    pulse_cfgfile.get('translator', option))
+        if pulse_cfgfile.has_option('translator', 'trees'):
+            known_trees = [tree.strip() for tree in
+                           pulse_cfgfile.get('translator', 'trees').split(',')
+                           if tree.strip()]
         if os.environ.get('pulseuser'):
           setattr(pulse_cfgs['consumer'], 'user', os.environ['pulseuser'])
           setattr(pulse_cfgs['publisher'], 'user', os.environ['pulseuser'])
@@ -81,6 +243,30 @@ def main():
                                       logdir=options.logdir,
                                       message=options.message,
                                       label=options.label,
+                                      log_stable_interval=options.log_stable_interval,
+                                      profile=options.profile,
+                                      profile_sample_interval=options.profile_sample_interval,
+                                      sink_files=options.sink_files,
+                                      sink_urls=options.sink_urls,
+                                      trace_files=options.trace_files,
+                                      trace_urls=options.trace_urls,
+                                      shutdown_timeout=options.shutdown_timeout,
+                                      pending_file=options.pending_file,
+                                      known_trees=known_trees,
+                                      topics=translator_cfg.get('bindings'),
+                                      wanted=translator_cfg.get('wanted'),
+                                      excluded=translator_cfg.get('excluded'),
+                                      report_bindings=options.report_bindings,
+                                      heartbeat=options.heartbeat,
+                                      first_probe_quantile=options.first_probe_quantile,
+                                      max_reconnect_delay=options.max_reconnect_delay,
+                                      priorities=priorities,
+                                      pending_memory=options.pending_memory,
+                                      log_probe_threads=options.log_probe_threads,
+                                      shadow_engine=shadow_engine,
+                                      dedup_store=dedup_store,
+                                      dedup_lease=options.dedup_lease,
+                                      admin_address=options.admin_address,
                                       display_only=options.display_only,
                                       consumer_cfg=pulse_cfgs['consumer'],
                                       publisher_cfg=pulse_cfgs['publisher'])
@@ -0,0 +1,209 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Shadow translation by a candidate engine.
+
+A candidate engine is any object with the ``parse(data, now, warnings)``
+method of ``MessageParser``. In shadow mode every message is translated by
+the current engine, whose translations alone are published, and then again
+by the candidate on a background thread. Messages whose routing keys or
+payloads differ are logged, and matches, differences and the latency of
+each engine are counted.
+"""
+
+import importlib
+import json
+import Queue
+import threading
+import time
+
+from messageencoder import routing_key
+from messageparser import Translation
+from priorities import LatencyStats
+
+MISSING = '<missing>'
+
+
+def load_engine(spec):
+    """Return the engine factory named by a ``module:attribute`` spec."""
+    module, sep, attribute = spec.partition(':')
+    if not sep or not module or not attribute:
+        raise ValueError('engine %r is not "module:attribute"' % spec)
+    try:
+        return getattr(importlib.import_module(module), attribute)
+    except (ImportError, AttributeError) as e:
+        raise ValueError('cannot load engine %r: %s' % (spec, e))
+
+
+def published(data):
+    """Return a payload as it reads once published as JSON, where e.g.
+    tuples are lists.
+    """
+    try:
+        return json.loads(json.dumps(data))
+    except (TypeError, ValueError) as e:
+        return {'<unpublishable>': e.__class__.__name__}
+
+
+def describe(translations, error):
+    """Return the routing keys and published payloads of an engine's
+    output, or the class of the exception it raised.
+    """
+    if error is not None:
+        return error.__class__.__name__, []
+    outputs = []
+    for translation in translations:
+        try:
+            key = routing_key(translation.data)
+        except Exception as e:
+            key = '<%s>' % e.__class__.__name__
+        outputs.append((key, published(translation.data)))
+    return None, outputs
+
+
+def diff(primary, candidate):
+    """Return the differences between two described outputs, or None."""
+    (primary_error, primary_outputs) = primary
+    (candidate_error, candidate_outputs) = candidate
+    differences = {}
+    if primary_error != candidate_error:
+        differences['error'] = [primary_error, candidate_error]
+    if len(primary_outputs) != len(candidate_outputs):
+        differences['count'] = [len(primary_outputs), len(candidate_outputs)]
+
+    messages = []
+    for index, ((primary_key, primary_data),
+                (candidate_key, candidate_data)) in enumerate(
+                    zip(primary_outputs, candidate_outputs)):
+        message = {}
+        if primary_key != candidate_key:
+            message['routing_key'] = [primary_key, candidate_key]
+        fields = dict(
+            (field, [primary_data.get(field, MISSING),
+                     candidate_data.get(field, MISSING)])
+            for field in set(primary_data) | set(candidate_data)
+            if primary_data.get(field, MISSING) !=
+            candidate_data.get(field, MISSING))
+        if fields:
+            message['fields'] = fields
+        if message:
+            message['index'] = index
+            messages.append(message)
+    if messages:
+        differences['messages'] = messages
+    return differences or None
+
+
+class ShadowParser(threading.Thread):
+    """Translate with ``primary`` and compare with ``candidate``.
+
+    Messages are compared in the order they were translated, from a
+    buffer of up to ``maxsize``. Once the buffer is full, further
+    messages are not compared and are counted as dropped, so a slow
+    candidate never holds up translation.
+    """
+
+    def __init__(self, primary, candidate, logger, maxsize=1000):
+        threading.Thread.__init__(self, name='ShadowParser')
+        self.daemon = True
+        self.primary = primary
+        self.candidate = candidate
+        self.logger = logger
+        self.queue = Queue.Queue(maxsize=maxsize)
+        self.comparing = 0
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(['compared', 'matched', 'differed',
+                                     'candidate_errors', 'dropped'], 0)
+        self.latency = {'primary': LatencyStats(),
+                        'candidate': LatencyStats()}
+        self.start()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['backlog'] = self.comparing + self.queue.qsize()
+            stats['latency'] = dict((engine, latency.stats()) for
+                                    engine, latency in
+                                    self.latency.iteritems())
+        return stats
+
+    def parse(self, data, now=None, warnings=None):
+        # Both engines translate at the same time, so that time stamps
+        # such as insertion_time agree.
+        if now is None:
+            now = time.time()
+        started = time.time()
+        try:
+            translations = self.primary.parse(data, now=now,
+                                              warnings=warnings)
+        except Exception as e:
+            self.submit(data, now, time.time() - started, [], e)
+            raise
+
+        # The translations are completed and published after this returns;
+        # keep their payloads as the engine made them.
+        self.submit(data, now, time.time() - started,
+                    [Translation(translation.kind, dict(translation.data))
+                     for translation in translations], None)
+        return translations
+
+    def submit(self, data, now, seconds, translations, error):
+        try:
+            self.queue.put_nowait((data, now, seconds, translations, error))
+        except Queue.Full:
+            self.count('dropped')
+
+    def flush(self, timeout):
+        """Wait up to ``timeout`` seconds for buffered messages to be
+        compared, log the summary and return how many are outstanding.
+        """
+        deadline = time.time() + timeout
+        while ((self.comparing or not self.queue.empty()) and
+               time.time() < deadline):
+            time.sleep(0.05)
+        stats = self.stats()
+        self.logger.info({'shadow': stats})
+        return stats['backlog']
+
+    def compare(self, data, now, seconds, translations, error):
+        started = time.time()
+        try:
+            candidate_translations = self.candidate.parse(data, now=now,
+                                                          warnings=[])
+            candidate_error = None
+        except Exception as e:
+            candidate_translations, candidate_error = [], e
+        candidate_seconds = time.time() - started
+
+        differences = diff(describe(translations, error),
+                           describe(candidate_translations, candidate_error))
+        with self.lock:
+            self.latency['primary'].add(seconds)
+            self.latency['candidate'].add(candidate_seconds)
+            self.counts['compared'] += 1
+            self.counts['differed' if differences else 'matched'] += 1
+            if (candidate_error is not None and
+                    candidate_error.__class__ is not error.__class__):
+                self.counts['candidate_errors'] += 1
+        if differences:
+            differences.update({
+                'key': data.get('_meta', {}).get('routing_key'),
+                'primary_seconds': round(seconds, 6),
+                'candidate_seconds': round(candidate_seconds, 6)})
+            self.logger.info(differences)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            self.comparing = 1
+            try:
+                self.compare(*item)
+            except Exception:
+                self.logger.exception('Failure when comparing engines')
+            finally:
+                self.comparing = 0
@@ -0,0 +1,201 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Output sinks for normalized messages.
+
+Every sink implements ``publish(message)`` for an ``EncodedMessage``;
+sinks which can write several messages at once also implement
+``publish_batch(messages)``. Secondary sinks are
+wrapped in a ``BackgroundSink`` so that they buffer and retry on their
+own thread and never hold up the primary exchange.
+"""
+
+import json
+import Queue
+import threading
+import time
+
+from translatorqueues import PublishOutbox, publish_message
+
+
+def encode_ndjson(messages):
+    return ''.join('{"routing_key": %s, "payload": %s}\n' % (
+        json.dumps(message.routing_key), message.payload)
+        for message in messages)
+
+
+class AMQPSink(object):
+    """Publish to a pulse exchange, by default exchange/build/normalized.
+
+    Messages which fail to publish, and any published while earlier ones
+    are still waiting, go to a ``PublishOutbox`` to be retried in the
+    background by ``priorities`` class, so callers never wait for the
+    broker to come back.
+    ``confirm`` is called with each message once the exchange has accepted
+    it.
+    """
+
+    def __init__(self, logger, pulse_cfg, publisher_class=None,
+                 overflow_path=None, confirm=None, priorities=None):
+        self.logger = logger
+        self.pulse_cfg = pulse_cfg
+        self.publisher_class = publisher_class
+        self.confirm = confirm
+        self.outbox = PublishOutbox(self.publish_once, logger,
+                                    overflow_path=overflow_path,
+                                    priorities=priorities)
+        # The worker is only needed once a publish fails, or to resume the
+        # backlog of a previous run.
+        if self.outbox.backlog:
+            self.start_outbox()
+
+    def start_outbox(self):
+        with self.outbox.condition:
+            if self.outbox.ident is None:
+                self.outbox.start()
+
+    def publish_once(self, message):
+        if self.publisher_class is None:
+            from mozillapulse.publishers import NormalizedBuildPublisher
+            self.publisher_class = NormalizedBuildPublisher
+        publish_message(self.publisher_class, message, self.pulse_cfg)
+        if self.confirm:
+            self.confirm(message)
+
+    def publish(self, message):
+        if not self.outbox.backlog:
+            try:
+                self.publish_once(message)
+                return
+            except Exception:
+                self.logger.exception('Failure when publishing %s' %
+                                      message.routing_key)
+        self.start_outbox()
+        self.outbox.add(message)
+
+
+class FileSink(object):
+    """Append messages to a file, one JSON object per line."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def publish(self, message):
+        self.publish_batch([message])
+
+    def publish_batch(self, messages):
+        with open(self.path, 'a') as f:
+            f.write(encode_ndjson(messages))
+
+
+class HTTPSink(object):
+    """POST batches of messages as newline delimited JSON to a url."""
+
+    def __init__(self, url, timeout=30):
+        self.url = url
+        self.timeout = timeout
+
+    def publish(self, message):
+        self.publish_batch([message])
+
+    def publish_batch(self, messages):
+        import requests
+
+        resp = requests.post(self.url, data=encode_ndjson(messages),
+                             headers={'Content-Type': 'application/x-ndjson'},
+                             timeout=self.timeout)
+        resp.raise_for_status()
+
+
+class BackgroundSink(threading.Thread):
+    """Run a sink on its own thread with a bounded buffer.
+
+    Messages are written in batches of up to ``batch_size``. A failing
+    batch is retried with exponential backoff from ``min_backoff`` up to
+    ``max_backoff`` seconds while new messages keep being buffered; once
+    the buffer is full, further messages for this sink are dropped and
+    counted. After
+    ``max_attempts`` failures in a row the batch is logged and dropped, so
+    that a message the sink refuses cannot hold up the rest. Sinks
+    written one message at a time resume after the last message written.
+    """
+
+    def __init__(self, sink, logger, maxsize=10000, batch_size=100,
+                 min_backoff=1, max_backoff=60, max_attempts=8):
+        threading.Thread.__init__(self, name='Sink-%s' %
+                                  sink.__class__.__name__)
+        self.daemon = True
+        self.sink = sink
+        self.logger = logger
+        self.queue = Queue.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.dropped = 0
+        self.failed = 0
+
+    def publish(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except Queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout):
+        """Wait up to ``timeout`` seconds for buffered messages to be
+        written and return how many are still outstanding.
+        """
+        deadline = time.time() + timeout
+        # Messages count as unfinished until written or dropped.
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+        return self.queue.unfinished_tasks
+
+    def next_batch(self):
+        items = [self.queue.get()]
+        while len(items) < self.batch_size:
+            try:
+                items.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        return items
+
+    def write(self, items):
+        """Write ``items``, removing each from the list once written."""
+        if hasattr(self.sink, 'publish_batch'):
+            self.sink.publish_batch(items)
+            del items[:]
+        else:
+            while items:
+                self.sink.publish(items[0])
+                del items[0]
+
+    def run(self):
+        while True:
+            items = self.next_batch()
+            count = len(items)
+            backoff = self.min_backoff
+            attempts = 0
+            while items:
+                left = len(items)
+                try:
+                    self.write(items)
+                    break
+                except Exception:
+                    if len(items) < left:
+                        attempts, backoff = 0, self.min_backoff
+                    attempts += 1
+                    if attempts >= self.max_attempts:
+                        self.failed += len(items)
+                        self.logger.exception(
+                            'Failure when writing %d messages to %s, '
+                            'dropping them after %d attempts',
+                            len(items), self.name, attempts)
+                        break
+                    self.logger.exception('Failure when writing %d messages '
+                                          'to %s', len(items), self.name)
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+            for i in range(count):
+                self.queue.task_done()
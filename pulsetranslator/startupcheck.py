@@ -0,0 +1,91 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Startup time budget check for one-shot translator runs.
+
+Runs `runservice.py --display-only --push-message` in fresh interpreters
+and compares the median wall time against that of an empty interpreter.
+Exits non-zero if the overhead exceeds the budget, or if importing the
+translator eagerly pulls in one of the network stacks.
+"""
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_MESSAGE = os.path.join(HERE, os.pardir, 'test', 'pulse_messages',
+                               'mozilla-central',
+                               'build.mozilla-central-linux.98.log_uploaded')
+
+LAZY_MODULES = ['dateutil', 'kombu', 'mozillapulse', 'requests']
+
+
+def median_runtime(args, runs):
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            subprocess.check_call(args, stdout=devnull, cwd=HERE)
+            timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def eager_imports():
+    output = subprocess.check_output(
+        [sys.executable, '-c',
+         'import sys, runservice; '
+         'print "\\n".join(sorted(set(m.split(".")[0] for m in sys.modules)))'],
+        cwd=HERE)
+    loaded = output.split()
+    return [name for name in LAZY_MODULES if name in loaded]
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--budget', dest='budget', type='float', default=150,
+                      help='allowed startup overhead in milliseconds')
+    parser.add_option('--runs', dest='runs', type='int', default=5,
+                      help='number of runs to take the median of')
+    parser.add_option('--push-message', dest='message',
+                      default=DEFAULT_MESSAGE,
+                      help='path to file of a Pulse message to process')
+    options, args = parser.parse_args()
+
+    failed = False
+
+    eager = eager_imports()
+    if eager:
+        print 'Modules imported eagerly: %s' % ', '.join(eager)
+        failed = True
+
+    logdir = tempfile.mkdtemp()
+    try:
+        baseline = median_runtime([sys.executable, '-c', 'pass'],
+                                  options.runs)
+        translator = median_runtime(
+            [sys.executable, 'runservice.py', '--display-only',
+             '--logdir', logdir, '--push-message',
+             os.path.abspath(options.message)],
+            options.runs)
+    finally:
+        shutil.rmtree(logdir)
+
+    overhead = (translator - baseline) * 1000
+    print 'Startup overhead: %.1f ms (budget %.1f ms)' % (overhead,
+                                                           options.budget)
+    if overhead > options.budget:
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
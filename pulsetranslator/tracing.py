@@ -0,0 +1,238 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Latency tracing of normalized messages, from job end to publish.
+
+Every normalized message carries a trace: a JSON serializable dict with the
+times at which it passed each of ``STAGES``, so that it survives the
+pending spill database and the pending file. Once the exchange accepts the
+message, or translation gives up on it, the trace is rolled up into
+latency percentiles by tree and message kind and, if span sinks are
+configured, written out as a span in the JSON encoding of OpenTelemetry
+(OTLP), with one event per stage.
+"""
+
+import calendar
+import collections
+import json
+import os
+import re
+import threading
+import time
+
+from priorities import LatencyStats
+from sinks import BackgroundSink
+
+# 'finished': the job ended, by buildbot; 'sent': its pulse message was
+# published; 'received': the translator got the message; 'parsed': it was
+# normalized; 'first_probe': its log was first looked for; 'log_ready': the
+# log was complete; 'published': the exchange accepted the normalized
+# message.
+STAGES = ('finished', 'sent', 'received', 'parsed', 'first_probe',
+          'log_ready', 'published')
+
+# OTLP span kind and status codes
+SPAN_KIND_CONSUMER = 5
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+iso_time = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.\d+)?'
+                      r'(?:([+-])(\d\d):?(\d\d)|Z)?$')
+
+
+def parse_time(value):
+    """Return seconds since the epoch of a buildbot or pulse time stamp,
+    which is either a number or ISO 8601 with an optional UTC offset, or
+    None if it is neither.
+    """
+    if isinstance(value, (int, long, float)):
+        return float(value)
+    match = iso_time.match(value or '')
+    if not match:
+        return None
+    seconds = calendar.timegm(time.strptime(match.group(1),
+                                            '%Y-%m-%dT%H:%M:%S'))
+    if match.group(2):
+        offset = int(match.group(3)) * 3600 + int(match.group(4)) * 60
+        seconds -= offset if match.group(2) == '+' else -offset
+    return float(seconds)
+
+
+def attribute(key, value):
+    return {'key': key, 'value': {'stringValue': value or ''}}
+
+
+def to_span(trace, service):
+    stages = trace['stages']
+    events = sorted((when, stage) for stage, when in stages.iteritems())
+    span = {'traceId': trace['trace_id'],
+            'spanId': trace['span_id'],
+            'name': 'translate %s' % trace.get('kind'),
+            'kind': SPAN_KIND_CONSUMER,
+            'startTimeUnixNano': str(int(events[0][0] * 1e9)),
+            'endTimeUnixNano': str(int(events[-1][0] * 1e9)),
+            'attributes': [attribute('service.name', service),
+                           attribute('pulse.routing_key', trace['key']),
+                           attribute('build.tree', trace.get('tree')),
+                           attribute('build.kind', trace.get('kind'))],
+            'events': [{'name': stage, 'timeUnixNano': str(int(when * 1e9))}
+                       for when, stage in events],
+            'status': {'code': STATUS_OK}}
+    if trace.get('deduplicated'):
+        span['attributes'].append(attribute('translator.outcome',
+                                            'deduplicated'))
+    if trace.get('error'):
+        span['status'] = {'code': STATUS_ERROR, 'message': trace['error']}
+    return span
+
+
+class SpanFileSink(object):
+    """Append spans to a file, one JSON object per line."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def publish(self, span):
+        self.publish_batch([span])
+
+    def publish_batch(self, spans):
+        with open(self.path, 'a') as f:
+            f.write(''.join(json.dumps(span) + '\n' for span in spans))
+
+
+class OTLPSink(object):
+    """POST batches of spans to the OTLP/HTTP JSON endpoint of a
+    collector, e.g. http://localhost:4318/v1/traces.
+    """
+
+    def __init__(self, url, service, timeout=30):
+        self.url = url
+        self.service = service
+        self.timeout = timeout
+
+    def publish(self, span):
+        self.publish_batch([span])
+
+    def publish_batch(self, spans):
+        import requests
+
+        body = {'resourceSpans': [{
+            'resource': {'attributes': [attribute('service.name',
+                                                  self.service)]},
+            'scopeSpans': [{'scope': {'name': 'pulsetranslator'},
+                            'spans': spans}]}]}
+        resp = requests.post(self.url, data=json.dumps(body),
+                             headers={'Content-Type': 'application/json'},
+                             timeout=self.timeout)
+        resp.raise_for_status()
+
+
+class Tracer(object):
+    """Start, mark and complete the traces of messages.
+
+    Latencies are kept per tree and kind for every stage, as the seconds
+    since the previous stage the message passed, and for 'total', the
+    seconds from the first stage to the last.
+    """
+
+    def __init__(self, logger=None, sinks=None, service='pulsetranslator',
+                 window=200):
+        self.service = service
+        self.window = window
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.deduplicated = 0
+        self.failed = 0
+        # 'tree/kind' -> stage -> LatencyStats
+        self.rollups = {}
+        self.sinks = []
+        for sink in sinks or []:
+            background = BackgroundSink(sink, logger)
+            background.start()
+            self.sinks.append(background)
+
+    def start(self, data, now=None):
+        """Return the trace of a raw pulse message received ``now``."""
+        meta = data.get('_meta') or {}
+        build = (data.get('payload') or {}).get('build') or {}
+        stages = {'received': now or time.time()}
+        times = build.get('times') or []
+        for stage, value in [('finished', times[1] if len(times) > 1
+                              else None),
+                             ('sent', meta.get('sent'))]:
+            when = parse_time(value) if value is not None else None
+            if when is not None:
+                stages[stage] = when
+        return {'trace_id': os.urandom(16).encode('hex'),
+                'key': meta.get('routing_key'),
+                'stages': stages}
+
+    def child(self, trace, kind, data):
+        """Return the trace of one normalized message of a pulse message."""
+        return {'trace_id': trace['trace_id'],
+                'span_id': os.urandom(8).encode('hex'),
+                'key': trace['key'],
+                'kind': kind,
+                'tree': data.get('tree'),
+                'stages': dict(trace['stages'])}
+
+    def mark(self, trace, stage, now=None):
+        """Record that a message passed ``stage``, unless it did before."""
+        if trace is not None and stage not in trace['stages']:
+            trace['stages'][stage] = now or time.time()
+
+    def finish(self, trace, now=None, error=None, deduplicated=False):
+        """Complete a trace, as published unless given an ``error``, or
+        ``deduplicated`` if another instance published the message.
+        """
+        if trace is None:
+            return
+        if deduplicated:
+            trace['deduplicated'] = True
+        elif error is None:
+            self.mark(trace, 'published', now)
+        else:
+            trace['error'] = error
+        stages = sorted((when, stage) for stage, when
+                        in trace['stages'].iteritems())
+
+        name = '%s/%s' % (trace.get('tree'), trace.get('kind'))
+        with self.lock:
+            if deduplicated:
+                self.deduplicated += 1
+            elif error is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+            rollup = self.rollups.get(name)
+            if rollup is None:
+                rollup = self.rollups[name] = collections.defaultdict(
+                    lambda: LatencyStats(self.window))
+            if error is None and not deduplicated:
+                for (previous, _), (when, stage) in zip(stages, stages[1:]):
+                    rollup[stage].add(when - previous)
+                rollup['total'].add(stages[-1][0] - stages[0][0])
+
+        if self.sinks:
+            span = to_span(trace, self.service)
+            for sink in self.sinks:
+                sink.publish(span)
+
+    def stats(self):
+        with self.lock:
+            return {'completed': self.completed,
+                    'deduplicated': self.deduplicated,
+                    'failed': self.failed,
+                    'latency': dict(
+                        (name, dict((stage, stats.stats()) for stage, stats
+                                    in rollup.iteritems()))
+                        for name, rollup in self.rollups.iteritems())}
+
+    def flush(self, timeout):
+        """Give span sinks up to ``timeout`` seconds to write what they
+        buffered and return the number of spans left unwritten.
+        """
+        deadline = time.time() + timeout
+        return sum(sink.flush(max(0, deadline - time.time()))
+                   for sink in self.sinks)
@@ -77,3 +77,8 @@ class LogTimeoutError(Exception):
 
     def __str__(self):
         return "key: %s, url: %s" % (self.key, self.logurl)
+
+class ShutdownRequested(Exception):
+
+    def __str__(self):
+        return "translator shutdown requested"
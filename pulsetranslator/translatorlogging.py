@@ -0,0 +1,195 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Queue-backed logging for the translator.
+
+Records are handed to a background writer thread, so neither JSON
+serialization nor file writes and rotation happen inside the pulse
+callback. Repeated errors are rate limited before they are
+queued at all.
+"""
+
+import collections
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import Queue
+import threading
+import time
+
+
+class JSONFormatter(logging.Formatter):
+    """Format a record as a single line of JSON.
+
+    Non-string messages (e.g. the dict of a failed pulse message) are
+    embedded as structured ``data`` rather than as their repr.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.utcfromtimestamp(
+                record.created).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'level': record.levelname,
+            'logger': record.name,
+        }
+
+        if isinstance(record.msg, basestring):
+            entry['message'] = record.getMessage()
+        else:
+            entry['data'] = record.msg
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            entry['suppressed'] = suppressed
+
+        return json.dumps(entry, default=repr)
+
+
+class RateLimitFilter(logging.Filter):
+    """Limit how often similar errors are logged.
+
+    Records sharing a key (logger, level and exception class, or message
+    template) are passed through ``burst`` times per ``interval`` seconds.
+    After that only every ``sample``-th record is let through and carries
+    the number of records suppressed in between. Keys unused for an
+    interval are forgotten, and at most ``maxkeys`` are kept, least
+    recently used first out.
+    """
+
+    def __init__(self, burst=10, interval=60, sample=100, maxkeys=1000):
+        logging.Filter.__init__(self)
+        self.burst = burst
+        self.interval = interval
+        self.sample = sample
+        self.maxkeys = maxkeys
+        self.lock = threading.Lock()
+        self.counters = collections.OrderedDict()
+
+    def get_key(self, record):
+        if record.exc_info and record.exc_info[0]:
+            # Not the exception text, which names the message or url, so
+            # that a flood of bad messages counts as one error.
+            return (record.name, record.levelno, record.exc_info[0])
+        if isinstance(record.msg, basestring):
+            return (record.name, record.levelno, record.msg)
+        return (record.name, record.levelno, type(record.msg))
+
+    def filter(self, record):
+        key = self.get_key(record)
+        now = time.time()
+
+        with self.lock:
+            window_start, seen, suppressed = self.counters.pop(key,
+                                                               (now, 0, 0))
+            if now - window_start > self.interval:
+                window_start, seen = now, 0
+            seen += 1
+
+            if seen <= self.burst or seen % self.sample == 0:
+                record.suppressed = suppressed
+                suppressed = 0
+                allow = True
+            else:
+                suppressed += 1
+                allow = False
+
+            # Least recently used keys come first.
+            while self.counters and (
+                    len(self.counters) >= self.maxkeys or
+                    now - next(self.counters.itervalues())[0] >
+                    self.interval):
+                self.counters.popitem(last=False)
+            self.counters[key] = (window_start, seen, suppressed)
+
+        return allow
+
+
+class LogWriter(threading.Thread):
+    """Background thread draining queued records into real handlers."""
+
+    def __init__(self, maxsize=10000):
+        threading.Thread.__init__(self, name='LogWriter')
+        self.daemon = True
+        self.queue = Queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def put(self, handler, record):
+        try:
+            self.queue.put_nowait((handler, record))
+        except Queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        return {'queued': self.queue.qsize(),
+                'dropped': self.dropped}
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            handler, record = item
+            try:
+                handler.handle(record)
+            except Exception:
+                handler.handleError(record)
+
+    def stop(self, timeout=5):
+        """Flush pending records and stop the writer thread."""
+        if not self.is_alive():
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Queue.Full:
+            return
+        self.join(timeout)
+
+
+class DeferredRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotating file handler which creates its file, and the directory
+    holding it, when the first record is written rather than up front.
+    """
+
+    def __init__(self, filename, **kwargs):
+        kwargs['delay'] = True
+        logging.handlers.RotatingFileHandler.__init__(self, filename,
+                                                      **kwargs)
+
+    def _open(self):
+        dirname = os.path.dirname(self.baseFilename)
+        if not os.access(dirname, os.F_OK):
+            os.makedirs(dirname)
+        return logging.handlers.RotatingFileHandler._open(self)
+
+
+class QueueHandler(logging.Handler):
+    """Forward records to a ``LogWriter`` for a wrapped target handler."""
+
+    def __init__(self, writer, target):
+        logging.Handler.__init__(self)
+        self.writer = writer
+        self.target = target
+
+    def prepare(self, record):
+        # Tracebacks have to be rendered in the calling thread while the
+        # frames are still alive; everything else is deferred.
+        if record.exc_info:
+            record.exc_text = self.target.formatter.formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.writer.put(self.target, self.prepare(record))
+        except Exception:
+            self.handleError(record)
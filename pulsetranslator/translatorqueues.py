@@ -2,44 +2,322 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import datetime
+import collections
+import glob
+import heapq
+import itertools
+import json
+import os
+import threading
 import time
 
-from mozillapulse.messages.base import GenericMessage
-
-
-def publish_message(publisherClass, logger, data, routing_key, pulse_cfg):
-    assert(isinstance(data, dict))
-
-    msg = GenericMessage()
-    msg.routing_parts = routing_key.split('.')
-    for key, value in data.iteritems():
-        msg.set_data(key, value)
-
-    failures = []
-    while True:
-        try:
-            publisher = publisherClass(connect=False)
-            if pulse_cfg:
-                publisher.config = pulse_cfg
-            publisher.publish(msg)
-            break
-        except Exception:
-            now = datetime.datetime.now()
-            logger.exception('Failure when publishing %s' % routing_key)
-
-            failures = [x for x in failures
-                        if now - x < datetime.timedelta(seconds=60)]
-            failures.append(now)
-
-            if len(failures) >= 5:
-                logger.warning('%d publish failures within one minute.'
-                               % len(failures))
-                failures = []
-                sleep_time = 5 * 60
+from messageencoder import EncodedMessage
+from pendingstore import Lane
+from priorities import PriorityClasses
+
+def publish_encoded(publisher, message):
+    """Publish the already encoded payload of a message with a mozillapulse
+    publisher, in the envelope ``GenericPublisher.publish`` would build.
+    """
+    from datetime import datetime
+
+    from kombu import Exchange, Producer
+    from mozillapulse.utils import time_to_string
+    from pytz import timezone
+
+    if not message.routing_key or '..' in message.routing_key:
+        raise ValueError('invalid routing key %r' % message.routing_key)
+
+    meta = {'exchange': publisher.exchange,
+            'routing_key': message.routing_key,
+            'serializer': 'json',
+            'sent': time_to_string(datetime.now(
+                timezone(publisher.config.broker_timezone)))}
+    body = '{"payload": %s, "_meta": %s}' % (message.payload,
+                                              json.dumps(meta))
+
+    publisher.connect()
+    producer = Producer(channel=publisher.connection,
+                        exchange=Exchange(publisher.exchange, type='topic'),
+                        routing_key=message.routing_key)
+    producer.publish(body, content_type='application/json',
+                     content_encoding='utf-8')
+
+
+def publish_message(publisherClass, message, pulse_cfg):
+    """Make a single attempt at publishing an ``EncodedMessage``.
+
+    Exceptions from the publisher are passed on to the caller.
+    """
+    from mozillapulse.messages.base import GenericMessage
+    from mozillapulse.publishers import GenericPublisher
+
+    publisher = publisherClass(connect=False)
+    try:
+        if pulse_cfg:
+            publisher.config = pulse_cfg
+        if (isinstance(publisher, GenericPublisher) and
+                publisher.config.serializer == 'json'):
+            publish_encoded(publisher, message)
+            return
+
+        msg = GenericMessage()
+        msg.routing_parts = message.routing_key.split('.')
+        for key, value in message.data.iteritems():
+            msg.set_data(key, value)
+        publisher.publish(msg)
+    finally:
+        if hasattr(publisher, 'disconnect'):
+            publisher.disconnect()
+
+
+class PublishOutbox(threading.Thread):
+    """Retry queue for messages which failed to publish.
+
+    Messages are retried by a worker thread, in order within each of the
+    ``priorities`` classes, and classes are served by weighted fair
+    queuing like the messages waiting for their log. A message which fails
+    goes to the back of its class and the next one is tried right away;
+    only failures in a row, as during an outage, make the worker wait, for
+    ``min_backoff`` seconds doubling up to ``max_backoff``. Up to
+    ``maxsize`` messages are kept in memory; beyond that they are appended
+    to segments of ``maxsize`` messages, ``overflow_path`` followed by a
+    sequence number, which are read back and removed one at a time as the
+    backlog shrinks. Without an overflow path they are dropped.
+    """
+
+    def __init__(self, publish, logger, maxsize=1000, overflow_path=None,
+                 min_backoff=1, max_backoff=300, priorities=None):
+        threading.Thread.__init__(self, name='PublishOutbox')
+        self.daemon = True
+        self.publish = publish
+        self.logger = logger
+        self.maxsize = maxsize
+        self.overflow_path = overflow_path
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.priorities = priorities or PriorityClasses()
+
+        self.condition = threading.Condition()
+        # class name -> Lane, whose heap holds (sequence, message)
+        self.lanes = {}
+        self.sequence = itertools.count()
+        self.in_memory = 0
+        # virtual time of the last message attempted
+        self.clock = 0.0
+        # [path, messages] of the overflow segments, oldest first
+        self.segments = collections.deque()
+        self.overflow = 0
+        self.backoff = min_backoff
+        # failed attempts since the last success
+        self.failed_in_row = 0
+        self.next_attempt = 0
+        self.backlog_since = None
+        self.attempting = False
+        # (sequence, message) of the attempt in progress, counted in
+        # in_memory but out of its lane
+        self.current = None
+        self.stopped = False
+
+        self.published = 0
+        self.failures = 0
+        self.dropped = 0
+
+        # Resume overflow segments left behind by a previous run; the
+        # unnumbered file is one from before there were segments.
+        if overflow_path:
+            numbered = [path for path in glob.glob(overflow_path + '.*')
+                        if path.rsplit('.', 1)[1].isdigit()]
+            numbered.sort(key=lambda path: int(path.rsplit('.', 1)[1]))
+            if os.path.exists(overflow_path):
+                numbered.insert(0, overflow_path)
+            for path in numbered:
+                with open(path) as f:
+                    self.segments.append([path, sum(1 for line in f)])
+            self.overflow = sum(count for path, count in self.segments)
+            if self.overflow:
+                self.backlog_since = time.time()
+
+    @property
+    def backlog(self):
+        return self.in_memory + self.overflow
+
+    def stats(self):
+        with self.condition:
+            return {'backlog': self.backlog,
+                    'in_memory': self.in_memory,
+                    'lanes': dict((name, len(lane.heap)) for name, lane
+                                  in self.lanes.iteritems()),
+                    'on_disk': self.overflow,
+                    'published': self.published,
+                    'failures': self.failures,
+                    'dropped': self.dropped,
+                    'attempting': self.attempting,
+                    'backoff': self.backoff,
+                    'retry_in': (max(0, self.next_attempt - time.time())
+                                 if self.in_memory else None),
+                    'backlog_seconds': (time.time() - self.backlog_since
+                                        if self.backlog_since else 0)}
+
+    def retry_now(self):
+        """Cut the current backoff short."""
+        with self.condition:
+            self.next_attempt = 0
+            self.condition.notify()
+
+    def add(self, message):
+        with self.condition:
+            if not self.backlog:
+                # Publishing the message just failed; retry it once right
+                # away and back off if that fails too.
+                self.backlog_since = time.time()
+                self.failed_in_row = 1
+                self.next_attempt = 0
+            if not self.overflow and self.in_memory < self.maxsize:
+                self.enqueue(message)
+            elif self.overflow_path:
+                self.spill(message)
             else:
-                sleep_time = 5
+                self.dropped += 1
+                self.logger.error('Publish backlog full, dropping %s.',
+                                  message.routing_key)
+            self.condition.notify()
+
+    def enqueue(self, message):
+        """Put a message at the back of its class."""
+        name = self.priorities.classify(message.data)
+        lane = self.lanes.get(name)
+        if lane is None:
+            lane = self.lanes[name] = Lane(self.priorities.weight(name))
+        heapq.heappush(lane.heap, (next(self.sequence), message))
+        self.in_memory += 1
+
+    def next_lane(self):
+        """Return the lane to attempt next, by weighted fair queuing, and
+        charge it for the attempt.
+        """
+        start, name, lane = min(
+            (max(lane.finish, self.clock), name, lane)
+            for name, lane in self.lanes.iteritems() if lane.heap)
+        self.clock = start
+        lane.finish = start + 1.0 / lane.weight
+        return lane
+
+    def spill(self, message):
+        """Append a message to the newest overflow segment."""
+        if not self.segments or self.segments[-1][1] >= self.maxsize:
+            dirname = os.path.dirname(self.overflow_path)
+            if dirname and not os.access(dirname, os.F_OK):
+                os.makedirs(dirname)
+            number = (int(self.segments[-1][0].rsplit('.', 1)[1]) + 1
+                      if self.segments and
+                      self.segments[-1][0] != self.overflow_path else 0)
+            self.segments.append(['%s.%d' % (self.overflow_path, number), 0])
+        segment = self.segments[-1]
+        with open(segment[0], 'a') as f:
+            f.write('{"routing_key": %s, "trace": %s, "data": %s}\n' % (
+                json.dumps(message.routing_key), json.dumps(message.trace),
+                message.payload))
+        segment[1] += 1
+        self.overflow += 1
+
+    def refill(self):
+        """Move the oldest overflow segment back into memory."""
+        path, count = self.segments.popleft()
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                self.enqueue(EncodedMessage(
+                    record['routing_key'], record['data'],
+                    json.dumps(record['data']), record.get('trace')))
+        os.remove(path)
+        self.overflow -= count
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.in_memory and self.overflow:
+                    self.refill()
+                while not self.stopped and (
+                        not self.in_memory or
+                        time.time() < self.next_attempt):
+                    if self.in_memory:
+                        self.condition.wait(self.next_attempt - time.time())
+                    else:
+                        # add() and drain() notify.
+                        self.condition.wait()
+                if self.stopped:
+                    return
+                lane = self.next_lane()
+                self.current = heapq.heappop(lane.heap)
+                message = self.current[1]
+                self.attempting = True
+
+            try:
+                self.publish(message)
+            except Exception:
+                with self.condition:
+                    self.attempting = False
+                    self.current = None
+                    self.failures += 1
+                    self.failed_in_row += 1
+                    # Let the messages behind it go first.
+                    heapq.heappush(lane.heap, (next(self.sequence), message))
+                    delay = 0
+                    if self.failed_in_row > 1:
+                        delay = self.backoff
+                        self.backoff = min(self.backoff * 2,
+                                           self.max_backoff)
+                    self.next_attempt = time.time() + delay
+                    self.logger.exception(
+                        'Retry of %s failed, %d messages waiting to be '
+                        'published; next attempt in %d seconds.',
+                        message.routing_key, self.backlog, delay)
+                continue
+
+            with self.condition:
+                self.attempting = False
+                self.current = None
+                self.in_memory -= 1
+                self.published += 1
+                self.failed_in_row = 0
+                self.backoff = self.min_backoff
+                if not self.backlog:
+                    self.logger.warning(
+                        'Publish backlog cleared after %d seconds.',
+                        time.time() - self.backlog_since)
+                    self.backlog_since = None
+
+    def drain(self, timeout):
+        """Retry for up to ``timeout`` seconds, then stop the worker and
+        return the messages which are still unpublished.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            self.next_attempt = 0
+            self.condition.notify()
+        while self.backlog and time.time() < deadline:
+            time.sleep(0.05)
 
-            logger.warning('Sleeping for %d seconds.' % sleep_time)
-            time.sleep(sleep_time)
-            logger.warning('Retrying...')
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+            # Let an attempt in progress finish, so its message is neither
+            # lost nor published twice.
+            while self.attempting and time.time() < deadline + 0.5:
+                self.condition.wait(0.05)
+            while self.overflow:
+                self.refill()
+            entries = [entry for lane in self.lanes.itervalues()
+                       for entry in lane.heap]
+            if self.current:
+                # The attempt did not finish in time.
+                entries.append(self.current)
+            entries.sort()
+            remaining = [{'data': message.data,
+                          'routing_key': message.routing_key,
+                          'trace': message.trace}
+                         for sequence, message in entries]
+            self.lanes.clear()
+            self.in_memory = 0
+        return remaining
@@ -0,0 +1,105 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Split buildbot routing keys into tree, platform and suffix.
+
+Builder names are plain concatenations like
+``release-mozilla-beta-macosx64_repack_2`` where nothing but knowledge of
+the existing trees tells where the tree name ends. ``TreeIndex`` keeps
+tries of known tree and platform names, seeded from messageparams and
+configuration and extended with every tree seen in a ``branch`` property,
+so a key can be split without first scanning the message properties.
+"""
+
+import collections
+
+RoutingKey = collections.namedtuple('RoutingKey', ['prefix', 'tree',
+                                                   'platform', 'suffix',
+                                                   'number', 'event'])
+
+SEPARATORS = '-_'
+
+
+class Trie(object):
+
+    def __init__(self, words=()):
+        self.root = {}
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        node = self.root
+        for char in word:
+            node = node.setdefault(char, {})
+        # None can never be a character, so it marks the end of a word.
+        node[None] = word
+
+    def __contains__(self, word):
+        node = self.root
+        for char in word:
+            node = node.get(char)
+            if node is None:
+                return False
+        return None in node
+
+    def match(self, string, start=0):
+        """Return the longest word at ``start`` of ``string`` which is
+        followed by a separator or the end of the string, or None.
+        """
+        node = self.root
+        longest = None
+        for pos in xrange(start, len(string)):
+            node = node.get(string[pos])
+            if node is None:
+                return longest
+            if None in node and (pos + 1 == len(string) or
+                                 string[pos + 1] in SEPARATORS):
+                longest = node[None]
+        return longest
+
+
+class TreeIndex(object):
+
+    # Builder name prefixes which precede the tree name, see the
+    # classification regexes in PulseBuildbotTranslator.
+    PREFIXES = ('release-', 'jetpack-', 'b2g_')
+
+    def __init__(self, trees=(), platforms=()):
+        self.trees = Trie(trees)
+        self.platforms = Trie(platforms)
+
+    def learn(self, tree):
+        if tree and tree not in self.trees:
+            self.trees.add(tree)
+
+    def split(self, key):
+        """Return a ``RoutingKey`` for a buildbot routing key, or None if
+        the key does not start with a known tree.
+        """
+        parts = key.split('.')
+        if len(parts) < 4 or parts[0] != 'build':
+            return None
+        builder = '.'.join(parts[1:-2])
+
+        prefix = ''
+        tree = self.trees.match(builder)
+        if tree is None:
+            for candidate in self.PREFIXES:
+                if builder.startswith(candidate):
+                    tree = self.trees.match(builder, len(candidate))
+                    if tree is not None:
+                        prefix = candidate
+                        break
+            if tree is None:
+                return None
+
+        pos = len(prefix) + len(tree) + 1
+        if builder.startswith('xulrunner', pos):
+            pos += len('xulrunner') + 1
+        platform = self.platforms.match(builder, pos)
+        if platform is not None:
+            pos += len(platform) + 1
+
+        return RoutingKey(prefix, tree, platform, builder[pos:], parts[-2],
+                          parts[-1])
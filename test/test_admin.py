@@ -0,0 +1,114 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import httplib
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from pulsetranslator.admin import AdminServer, parse_address
+
+
+class ParseAddressTest(unittest.TestCase):
+
+    def test_local_addresses(self):
+        self.assertEqual(parse_address('8765'), ('tcp', ('127.0.0.1', 8765)))
+        self.assertEqual(parse_address('localhost:8765'),
+                         ('tcp', ('localhost', 8765)))
+        self.assertEqual(parse_address('127.0.0.2:8765'),
+                         ('tcp', ('127.0.0.2', 8765)))
+        self.assertEqual(parse_address('/run/translator.sock'),
+                         ('unix', '/run/translator.sock'))
+
+    def test_other_hosts_are_refused(self):
+        for address in ['0.0.0.0:8765', '10.0.0.1:8765', 'example.com:8765']:
+            self.assertRaises(ValueError, parse_address, address)
+
+
+class FakeLogHandler(object):
+
+    def __init__(self):
+        self.dropped = []
+
+    def drop(self, pattern):
+        self.dropped.append(pattern)
+        return 1, 0
+
+
+class FakeTranslator(object):
+
+    def __init__(self):
+        self.loghandler = FakeLogHandler()
+
+    def status(self):
+        return {'consumer': 'connected'}
+
+
+class AdminServerTest(unittest.TestCase):
+
+    def setUp(self):
+        logger = logging.getLogger('AdminServerTest')
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+        self.tmpdir = tempfile.mkdtemp()
+        self.translator = FakeTranslator()
+        self.servers = []
+        self.logger = logger
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def serve(self, address):
+        server = AdminServer(self.translator, address, self.logger)
+        server.start()
+        self.servers.append(server)
+        return server
+
+    def request(self, method, path, headers):
+        server = self.serve('0')
+        connection = httplib.HTTPConnection(*server.server.server_address)
+        connection.putrequest(method, path, skip_host=True)
+        for name, value in headers.iteritems():
+            connection.putheader(name, value)
+        connection.endheaders()
+        response = connection.getresponse()
+        body = json.loads(response.read())
+        connection.close()
+        return response.status, body
+
+    def test_local_requests_are_served(self):
+        status, body = self.request('GET', '/status',
+                                    {'Host': 'localhost:8765'})
+        self.assertEqual((status, body), (200, {'consumer': 'connected'}))
+        status, body = self.request('POST', '/drop?key=build.*',
+                                    {'Host': '127.0.0.1:8765',
+                                     'X-Admin-Request': '1'})
+        self.assertEqual(status, 200)
+        self.assertEqual(self.translator.loghandler.dropped, ['build.*'])
+
+    def test_rebound_host_is_refused(self):
+        status, body = self.request('GET', '/status',
+                                    {'Host': 'attacker.example:8765'})
+        self.assertEqual(status, 403)
+
+    def test_post_without_header_is_refused(self):
+        status, body = self.request('POST', '/drop?key=*',
+                                    {'Host': 'localhost:8765'})
+        self.assertEqual(status, 403)
+        self.assertEqual(self.translator.loghandler.dropped, [])
+
+    def test_unix_socket_is_private(self):
+        path = os.path.join(self.tmpdir, 'admin.sock')
+        self.serve(path)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0600)
+
+
+if __name__ == '__main__':
+    unittest.main()
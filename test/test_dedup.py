@@ -0,0 +1,97 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from pulsetranslator.dedup import PublishDedup, SQLiteStore
+from pulsetranslator.messageencoder import EncodedMessage
+from pulsetranslator.translatorqueues import PublishOutbox
+
+
+class BrokerDown(object):
+    """Fail to publish until ``up`` is set, then confirm to ``dedup``."""
+
+    def __init__(self, dedup):
+        self.dedup = dedup
+        self.up = False
+        self.published = []
+
+    def __call__(self, message):
+        if not self.up:
+            raise IOError('simulated broker outage')
+        self.published.append(message)
+        self.dedup.published(message)
+
+
+class PublishDedupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = SQLiteStore(os.path.join(self.tmpdir, 'dedup.sqlite'))
+        self.logger = logging.getLogger('PublishDedupTest')
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.propagate = False
+        data = {'buildid': '20140101000000', 'key': 'build.mozilla-central.1',
+                'locale': None}
+        self.message = EncodedMessage('build.mozilla-central.linux.opt', data,
+                                      json.dumps(data))
+
+        self.instances = []
+
+    def tearDown(self):
+        for dedup in self.instances:
+            dedup.close(1)
+        shutil.rmtree(self.tmpdir)
+
+    def dedup(self, owner, lease):
+        dedup = PublishDedup(self.store, owner, self.logger, lease=lease)
+        self.instances.append(dedup)
+        return dedup
+
+    def test_claim_held_while_publish_fails(self):
+        lease = 0.3
+        first = self.dedup('a', lease)
+        second = self.dedup('b', lease)
+        broker = BrokerDown(first)
+        outbox = PublishOutbox(broker, self.logger, min_backoff=60)
+
+        self.assertTrue(first.claim(self.message))
+        outbox.add(self.message)
+        outbox.start()
+        # The outbox backs off for much longer than the lease.
+        time.sleep(lease * 4)
+        self.assertEqual(broker.published, [])
+        self.assertEqual(second.claim(self.message), None)
+        self.assertTrue(first.stats()['renewed'] >= 2)
+
+        broker.up = True
+        outbox.retry_now()
+        deadline = time.time() + 5
+        while outbox.backlog and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(broker.published, [self.message])
+        self.assertEqual(second.claim(self.message), False)
+        self.assertEqual(first.stats()['held'], 0)
+        outbox.drain(0)
+
+    def test_claim_of_dead_instance_lapses(self):
+        lease = 0.2
+        first = self.dedup('a', lease)
+        second = self.dedup('b', lease)
+        self.assertTrue(first.claim(self.message))
+        # Nothing renews a claim once its instance is gone.
+        first.close(1)
+        time.sleep(lease * 2)
+        self.assertTrue(second.claim(self.message))
+        self.assertEqual(second.stats()['taken_over'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
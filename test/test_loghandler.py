@@ -0,0 +1,83 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import socket
+import threading
+import time
+import unittest
+
+from pulsetranslator.loghandler import LogHandler
+
+
+class ProbeTimeoutTest(unittest.TestCase):
+
+    def setUp(self):
+        logger = logging.getLogger('ProbeTimeoutTest')
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+        self.handler = LogHandler(logger, None, probe_timeout=(1, 0.2))
+        # Accepts connections, but never answers.
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+
+    def tearDown(self):
+        self.handler.stopping.set()
+        self.handler.close(1)
+        self.server.close()
+
+    def test_unanswered_probe_is_not_ready(self):
+        url = 'http://127.0.0.1:%d/log' % self.server.getsockname()[1]
+        started = time.time()
+        info = self.handler.get_url_info(url)
+        self.assertEqual(info.code, -1)
+        self.assertTrue(time.time() - started < 1)
+        self.assertFalse(self.handler.readiness.is_ready(url, info))
+
+
+
+class DropTest(unittest.TestCase):
+
+    def setUp(self):
+        logger = logging.getLogger('DropTest')
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+        self.handler = LogHandler(logger, None, probe_threads=1,
+                                  retry_interval=0)
+        self.probing = threading.Event()
+        self.release = threading.Event()
+        self.handler.process_message = self.process_message
+
+    def tearDown(self):
+        self.handler.stopping.set()
+        self.release.set()
+        self.handler.close(1)
+
+    def process_message(self, data, payload, since, name, trace=None,
+                        probes=1):
+        # The log is never ready.
+        self.probing.set()
+        self.release.wait(5)
+        return False
+
+    def test_drop_message_being_probed(self):
+        trace = {'trace_id': '0' * 32, 'span_id': '0' * 16,
+                 'key': 'build.try-linux.1.log_uploaded', 'stages': {}}
+        self.handler.handle_message(
+            {'key': 'build.try-linux.1.log_uploaded'}, trace=trace)
+        self.assertTrue(self.probing.wait(5))
+
+        self.assertEqual(self.handler.drop('build.mozilla-*'), (0, 0))
+        self.assertEqual(self.handler.drop('build.try-*'), (0, 1))
+        self.release.set()
+        deadline = time.time() + 5
+        while self.handler.waiting and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.handler.waiting, 0)
+        self.assertEqual(trace['error'], 'Dropped')
+        self.assertEqual(self.handler.tracer.failed, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import os
+import unittest
+
+from pulsetranslator.messageparser import MessageParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_message(name, routing_key=None):
+    with open(os.path.join(HERE, 'pulse_messages', name)) as f:
+        data = json.load(f)
+    if routing_key:
+        data['_meta']['routing_key'] = routing_key
+    return data
+
+
+class JetpackTest(unittest.TestCase):
+    """Jetpack builders are only told apart by their routing keys, e.g.
+    build.jetpack-mozilla-central-win7-debug.18.log_uploaded.
+    """
+
+    def parse(self, data):
+        result, = MessageParser().parse_batch([data])
+        self.assertEqual(result.error, None, result.detail)
+        translation, = result.translations
+        return translation.data
+
+    def test_linux(self):
+        data = self.parse(load_message(
+            'mozilla-central/build.mozilla-central-linux-debug.120.'
+            'log_uploaded',
+            'build.jetpack-mozilla-central-linux-debug.18.log_uploaded'))
+        self.assertEqual(data['tree'], 'mozilla-central')
+        self.assertEqual(data['platform'], 'linux')
+        self.assertEqual(data['buildtype'], 'debug')
+        self.assertEqual(data['tags'], ('jetpack',))
+
+    def test_platform_from_key_os(self):
+        # The platform property says win32, the key the OS, win7.
+        data = self.parse(load_message(
+            'mozilla-central/build.mozilla-central-win32-debug.334.'
+            'log_uploaded',
+            'build.jetpack-mozilla-central-win7-debug.18.log_uploaded'))
+        self.assertEqual(data['tree'], 'mozilla-central')
+        self.assertEqual(data['platform'], 'win32')
+        self.assertEqual(data['tags'], ('jetpack',))
+
+
+if __name__ == '__main__':
+    unittest.main()
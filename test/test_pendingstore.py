@@ -0,0 +1,73 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from pulsetranslator.pendingstore import PendingStore
+
+
+def keys(record):
+    return record['key'], record.get('routing_key')
+
+
+def record(number, tree='mozilla-central'):
+    return {'key': 'build.%s-linux.%d.log_uploaded' % (tree, number),
+            'routing_key': 'build.%s.linux.opt.%d' % (tree, number)}
+
+
+class PendingStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.spill_path = os.path.join(self.tmpdir, 'pending.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def store(self):
+        return PendingStore(2, self.spill_path, keys=keys)
+
+    def test_remove_from_memory_and_disk(self):
+        store = self.store()
+        for number in range(6):
+            tree = 'try' if number % 2 else 'mozilla-central'
+            store.add(record(number, tree), due=number)
+        self.assertEqual((store.in_memory, store.on_disk), (2, 4))
+
+        removed = store.remove('build.try-*')
+        self.assertEqual(sorted(data['key'] for lane, data in removed),
+                         [record(number, 'try')['key']
+                          for number in (1, 3, 5)])
+        self.assertEqual(len(store), 3)
+        # Normalized routing keys match as well; [!...] negates.
+        removed = store.remove('build.mozilla-central.linux.opt.[!0]')
+        self.assertEqual(sorted(data['key'] for lane, data in removed),
+                         [record(number)['key'] for number in (2, 4)])
+        self.assertEqual([data['key'] for data in store.drain()],
+                         [record(0)['key']])
+
+    def test_resume_database_without_key_columns(self):
+        db = sqlite3.connect(self.spill_path)
+        db.execute('CREATE TABLE pending (id INTEGER PRIMARY KEY, lane TEXT, '
+                   'due REAL, data TEXT)')
+        db.execute('INSERT INTO pending (lane, due, data) VALUES (?, ?, ?)',
+                   ('default', 1, json.dumps(record(7, 'try'))))
+        db.commit()
+        db.close()
+
+        store = self.store()
+        self.assertEqual(len(store), 1)
+        removed = store.remove('build.try.*')
+        self.assertEqual([data['key'] for lane, data in removed],
+                         [record(7, 'try')['key']])
+        self.assertEqual(len(store), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
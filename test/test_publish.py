@@ -0,0 +1,60 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import unittest
+
+from kombu import Connection, Exchange, Queue
+from mozillapulse.messages.base import GenericMessage
+from mozillapulse.publishers import NormalizedBuildPublisher
+
+from pulsetranslator.messageencoder import EncodedMessage
+from pulsetranslator.translatorqueues import publish_encoded
+
+
+class PublishEncodedTest(unittest.TestCase):
+    """publish_encoded() must send what GenericPublisher.publish() would."""
+
+    def setUp(self):
+        self.connection = Connection('memory://')
+        self.publisher = NormalizedBuildPublisher(connect=False)
+        self.publisher.connection = self.connection
+        self.queue = Queue('normalized',
+                           Exchange(self.publisher.exchange, type='topic'),
+                           routing_key='#')
+        self.queue(self.connection.default_channel).declare()
+
+    def tearDown(self):
+        self.connection.release()
+
+    def receive(self):
+        message = self.queue(self.connection.default_channel).get(
+            no_ack=True)
+        properties = dict(message.properties)
+        del properties['delivery_tag']
+        body = message.payload
+        # Only the time sent may differ.
+        self.assertTrue(body['_meta'].pop('sent'))
+        return (message.content_type, message.content_encoding,
+                message.headers, properties, body)
+
+    def test_same_envelope(self):
+        data = {'tree': 'mozilla-central', 'tags': ['l10n', 'nightly'],
+                'locale': u'fran\xe7ais', 'status': 0, 'buildurl': None}
+        routing_key = 'build.mozilla-central.linux.opt.l10n.nightly'
+
+        publish_encoded(self.publisher, EncodedMessage(
+            routing_key, data, json.dumps(data)))
+        encoded = self.receive()
+
+        message = GenericMessage()
+        message.routing_parts = routing_key.split('.')
+        for key, value in data.iteritems():
+            message.set_data(key, value)
+        self.publisher.publish(message)
+        self.assertEqual(encoded, self.receive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import signal
+import StringIO
+import sys
+import tempfile
+import unittest
+
+from pulsetranslator.pulsetranslator import PulseBuildbotTranslator
+from pulsetranslator.translatorexceptions import ShutdownRequested
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MESSAGE = os.path.join(HERE, 'pulse_messages', 'mozilla-central',
+                       'build.mozilla-central-linux.98.log_uploaded')
+
+
+class UnavailableConsumer(object):
+    """A consumer whose broker cannot be reached."""
+
+    def __init__(self, applabel, connect):
+        self.disconnects = 0
+
+    def configure(self, **kwargs):
+        pass
+
+    def listen(self, on_connect_callback=None):
+        raise IOError('broker unavailable')
+
+    def disconnect(self):
+        self.disconnects += 1
+
+
+class InterruptedLogger(object):
+    """Stands in for the error logger when SIGTERM arrives while the
+    listener logs a failure.
+    """
+
+    def exception(self, *args, **kwargs):
+        raise ShutdownRequested()
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class ShutdownTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logdir = tempfile.mkdtemp()
+        self.handlers = dict((signum, signal.getsignal(signum))
+                             for signum in (signal.SIGTERM, signal.SIGUSR1))
+
+    def tearDown(self):
+        for signum, handler in self.handlers.iteritems():
+            signal.signal(signum, handler)
+        shutil.rmtree(self.logdir)
+
+    def test_shutdown_requested_while_handling_failure(self):
+        consumers = []
+
+        def consumer_class(**kwargs):
+            consumers.append(UnavailableConsumer(**kwargs))
+            return consumers[-1]
+
+        translator = PulseBuildbotTranslator(logdir=self.logdir,
+                                             consumer_class=consumer_class,
+                                             shutdown_timeout=1)
+        self.assertEqual(signal.getsignal(signal.SIGTERM),
+                         self.handlers[signal.SIGTERM])
+        translator.error_logger = InterruptedLogger()
+        shutdowns = []
+        shutdown = translator.shutdown
+        translator.shutdown = lambda: shutdowns.append(shutdown())
+
+        translator.start()
+        self.assertEqual(shutdowns, [None])
+        self.assertEqual(consumers[0].disconnects, 1)
+
+
+class OneShotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logdir = tempfile.mkdtemp()
+        self.handler = signal.getsignal(signal.SIGTERM)
+
+    def tearDown(self):
+        shutil.rmtree(self.logdir)
+
+    def test_display_only_starts_nothing(self):
+        translator = PulseBuildbotTranslator(logdir=self.logdir,
+                                             message=MESSAGE,
+                                             display_only=True)
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            translator.start()
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertTrue(output.startswith('Build properties:'))
+        self.assertEqual(translator.loghandler.probers, [])
+        self.assertEqual(translator.loghandler.outbox.ident, None)
+        self.assertEqual(translator.profiler.controller, None)
+        self.assertEqual(signal.getsignal(signal.SIGTERM), self.handler)
+        self.assertFalse(os.path.exists(os.path.join(self.logdir,
+                                                     'probe-delays.json')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from pulsetranslator.readiness import StableSizeReadiness, UrlInfo
+
+URL = 'http://ftp.mozilla.org/pub/firefox/tinderbox-builds/log.txt.gz'
+
+
+class StableSizeReadinessTest(unittest.TestCase):
+
+    def test_garbled_content_length_is_not_ready(self):
+        readiness = StableSizeReadiness(stable_interval=0)
+        info = UrlInfo(200, '12a4, 1204', None, None, None)
+        self.assertFalse(readiness.is_ready(URL, info))
+        self.assertTrue(readiness.is_ready(
+            URL, info._replace(content_length='1204')))
+
+    def test_empty_log_is_not_ready(self):
+        readiness = StableSizeReadiness(stable_interval=0)
+        self.assertFalse(readiness.is_ready(
+            URL, UrlInfo(200, '0', None, None, None)))
+
+
+if __name__ == '__main__':
+    unittest.main()
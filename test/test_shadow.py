@@ -0,0 +1,43 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from pulsetranslator.messageparser import Translation
+from pulsetranslator.shadow import describe, diff
+
+
+def build(**fields):
+    data = {'tree': 'mozilla-central', 'platform': 'linux64',
+            'buildtype': 'opt', 'product': 'firefox',
+            'tags': ('nightly',)}
+    data.update(fields)
+    return [Translation('build', data)]
+
+
+class DiffTest(unittest.TestCase):
+
+    def test_compares_published_json(self):
+        # The primary interns tags as a tuple; a list publishes the same.
+        self.assertEqual(diff(describe(build(), None),
+                              describe(build(tags=['nightly']), None)),
+                         None)
+
+    def test_reports_differing_fields(self):
+        differences = diff(describe(build(), None),
+                           describe(build(tags=['pgo']), None))
+        self.assertEqual(differences['messages'],
+                         [{'index': 0,
+                           'fields': {'tags': [['nightly'], ['pgo']]}}])
+
+    def test_reports_unpublishable_payloads(self):
+        differences = diff(describe(build(), None),
+                           describe(build(tags=set(['nightly'])), None))
+        self.assertEqual(sorted(differences['messages'][0]['fields']),
+                         ['<unpublishable>', 'buildtype', 'platform',
+                          'product', 'tags', 'tree'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import logging
+import unittest
+
+from pulsetranslator.messageencoder import EncodedMessage
+from pulsetranslator.sinks import BackgroundSink
+
+
+def message(number):
+    data = {'number': number}
+    return EncodedMessage('build.%d' % number, data, json.dumps(data))
+
+
+class RefusingSink(object):
+    """Write one message at a time, failing ``failures`` times on
+    ``refused``.
+    """
+
+    def __init__(self, refused, failures):
+        self.refused = refused
+        self.failures = failures
+        self.written = []
+
+    def publish(self, message):
+        if message.data['number'] == self.refused and self.failures:
+            self.failures -= 1
+            raise IOError('simulated write failure')
+        self.written.append(message.data['number'])
+
+
+class BackgroundSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('BackgroundSinkTest')
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.propagate = False
+
+    def background(self, sink):
+        background = BackgroundSink(sink, self.logger, min_backoff=0.01,
+                                    max_attempts=3)
+        for number in range(5):
+            background.publish(message(number))
+        background.start()
+        self.assertEqual(background.flush(5), 0)
+        return background
+
+    def test_retry_resumes_after_written_messages(self):
+        sink = RefusingSink(refused=2, failures=2)
+        background = self.background(sink)
+        self.assertEqual(sink.written, [0, 1, 2, 3, 4])
+        self.assertEqual(background.failed, 0)
+
+    def test_refused_batch_is_dropped(self):
+        sink = RefusingSink(refused=2, failures=1000)
+        background = self.background(sink)
+        self.assertEqual(sink.written, [0, 1])
+        self.assertEqual(background.failed, 3)
+
+        background.publish(message(5))
+        self.assertEqual(background.flush(5), 0)
+        self.assertEqual(sink.written, [0, 1, 5])
+
+
+if __name__ == '__main__':
+    unittest.main()
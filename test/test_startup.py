@@ -0,0 +1,31 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import subprocess
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STARTUPCHECK = os.path.join(HERE, os.pardir, 'pulsetranslator',
+                            'startupcheck.py')
+# The 150 ms budget is measured with startupcheck.py on an idle machine;
+# here the budget only catches gross regressions, such as network stacks
+# imported eagerly, without failing on loaded machines.
+BUDGET = 1000
+
+
+class StartupBudgetTest(unittest.TestCase):
+
+    def test_startup_within_budget(self):
+        process = subprocess.Popen([sys.executable, STARTUPCHECK,
+                                    '--budget', str(BUDGET), '--runs', '3'],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0, output)
+
+
+if __name__ == '__main__':
+    unittest.main()
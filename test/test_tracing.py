@@ -0,0 +1,39 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from pulsetranslator.tracing import Tracer, to_span
+
+
+class TracerTest(unittest.TestCase):
+
+    def trace(self, tracer):
+        data = {'_meta': {'routing_key': 'build.mozilla-central-linux.1.'
+                                         'log_uploaded'}}
+        return tracer.child(tracer.start(data, now=100), 'build',
+                            {'tree': 'mozilla-central'})
+
+    def test_deduplicated_trace_is_counted(self):
+        tracer = Tracer()
+        published = self.trace(tracer)
+        tracer.finish(published, now=101)
+        deduplicated = self.trace(tracer)
+        tracer.finish(deduplicated, deduplicated=True)
+
+        stats = tracer.stats()
+        self.assertEqual((stats['completed'], stats['deduplicated'],
+                          stats['failed']), (1, 1, 0))
+        # Only messages published here count towards publish latency.
+        self.assertEqual(
+            stats['latency']['mozilla-central/build']['total']['count'], 1)
+        self.assertNotIn('published', deduplicated['stages'])
+        span = to_span(deduplicated, 'pulsetranslator')
+        self.assertIn({'key': 'translator.outcome',
+                       'value': {'stringValue': 'deduplicated'}},
+                      span['attributes'])
+
+
+if __name__ == '__main__':
+    unittest.main()
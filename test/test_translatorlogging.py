@@ -0,0 +1,51 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import sys
+import time
+import unittest
+
+from pulsetranslator.translatorexceptions import BadPulseMessageError
+from pulsetranslator.translatorlogging import RateLimitFilter
+
+
+def error_record(routing_key):
+    try:
+        raise BadPulseMessageError(routing_key, 'no buildid')
+    except BadPulseMessageError:
+        exc_info = sys.exc_info()
+    return logging.LogRecord('ErrorLog', logging.ERROR, __file__, 0,
+                             {'key': routing_key}, None, exc_info)
+
+
+class RateLimitFilterTest(unittest.TestCase):
+
+    def test_distinct_messages_share_a_limit(self):
+        limit = RateLimitFilter(burst=2, sample=10)
+        allowed = [limit.filter(error_record('build.%d' % number))
+                   for number in range(10)]
+        self.assertEqual(allowed, [True, True] + [False] * 7 + [True])
+        self.assertEqual(len(limit.counters), 1)
+
+    def test_keys_are_bounded(self):
+        limit = RateLimitFilter(maxkeys=5)
+        for number in range(20):
+            limit.filter(logging.LogRecord(
+                'ErrorLog', logging.ERROR, __file__, 0,
+                'Failure when publishing build.%d' % number, None, None))
+        self.assertEqual(len(limit.counters), 5)
+
+    def test_expired_keys_are_forgotten(self):
+        limit = RateLimitFilter(interval=0.01)
+        limit.filter(error_record('build.1'))
+        time.sleep(0.02)
+        limit.filter(logging.LogRecord('ErrorLog', logging.INFO, __file__,
+                                       0, 'shutdown', None, None))
+        self.assertEqual(limit.counters.keys(),
+                         [('ErrorLog', logging.INFO, 'shutdown')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import glob
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from pulsetranslator.messageencoder import EncodedMessage
+from pulsetranslator.priorities import PriorityClasses
+from pulsetranslator.translatorqueues import PublishOutbox
+
+
+def message(number, tree='try'):
+    data = {'number': number, 'tree': tree}
+    return EncodedMessage('build.%d' % number, data, json.dumps(data),
+                          {'trace_id': '%032x' % number})
+
+
+class FlakyPublisher(object):
+    """Fail the first attempt at each of ``failing`` messages."""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.published = []
+        self.lock = threading.Lock()
+
+    def __call__(self, message):
+        with self.lock:
+            if message.data['number'] in self.failing:
+                self.failing.remove(message.data['number'])
+                raise IOError('simulated publish failure')
+            self.published.append(message)
+
+
+class PublishOutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.overflow_path = os.path.join(self.tmpdir, 'outbox-overflow.json')
+        self.logger = logging.getLogger('PublishOutboxTest')
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.propagate = False
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def outbox(self, publish, **kwargs):
+        return PublishOutbox(publish, self.logger,
+                             overflow_path=self.overflow_path, **kwargs)
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    # Messages are added after publishing them failed once.
+
+    def test_failed_message_does_not_stall_the_rest(self):
+        publisher = FlakyPublisher(failing=[1, 3])
+        outbox = self.outbox(publisher, min_backoff=60)
+        for number in range(5):
+            outbox.add(message(number))
+        outbox.start()
+        self.assertTrue(self.wait_for(lambda: not outbox.backlog, 2))
+        self.assertEqual([m.data['number'] for m in publisher.published],
+                         [0, 2, 4, 1, 3])
+        outbox.drain(0)
+
+    def test_failures_in_row_back_off(self):
+        publisher = FlakyPublisher(failing=[0])
+        outbox = self.outbox(publisher, min_backoff=60)
+        for number in range(3):
+            outbox.add(message(number))
+        outbox.start()
+        self.assertTrue(self.wait_for(lambda: outbox.failures == 1, 2))
+        time.sleep(0.1)
+        stats = outbox.stats()
+        self.assertEqual(publisher.published, [])
+        self.assertEqual(stats['backoff'], 120)
+        self.assertTrue(stats['retry_in'] > 50)
+        outbox.drain(0)
+
+    def test_classes_are_served_by_weight(self):
+        publisher = FlakyPublisher()
+        outbox = self.outbox(publisher,
+                             priorities=PriorityClasses([('release-*', 8)]))
+        for number in range(4):
+            outbox.add(message(number))
+        for number in range(4, 6):
+            outbox.add(message(number, tree='release-mozilla-beta'))
+        self.assertEqual(outbox.stats()['lanes'],
+                         {'default': 4, 'release-*': 2})
+        outbox.start()
+        self.assertTrue(self.wait_for(lambda: not outbox.backlog, 2))
+        # Release messages need not wait behind the try backlog.
+        self.assertEqual([m.data['number'] for m in publisher.published],
+                         [0, 4, 5, 1, 2, 3])
+        outbox.drain(0)
+
+    def test_overflow_segments_keep_order_and_traces(self):
+        outbox = self.outbox(FlakyPublisher(), maxsize=3)
+        for number in range(10):
+            outbox.add(message(number))
+        self.assertEqual(outbox.in_memory, 3)
+        self.assertEqual(outbox.overflow, 7)
+        self.assertEqual(len(glob.glob(self.overflow_path + '.*')), 3)
+
+        # A new outbox resumes the segments left behind.
+        publisher = FlakyPublisher()
+        resumed = self.outbox(publisher, maxsize=3)
+        self.assertEqual(resumed.overflow, 7)
+        resumed.start()
+        self.assertTrue(self.wait_for(lambda: not resumed.backlog))
+        self.assertEqual([m.data['number'] for m in publisher.published],
+                         range(3, 10))
+        self.assertEqual(publisher.published[0].trace,
+                         {'trace_id': '%032x' % 3})
+        self.assertEqual(glob.glob(self.overflow_path + '*'), [])
+        resumed.drain(0)
+
+    def test_drain_returns_overflow_with_traces(self):
+        outbox = self.outbox(FlakyPublisher(), maxsize=2)
+        for number in range(5):
+            outbox.add(message(number))
+        remaining = outbox.drain(0)
+        self.assertEqual([record['data']['number'] for record in remaining],
+                         range(5))
+        self.assertEqual(remaining[4]['trace'], {'trace_id': '%032x' % 4})
+
+
+if __name__ == '__main__':
+    unittest.main()